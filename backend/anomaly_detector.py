@@ -0,0 +1,370 @@
+"""
+Live anomaly detection for ingested readings against stored forecast bands.
+
+`ForecastBands` keeps the newest `yhat_lower`/`yhat_upper` of every model per
+minute in memory. It reads them from the `forecasts` table written by
+`forecast_scheduler.py` and refreshes every `refresh_s` seconds, so Prophet is
+never called on the ingest path. A device uses its own model's forecast, else
+its department's (`dept:<department>`); the global `*` model describes no
+single device and is not used.
+
+`AnomalyDetector.observe_many(rows)` is called with the rows each committed
+batch actually inserted (duplicates and failed batches never count). The
+ingest pipeline sends every device to one writer, so a device's batches
+arrive in commit order; readings are still held per device for `reorder_s`
+seconds and checked in `ds` order, which also merges the batches of several
+worker processes (see below). Readings without a band (no forecast for that
+device and minute) are only counted. A reading that arrives after newer ones
+of its device were already checked is still checked: it counts as `late`, and
+when it lies outside on the side of the open episode it is recorded in it,
+but it never moves the debounce streaks back in time.
+
+Per device, a reading is *outside* when it lies beyond the band by more than
+`margin` x band width, and *inside* when it lies within the band itself;
+readings in between change nothing (hysteresis). An episode opens after
+`debounce` consecutive outside readings on the same side and closes after
+`debounce` consecutive inside readings. Episodes are written to `anomalies`
+by a background thread (insert on open, update on close).
+
+With `--processes N` the workers do not check readings themselves: each
+forwards its committed rows through `AnomalyForwarder` to the supervisor,
+which runs the only `AnomalyDetector`, so every device has one state.
+"""
+
+import heapq
+import queue
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert, text, update
+from sqlalchemy.exc import SQLAlchemyError
+
+from .devices import device_cache
+from .model_registry import department_key
+from .sensor_schema import anomalies_table, ensure_forecast_tables
+
+# Newest forecast per (model, minute) among recent runs; ix_forecasts_generated_at bounds the scan.
+BANDS_SQL = text(
+    "SELECT DISTINCT ON (device, ds) device, ds, yhat_lower, yhat_upper FROM forecasts "
+    "WHERE generated_at >= :since AND ds >= :since AND yhat_lower IS NOT NULL "
+    "ORDER BY device, ds, generated_at DESC"
+)
+DEPARTMENTS_SQL = text("SELECT name, department FROM devices")
+
+
+class ForecastBands:
+    """In-memory `(model key, minute) -> (lower, upper)` map plus device name -> model key."""
+
+    def __init__(self, max_age=timedelta(hours=2)):
+        self.max_age = max_age
+        # Replaced as one tuple on refresh, so readers need no lock.
+        self.state = ({}, {})
+        self.refreshed = None
+
+    def refresh(self, engine, now=None):
+        now = now or datetime.utcnow()
+        with engine.connect() as conn:
+            rows = conn.execute(BANDS_SQL, {"since": now - self.max_age}).fetchall()
+            devices = conn.execute(DEPARTMENTS_SQL).fetchall()
+        bands = {(r.device, r.ds): (r.yhat_lower, r.yhat_upper) for r in rows}
+        models = {r.device for r in rows}
+        device_keys = {}
+        for name, department in devices:
+            if name in models:
+                device_keys[name] = name
+            elif department is not None and department_key(department) in models:
+                device_keys[name] = department_key(department)
+        self.state = (device_keys, bands)
+        self.refreshed = now
+        return len(bands)
+
+
+class Episode:
+    __slots__ = ("id", "device", "model", "direction", "started_at", "ended_at", "readings",
+                 "peak_value", "peak_deviation", "lower", "upper")
+
+    def __init__(self, device, model, direction, started_at):
+        self.id = None
+        self.device = device
+        self.model = model
+        self.direction = direction
+        self.started_at = started_at
+        self.ended_at = None
+        self.readings = 0
+        self.peak_value = None
+        self.peak_deviation = -1.0
+        self.lower = self.upper = None
+
+    def record(self, value, deviation, lower, upper):
+        self.readings += 1
+        if deviation > self.peak_deviation:
+            self.peak_value, self.peak_deviation = value, deviation
+            self.lower, self.upper = lower, upper
+
+
+class _DeviceState:
+    __slots__ = ("pending", "newest", "arrived", "streak", "inside", "candidate", "episode", "last_ds")
+
+    def __init__(self):
+        self.pending = []      # heap of (ds, value) held for reordering
+        self.newest = None     # newest ds received
+        self.arrived = 0.0     # monotonic time of the last reading received
+        self.last_ds = None    # newest reading checked
+        self.streak = 0        # consecutive outside readings on `candidate.direction`
+        self.inside = 0        # consecutive inside readings while an episode is open
+        self.candidate = None  # Episode being debounced
+        self.episode = None    # open Episode
+
+
+class AnomalyDetector:
+    def __init__(self, engine, margin=0.1, debounce=3, refresh_s=60, queue_size=10000, reorder_s=5.0):
+        self.engine = engine
+        self.margin = margin
+        self.debounce = max(1, debounce)
+        self.refresh_s = refresh_s
+        self.reorder = timedelta(seconds=max(0.0, reorder_s))
+        self.reorder_s = max(0.0, reorder_s)
+        self.bands = ForecastBands()
+        self._devices = {}
+        self._lock = threading.Lock()
+        self._events = queue.Queue(maxsize=max(1, queue_size))
+        self._stop = threading.Event()
+        self._writer_stop = threading.Event()
+        self._threads = []
+        self._writer = None
+        self.checked = 0
+        self.no_band = 0
+        self.late = 0
+        self.late_outside = 0
+        self.opened = 0
+        self.closed = 0
+        self.dropped = 0
+
+    def observe_many(self, rows):
+        for row in rows:
+            self.observe(row)
+
+    def observe(self, row):
+        """Take one committed `(ds, device_name, value)` reading; it is checked once its device's hold passes."""
+        ds, name, value = row
+        with self._lock:
+            state = self._devices.get(name)
+            if state is None:
+                state = self._devices[name] = _DeviceState()
+            if state.last_ds is not None and ds <= state.last_ds:
+                self._check_late(state, name, ds, value)
+                return
+            heapq.heappush(state.pending, (ds, value))
+            state.arrived = time.monotonic()
+            if state.newest is None or ds > state.newest:
+                state.newest = ds
+            self._release(state, name, state.newest - self.reorder)
+
+    def flush(self, idle_s=None):
+        """Check the held readings of devices idle for `idle_s` seconds (all of them when None)."""
+        cutoff = time.monotonic() - idle_s if idle_s is not None else None
+        with self._lock:
+            for name, state in self._devices.items():
+                if state.pending and (cutoff is None or state.arrived <= cutoff):
+                    self._release(state, name, state.newest)
+
+    def _release(self, state, name, upto):
+        while state.pending and state.pending[0][0] <= upto:
+            ds, value = heapq.heappop(state.pending)
+            self._check(state, name, ds, value)
+
+    def _classify(self, name, ds, value):
+        """`(model, side, deviation, lower, upper)` of a reading, or None without a band."""
+        device_keys, bands = self.bands.state
+        model = device_keys.get(name)
+        band = bands.get((model, ds.replace(second=0, microsecond=0)))
+        if band is None or value is None:
+            return None
+        lower, upper = band
+        slack = self.margin * (upper - lower)
+        if value > upper + slack:
+            return model, "high", value - upper, lower, upper
+        if value < lower - slack:
+            return model, "low", lower - value, lower, upper
+        if lower <= value <= upper:
+            return model, None, 0.0, lower, upper
+        return model, "between", 0.0, lower, upper
+
+    def _check_late(self, state, name, ds, value):
+        found = self._classify(name, ds, value)
+        if found is None:
+            self.no_band += 1
+            return
+        model, side, deviation, lower, upper = found
+        self.checked += 1
+        self.late += 1
+        if side not in ("high", "low"):
+            return
+        episode = state.episode
+        if episode is not None and episode.direction == side and ds >= episode.started_at:
+            episode.record(value, deviation, lower, upper)
+        else:
+            self.late_outside += 1
+
+    def _check(self, state, name, ds, value):
+        """Advance `name`'s streaks with the reading at `ds`. Called with the lock held, in `ds` order."""
+        state.last_ds = ds
+        found = self._classify(name, ds, value)
+        if found is None:
+            self.no_band += 1
+            return
+        model, side, deviation, lower, upper = found
+        self.checked += 1
+        episode = state.episode
+        if side is None:
+            state.streak = 0
+            state.candidate = None
+            if episode is not None:
+                state.inside += 1
+                if state.inside >= self.debounce:
+                    episode.ended_at = ds
+                    state.episode = None
+                    state.inside = 0
+                    self.closed += 1
+                    self._emit(episode)
+        elif side != "between":
+            state.inside = 0
+            if episode is not None:
+                if side == episode.direction:
+                    episode.record(value, deviation, lower, upper)
+                return
+            candidate = state.candidate
+            if candidate is None or candidate.direction != side:
+                candidate = state.candidate = Episode(name, model, side, ds)
+                state.streak = 0
+            candidate.record(value, deviation, lower, upper)
+            state.streak += 1
+            if state.streak >= self.debounce:
+                state.episode, state.candidate, state.streak = candidate, None, 0
+                self.opened += 1
+                self._emit(candidate)
+
+    def _emit(self, episode):
+        try:
+            self._events.put_nowait(episode)
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        try:
+            ensure_forecast_tables(self.engine)
+        except SQLAlchemyError as exc:  # noqa: BLE001
+            print(f"Could not create forecast/anomaly tables: {exc}")
+        self._stop.clear()
+        self._writer_stop.clear()
+        for target, name in ((self._refresh, "anomaly-bands"), (self._flush_idle, "anomaly-reorder")):
+            t = threading.Thread(target=target, name=name, daemon=True)
+            t.start()
+            self._threads.append(t)
+        self._writer = threading.Thread(target=self._write_events, name="anomaly-writer", daemon=True)
+        self._writer.start()
+
+    def close(self):
+        """Stop refreshing, check the readings still held and write the episodes still queued."""
+        self._stop.set()
+        for t in self._threads:
+            t.join()
+        self._threads = []
+        self.flush()
+        self._writer_stop.set()
+        if self._writer is not None:
+            self._writer.join()
+            self._writer = None
+
+    def _flush_idle(self):
+        # Devices that stopped reporting would otherwise hold their last readings forever.
+        interval = max(self.reorder_s / 2, 0.1)
+        while not self._stop.wait(interval):
+            self.flush(idle_s=self.reorder_s)
+
+    def _refresh(self):
+        while True:
+            try:
+                self.bands.refresh(self.engine)
+            except SQLAlchemyError as exc:  # noqa: BLE001
+                print(f"Refreshing forecast bands failed: {exc}")
+            if self._stop.wait(self.refresh_s):
+                return
+
+    def _write_events(self):
+        while True:
+            try:
+                batch = [self._events.get(timeout=0.5)]
+            except queue.Empty:
+                if self._writer_stop.is_set():
+                    return
+                continue
+            while len(batch) < 500:
+                try:
+                    batch.append(self._events.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except SQLAlchemyError as exc:  # noqa: BLE001
+                print(f"Failed to record {len(batch)} anomaly events: {exc}")
+
+    def _write(self, episodes):
+        ids = device_cache.resolve(self.engine, {e.device for e in episodes})
+        table = anomalies_table
+        # Row ids of episodes inserted by this batch; kept off the episodes until the commit,
+        # so after a rollback their close is inserted again rather than updating a missing row.
+        inserted = {}
+        with self.engine.begin() as conn:
+            for e in episodes:
+                values = {
+                    "ended_at": e.ended_at,
+                    "readings": e.readings,
+                    "peak_value": e.peak_value,
+                    "peak_deviation": e.peak_deviation,
+                    "expected_lower": e.lower,
+                    "expected_upper": e.upper,
+                }
+                row_id = e.id if e.id is not None else inserted.get(e)
+                if row_id is None:
+                    # Open event, or a close whose open event was dropped.
+                    values.update(device_id=ids[e.device], started_at=e.started_at, direction=e.direction, model=e.model)
+                    inserted[e] = conn.execute(insert(table).values(**values).returning(table.c.id)).scalar()
+                else:
+                    conn.execute(update(table).where(table.c.id == row_id).values(**values))
+        for e, row_id in inserted.items():
+            e.id = row_id
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "anomaly_checked": self.checked,
+                "anomaly_no_band": self.no_band,
+                "anomaly_late": self.late,
+                "anomaly_late_outside": self.late_outside,
+                "anomaly_held": sum(len(s.pending) for s in self._devices.values()),
+                "anomalies_opened": self.opened,
+                "anomalies_closed": self.closed,
+                "anomalies_open": sum(1 for s in self._devices.values() if s.episode is not None),
+                "anomaly_events_dropped": self.dropped,
+                "forecast_bands": len(self.bands.state[1]),
+            }
+
+
+class AnomalyForwarder:
+    """Stands in for the detector in a supervised worker: sends committed rows to the supervisor's queue."""
+
+    def __init__(self, rows_queue):
+        self.rows_queue = rows_queue
+        self.forwarded = 0
+
+    def observe_many(self, rows):
+        self.rows_queue.put(list(rows))
+        self.forwarded += len(rows)
+
+    def close(self):
+        pass
+
+    def snapshot(self):
+        return {"anomaly_rows_forwarded": self.forwarded}
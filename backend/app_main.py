@@ -2,6 +2,8 @@
 Application entrypoint that mounts auth and model APIs into a single FastAPI app.
 This allows the Docker image to expose a single HTTP service for auth, model, and health checks.
 """
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 
 # Use package-relative imports so the module works when run as
@@ -9,20 +11,52 @@ from fastapi import FastAPI
 from . import auth_api
 from . import notify_api
 
+# The sensor API needs a database driver and numpy; keep the app usable without them.
+try:
+    from . import sensors_api
+except Exception as _err:
+    sensors_api = None
+    _sensors_import_error = _err
+
 # Import model app lazily: it's optional for dev (heavy ML deps may be absent).
 try:
     from . import serve_prophet
     _model_app = serve_prophet.app
 except Exception as _err:
+    serve_prophet = None
     _model_app = None
     _model_import_error = _err
 
-app = FastAPI(title="ENERGIA Backend")
+
+# Mounted sub-apps don't receive lifecycle events; drive the sensor feed and the
+# model loader from here. The model loads in the background, so the service is
+# ready immediately and /model/health reports `model_loaded` once it is in.
+@asynccontextmanager
+async def lifespan(app):
+    if sensors_api is not None:
+        sensors_api.start()
+    if serve_prophet is not None:
+        serve_prophet.start()
+    yield
+    if serve_prophet is not None:
+        serve_prophet.stop()
+    if sensors_api is not None:
+        sensors_api.stop()
+
+
+app = FastAPI(title="ENERGIA Backend", lifespan=lifespan)
 
 # Mount sub-apps on distinct prefixes so endpoints don't collide.
-# Auth endpoints will be available at /auth/* and model endpoints at /model/*
+# Auth endpoints will be available at /auth/*, model endpoints at /model/*
+# and live sensor reads at /sensors/*
 app.mount("/auth", auth_api.app)
 app.mount("/notify", notify_api.app)
+if sensors_api is not None:
+    app.mount("/sensors", sensors_api.app)
+else:
+    @app.get("/sensors/status")
+    def sensors_status():
+        return {"available": False, "error": str(_sensors_import_error)}
 if _model_app is not None:
     app.mount("/model", _model_app)
 else:
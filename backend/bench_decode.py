@@ -0,0 +1,146 @@
+"""
+Microbenchmark for the ingest decode path.
+
+Compares the per-message cost of the original JSON/ISO decode with the
+decoders in `ingest_decoders.py`. No broker or database is needed.
+
+Before timing, a set of malformed payloads is fed through
+`DecoderRouter.decode`; each must be rejected (None) rather than raise, since
+an exception there would kill an ingest writer thread. The script exits
+non-zero if one is not.
+
+Usage:
+  python -m backend.bench_decode --messages 200000
+"""
+
+import argparse
+import json
+import random
+import struct
+import sys
+import time
+from datetime import datetime, timedelta
+
+from . import ingest_decoders as dec
+
+TOPIC = "energia/sensors/cse/esp32-01"
+
+
+def legacy_decode(topic, raw):
+    """The decode path `mqtt_ingest.on_message` used before the decoder layer."""
+    payload = json.loads(raw.decode())
+    device_id = payload.get("device_id") or payload.get("id") or topic
+    ts = payload.get("ts")
+    if ts:
+        try:
+            ts = datetime.fromisoformat(ts.replace("Z", "+00:00"))
+        except Exception:
+            ts = datetime.utcnow()
+    else:
+        ts = datetime.utcnow()
+    value = payload.get("value") if payload.get("value") is not None else payload.get("y")
+    return (ts, device_id, float(value))
+
+
+def make_payloads(n):
+    start = datetime(2025, 12, 6, 12, 0)
+    readings = [
+        (start + timedelta(seconds=5 * i), f"esp32-{i % 300:03d}", round(random.uniform(0, 50), 3))
+        for i in range(n)
+    ]
+    iso = [
+        json.dumps({"device_id": d, "ts": ts.isoformat() + "Z", "value": v}).encode()
+        for ts, d, v in readings
+    ]
+    epoch = [
+        json.dumps({"device_id": d, "ts": int((ts - datetime(1970, 1, 1)).total_seconds()), "value": v}).encode()
+        for ts, d, v in readings
+    ]
+    binary = [dec.encode_binary(ts, d, v) for ts, d, v in readings]
+    cases = [
+        ("legacy json + iso", legacy_decode, iso),
+        ("json + iso", dec.decode_json, iso),
+        ("json + epoch", dec.decode_json, epoch),
+        ("binary", dec.decode_binary, binary),
+    ]
+    if dec.msgpack is not None:
+        packed = [
+            dec.msgpack.packb({"device_id": d, "ts": int((ts - datetime(1970, 1, 1)).total_seconds()), "value": v})
+            for ts, d, v in readings
+        ]
+        cases.append(("msgpack + epoch", dec.decode_msgpack, packed))
+    return cases
+
+
+def malformed_payloads():
+    """`(format, payload)` pairs every decoder must reject without raising."""
+    header = dec.BINARY_HEADER
+    return [
+        ("binary", header.pack(dec.BINARY_VERSION, 1765022400000, 1.0, 2) + b"\xff\xfe"),
+        ("binary", header.pack(dec.BINARY_VERSION, 10**18, 1.0, 0)),
+        ("binary", header.pack(dec.BINARY_VERSION, -(2**63), 1.0, 0)),
+        ("binary", b"\x01" + struct.pack("<q", 0)),
+        ("binary", header.pack(dec.BINARY_VERSION, 1765022400000, float("inf"), 0)),
+        ("binary", header.pack(dec.BINARY_VERSION, 1765022400000, float("nan"), 0)),
+        ("binary", header.pack(dec.BINARY_VERSION, 1765022400000, 1.0, 5) + b"dev\x00x"),
+        ("json", b'{"ts": 1e300, "value": 1}'),
+        ("json", b'{"ts": 1e400, "value": 1}'),
+        ("json", b'{"ts": "2025-13-45T00:00:00Z", "value": 1}'),
+        ("json", b'{"ts": "999999999999999999999999999999", "value": 1}'),
+        ("json", b'{"ts": [1], "value": 1}'),
+        ("json", b'{"value": "abc"}'),
+        ("json", b'{"value": {"a": 1}}'),
+        ("json", b'{"value": "1e999"}'),
+        ("json", b'{"value": "nan"}'),
+        ("json", b'{"value": true}'),
+        ("json", b'{"device_id": "dev\\u0000x", "value": 1}'),
+        ("json", b'{"device_id": "' + b"d" * 256 + b'", "value": 1}'),
+        ("json", b"\xff\xfe"),
+        ("json", b"[1, 2]"),
+    ]
+
+
+def check_malformed():
+    """Descriptions of malformed payloads that were accepted or raised instead of returning None."""
+    failures = []
+    for name, payload in malformed_payloads():
+        router = dec.DecoderRouter([], default=name)
+        try:
+            row = router.decode(TOPIC, payload)
+        except Exception as exc:  # noqa: BLE001
+            failures.append(f"{name} {payload!r}: raised {type(exc).__name__}: {exc}")
+            continue
+        if row is not None:
+            failures.append(f"{name} {payload!r}: accepted as {row!r}")
+    return failures
+
+
+def bench(decode, payloads, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for payload in payloads:
+            decode(TOPIC, payload)
+        best = min(best, time.perf_counter() - started)
+    return best / len(payloads)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=3, help="Best-of-N timing runs per format")
+    args = parser.parse_args()
+
+    failures = check_malformed()
+    for failure in failures:
+        print(f"Malformed payload not rejected: {failure}")
+    if failures:
+        sys.exit(1)
+
+    print(f"JSON backend: {dec._json.__name__}; {args.messages} messages, best of {args.repeat}")
+    baseline = None
+    for name, decode, payloads in make_payloads(args.messages):
+        per_msg = bench(decode, payloads, args.repeat)
+        baseline = baseline or per_msg
+        size = sum(len(p) for p in payloads) / len(payloads)
+        print(f"{name:<20} {per_msg * 1e9:8.0f} ns/msg  {baseline / per_msg:5.2f}x  {size:5.1f} B/msg")
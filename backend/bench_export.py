@@ -0,0 +1,106 @@
+"""
+Export tens of millions of rows through the `/sensors/export` path and check
+that resident memory stays bounded.
+
+Seeds `--rows` readings for `--devices` fresh devices (`bench-export-<run id>-NNNNN`,
+all in one department) straight into `sensor_data` with `generate_series`,
+then streams them back with the endpoint's own `build_query` and `export`,
+filtered by that department and the seeded time range, so the server-side
+cursor reads the real table and partitions. The encoded output is discarded;
+only its size is counted. Exits non-zero when RSS grows by more than
+`--max-rss-growth-mb`. The seeded devices and rows are deleted afterwards
+unless `--keep` is given.
+
+Usage:
+  python -m backend.bench_export --rows 20000000 --format csv.gz
+"""
+
+import argparse
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, text
+
+from . import config as cfg
+from . import sensor_partitions
+from .bench_ingest import cleanup
+from .sensor_export import FORMATS, build_query, export
+
+REGISTER_SQL = text(
+    "INSERT INTO devices (name, department) "
+    "SELECT :prefix || lpad(g::text, 5, '0'), :department FROM generate_series(0, :devices - 1) g "
+    "RETURNING id"
+)
+# Device g % n gets one reading per second, so (device_id, ds) stays unique.
+SEED_SQL = text(
+    "INSERT INTO sensor_data (device_id, ds, value) "
+    "SELECT (CAST(:ids AS int[]))[g % :devices + 1], :start + (g / :devices) * interval '1 second', "
+    "(g % 1000) / 10.0::float8 FROM generate_series(0, :rows - 1) g"
+)
+
+
+def rss_mb():
+    with open("/proc/self/status") as fh:
+        for line in fh:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def seed(engine, prefix, department, rows, devices):
+    """Insert the synthetic readings; returns the [start, end) range they cover."""
+    span = timedelta(seconds=-(-rows // devices))
+    start = datetime.utcnow().replace(microsecond=0) - span - timedelta(minutes=1)
+    with engine.begin() as conn:
+        ids = [r[0] for r in conn.execute(REGISTER_SQL, {"prefix": prefix, "department": department,
+                                                         "devices": devices})]
+        sensor_partitions.ensure_partitions(conn, start=start)
+        conn.execute(SEED_SQL, {"ids": ids, "devices": devices, "start": start, "rows": rows})
+    with engine.begin() as conn:
+        conn.execute(text("ANALYZE sensor_data"))
+    return start, start + span
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", default=None, help="Database URL (overrides env DB_URL)")
+    parser.add_argument("--rows", type=int, default=20_000_000)
+    parser.add_argument("--devices", type=int, default=200)
+    parser.add_argument("--format", choices=list(FORMATS), default="csv")
+    parser.add_argument("--chunk-rows", type=int, default=50_000)
+    parser.add_argument("--max-rss-growth-mb", type=float, default=150)
+    parser.add_argument("--keep", action="store_true", help="Keep the seeded devices and rows")
+    args = parser.parse_args()
+
+    engine = create_engine(args.db or cfg.get_db_url())
+    run_id = uuid.uuid4().hex[:8]
+    prefix = f"bench-export-{run_id}-"
+    department = f"BENCH-{run_id}"
+    try:
+        started = time.perf_counter()
+        start, end = seed(engine, prefix, department, args.rows, args.devices)
+        print(f"Seeded {args.rows} rows for {args.devices} devices in {time.perf_counter() - started:.1f}s")
+
+        sql, params = build_query(departments=[department], start=start, end=end)
+        baseline = peak = rss_mb()
+        total = 0
+        started = time.perf_counter()
+        for i, data in enumerate(export(engine, args.format, sql, params, args.chunk_rows)):
+            total += len(data)
+            if i % 20 == 0:
+                peak = max(peak, rss_mb())
+        elapsed = time.perf_counter() - started
+        peak = max(peak, rss_mb())
+    finally:
+        if not args.keep:
+            cleanup(engine, prefix + "%")
+
+    growth = peak - baseline
+    print(f"Exported {args.rows} rows as {args.format}: {total / 1024 / 1024:.1f} MiB in {elapsed:.1f}s "
+          f"({args.rows / elapsed:.0f} rows/s)")
+    print(f"RSS: baseline {baseline:.1f} MiB, peak {peak:.1f} MiB, growth {growth:.1f} MiB")
+    if growth > args.max_rss_growth_mb:
+        print(f"FAIL: RSS grew by more than {args.max_rss_growth_mb} MiB")
+        sys.exit(1)
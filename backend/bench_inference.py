@@ -0,0 +1,85 @@
+"""
+Compare latency and interval accuracy of the `serve_prophet` inference modes
+on a trained model.
+
+Each mode predicts the same horizon `--repeat` times. Intervals are scored
+against a reference forecast sampled with `--reference-samples` draws: the
+mean absolute error of `yhat_lower`/`yhat_upper` as a percentage of the
+reference interval width, and the ratio of mean interval widths.
+
+Usage:
+  python -m backend.bench_inference --model models/prophet_model.joblib --periods 60
+"""
+
+import argparse
+import copy
+import json
+import time
+
+import joblib
+import numpy as np
+
+from .serve_prophet import INFERENCE_MODES, forecast
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else None
+
+
+def interval_error(records, reference):
+    """`(error % of reference width, width ratio)` of `records` against `reference`."""
+    lower = np.array([r["yhat_lower"] for r in records])
+    upper = np.array([r["yhat_upper"] for r in records])
+    ref_lower = np.array([r["yhat_lower"] for r in reference])
+    ref_upper = np.array([r["yhat_upper"] for r in reference])
+    width = (ref_upper - ref_lower).mean()
+    error = (np.abs(lower - ref_lower).mean() + np.abs(upper - ref_upper).mean()) / 2
+    return 100 * error / width, (upper - lower).mean() / width
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="models/prophet_model.joblib")
+    parser.add_argument("--freq", default="min")
+    parser.add_argument("--periods", type=int, default=60)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--reference-samples", type=int, default=10000)
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args()
+
+    model = joblib.load(args.model)
+    reference_model = copy.copy(model)
+    reference_model.uncertainty_samples = args.reference_samples
+    reference = forecast(reference_model, args.freq, args.periods)
+
+    report = {"periods": args.periods, "freq": args.freq, "modes": {}}
+    for mode in INFERENCE_MODES:
+        forecast(model, args.freq, args.periods, mode)  # warm-up
+        latencies, errors, widths = [], [], []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            records = forecast(model, args.freq, args.periods, mode)
+            latencies.append((time.perf_counter() - started) * 1000)
+            if mode != "point":
+                error, width = interval_error(records, reference)
+                errors.append(error)
+                widths.append(width)
+        yhat_diff = max(abs(r["yhat"] - ref["yhat"]) for r, ref in zip(records, reference))
+        report["modes"][mode] = {
+            "p50_ms": round(percentile(latencies, 50), 2),
+            "p95_ms": round(percentile(latencies, 95), 2),
+            "interval_error_pct": round(float(np.mean(errors)), 2) if errors else None,
+            "width_ratio": round(float(np.mean(widths)), 3) if widths else None,
+            "max_yhat_diff": yhat_diff,
+        }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"{args.periods} x {args.freq} steps, {args.repeat} runs per mode, "
+              f"reference {args.reference_samples} samples")
+        print(f"{'mode':<6} {'p50 ms':>8} {'p95 ms':>8} {'interval err %':>15} {'width ratio':>12}")
+        for mode, row in report["modes"].items():
+            err = "-" if row["interval_error_pct"] is None else f"{row['interval_error_pct']:.2f}"
+            ratio = "-" if row["width_ratio"] is None else f"{row['width_ratio']:.3f}"
+            print(f"{mode:<6} {row['p50_ms']:>8.1f} {row['p95_ms']:>8.1f} {err:>15} {ratio:>12}")
@@ -0,0 +1,373 @@
+"""
+Load generator and throughput/latency benchmark for the ingest path.
+
+Simulates `--devices` devices that each publish one reading every
+`--interval` seconds for `--duration` seconds, in one of the payload formats
+of `ingest_decoders.py`, and measures:
+
+- sustained publish and commit rates (messages/s)
+- publish-to-commit latency p50/p95/p99/max: every reading carries its publish
+  time as `ts`, and a poller reads committed `sensor_data` rows of the run
+  every `--poll-ms` (which is also the latency resolution). Writer threads
+  commit out of id order, so the poller looks back `--lookback-s` seconds of
+  `ds` and keeps the `(device_id, ds)` keys it has seen; while draining it
+  sweeps the whole run, which catches rows committed later than the lookback
+- database work from `pg_stat_database` / `pg_stat_wal` deltas, plus CPU time
+  of local `postgres` processes when they are visible in /proc
+
+Modes:
+- `broker`    - publish to the MQTT broker (`docker compose up mosquitto db`);
+                the ingestor is either already running or started with
+                `--spawn-ingest` (extra flags via `--ingest-arg`)
+- `inprocess` - no broker: messages go straight into an `IngestPipeline`
+                with the same decoders, filter and writer as `mqtt_ingest.py`
+
+Every run uses fresh device names (`bench-<random run id>-NNNNN`) and deletes
+its rows afterwards unless `--keep` is given. The report is printed and, with
+`--json`, written to a file; `--min-rate` / `--max-p99-ms` make the exit code
+non-zero on regressions.
+
+Usage:
+  python -m backend.bench_ingest --mode inprocess --devices 500 --interval 0.5 --duration 30
+  python -m backend.bench_ingest --spawn-ingest --ingest-arg=--workers=4 --format binary --json ingest.json
+"""
+
+import argparse
+import json
+import os
+import resource
+import signal
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, text
+
+from . import config as cfg
+from . import ingest_decoders as dec
+
+FORMATS = ("json", "json-epoch", "binary", "msgpack")
+
+POLL_SQL = text(
+    "SELECT s.device_id, s.ds FROM sensor_data s JOIN devices d ON d.id = s.device_id "
+    "WHERE s.ds >= :since AND d.name LIKE :pattern"
+)
+DB_STATS_SQL = text(
+    "SELECT xact_commit, tup_inserted, blks_read, blks_hit, temp_bytes "
+    "FROM pg_stat_database WHERE datname = current_database()"
+)
+WAL_STATS_SQL = text("SELECT wal_records, wal_bytes FROM pg_stat_wal")
+_EPOCH = datetime(1970, 1, 1)
+
+
+def encode(fmt, device, value, now):
+    """Payload for one reading published at wall-clock time `now` (epoch seconds)."""
+    ts_ms = int(now * 1000)
+    if fmt == "json":
+        ts = datetime.utcfromtimestamp(ts_ms / 1000).isoformat(timespec="milliseconds") + "Z"
+        return json.dumps({"device_id": device, "ts": ts, "value": value}).encode()
+    if fmt == "json-epoch":
+        return json.dumps({"device_id": device, "ts": ts_ms, "value": value}).encode()
+    if fmt == "binary":
+        return dec.encode_binary(datetime.utcfromtimestamp(ts_ms / 1000), device, value)
+    return dec.msgpack.packb({"device_id": device, "ts": ts_ms, "value": value})
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(q / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def postgres_cpu_seconds():
+    """User+system CPU of local `postgres` processes, or None if none are visible."""
+    ticks = os.sysconf("SC_CLK_TCK")
+    total, found = 0, False
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f"/proc/{pid}/stat") as fh:
+                stat = fh.read()
+        except OSError:
+            continue
+        comm = stat[stat.index("(") + 1:stat.rindex(")")]
+        if comm.startswith("postgres"):
+            fields = stat[stat.rindex(")") + 2:].split()
+            total += int(fields[11]) + int(fields[12])
+            found = True
+    return total / ticks if found else None
+
+
+def db_counters(engine):
+    with engine.connect() as conn:
+        row = conn.execute(DB_STATS_SQL).fetchone()
+        counters = dict(zip(("xact_commit", "tup_inserted", "blks_read", "blks_hit", "temp_bytes"), row))
+        try:
+            wal = conn.execute(WAL_STATS_SQL).fetchone()
+            counters.update(wal_records=wal[0], wal_bytes=int(wal[1]))
+        except Exception:  # noqa: BLE001 - pg_stat_wal needs Postgres 14+
+            pass
+    cpu = postgres_cpu_seconds()
+    if cpu is not None:
+        counters["postgres_cpu_s"] = cpu
+    return counters
+
+
+class CommitPoller:
+    """Polls `sensor_data` for committed bench rows and records their latency."""
+
+    def __init__(self, engine, pattern, poll_ms, lookback_s):
+        self.engine = engine
+        self.pattern = pattern
+        self.interval = poll_ms / 1000.0
+        self.lookback = timedelta(seconds=lookback_s)
+        self.latencies = []
+        self.last_commit = None
+        self.started = datetime.utcnow()
+        self._seen = set()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="commit-poller", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def poll(self, since):
+        """Record rows with `ds >= since` not seen before; returns how many were new."""
+        with self.engine.connect() as conn:
+            rows = conn.execute(POLL_SQL, {"since": since, "pattern": self.pattern}).fetchall()
+        seen = datetime.utcnow()
+        new = [(device_id, ds) for device_id, ds in rows if (device_id, ds) not in self._seen]
+        if new:
+            self.last_commit = time.time()
+            self._seen.update(new)
+            self.latencies.extend((seen - ds).total_seconds() * 1000 for _, ds in new)
+        return len(new)
+
+    def sweep(self):
+        """Poll the whole run once, for rows committed after the lookback window passed them."""
+        return self.poll(self.started - self.lookback)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.poll(max(self.started, datetime.utcnow()) - self.lookback)
+
+
+def publish_loop(send, devices, fmt, interval, duration, counter, lock):
+    """Publish one reading per device every `interval` seconds, evenly spread."""
+    rate = len(devices) / interval
+    started = time.time()
+    n = 0
+    while True:
+        due = started + n / rate
+        now = time.time()
+        if due - started >= duration:
+            break
+        if due > now:
+            time.sleep(due - now)
+            now = time.time()
+        device = devices[n % len(devices)]
+        send(device, encode(fmt, device, round((n % 5000) / 100.0, 2), now))
+        n += 1
+        if n % 1000 == 0:
+            with lock:
+                counter[0] += 1000
+    with lock:
+        counter[0] += n % 1000
+
+
+def run_publishers(send_factory, devices, args):
+    counter, lock = [0], threading.Lock()
+    groups = [devices[i::args.publishers] for i in range(args.publishers)]
+    threads = [
+        threading.Thread(
+            target=publish_loop,
+            args=(send_factory(), group, args.format, args.interval, args.duration, counter, lock),
+            daemon=True,
+        )
+        for group in groups if group
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return counter[0]
+
+
+def mqtt_sender(args):
+    import paho.mqtt.client as mqtt
+
+    client = mqtt.Client()
+    client.max_inflight_messages_set(1000)
+    client.connect(args.broker, args.port, 60)
+    client.loop_start()
+
+    def send(device, payload):
+        client.publish(f"{args.topic_prefix}/{device}", payload, qos=args.qos)
+
+    return send
+
+
+def cleanup(engine, pattern):
+    with engine.begin() as conn:
+        ids = [r[0] for r in conn.execute(text("SELECT id FROM devices WHERE name LIKE :p"), {"p": pattern})]
+        if not ids:
+            return
+        for table in ("sensor_data", "sensor_rollup_1m", "sensor_rollup_1h", "sensor_rollup_1d"):
+            conn.execute(text(f"DELETE FROM {table} WHERE device_id = ANY(:ids)"), {"ids": ids})
+        conn.execute(text("DELETE FROM devices WHERE id = ANY(:ids)"), {"ids": ids})
+
+
+def build_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", default=None, help="Database URL (overrides env DB_URL)")
+    parser.add_argument("--mode", choices=("broker", "inprocess"), default="broker")
+    parser.add_argument("--broker", default=os.environ.get("MQTT_BROKER", "localhost"))
+    parser.add_argument("--port", default=int(os.environ.get("MQTT_PORT", 1883)), type=int)
+    parser.add_argument("--topic-prefix", default="energia/sensors/bench")
+    parser.add_argument("--qos", default=0, type=int, choices=(0, 1))
+    parser.add_argument("--devices", default=200, type=int)
+    parser.add_argument("--interval", default=1.0, type=float, help="Seconds between readings of one device")
+    parser.add_argument("--duration", default=30.0, type=float, help="Seconds to publish for")
+    parser.add_argument("--format", default="json", choices=FORMATS)
+    parser.add_argument("--publishers", default=2, type=int, help="Publishing threads (one MQTT client each)")
+    parser.add_argument("--poll-ms", default=100, type=int, help="Commit poll interval (latency resolution)")
+    parser.add_argument(
+        "--lookback-s", default=10.0, type=float, help="Seconds of ds each commit poll re-reads (late commits)"
+    )
+    parser.add_argument("--drain-timeout", default=30.0, type=float, help="Seconds to wait for the last commits")
+    parser.add_argument("--spawn-ingest", action="store_true", help="Start mqtt_ingest for the run (broker mode)")
+    parser.add_argument("--ingest-arg", action="append", default=[], help="Extra mqtt_ingest flag (repeatable)")
+    parser.add_argument("--workers", default=2, type=int, help="Writer threads (inprocess mode)")
+    parser.add_argument("--batch-size", default=500, type=int, help="Writer batch size (inprocess mode)")
+    parser.add_argument("--flush-ms", default=1000, type=int, help="Writer flush interval (inprocess mode)")
+    parser.add_argument("--json", help="Write the report to this file")
+    parser.add_argument("--min-rate", type=float, help="Exit 1 if the commit rate is below this (msgs/s)")
+    parser.add_argument("--max-p99-ms", type=float, help="Exit 1 if p99 publish-to-commit latency exceeds this")
+    parser.add_argument("--keep", action="store_true", help="Keep the benchmark rows afterwards")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.format == "msgpack" and dec.msgpack is None:
+        sys.exit("msgpack format needs the msgpack package")
+
+    db_url = args.db or cfg.get_db_url()
+    engine = create_engine(db_url)
+    run_id = uuid.uuid4().hex[:12]
+    devices = [f"bench-{run_id}-{i:05d}" for i in range(args.devices)]
+    pattern = f"bench-{run_id}-%"
+    decoder = {"json-epoch": "json"}.get(args.format, args.format)
+
+    ingest = pipeline = None
+    if args.mode == "inprocess":
+        from .ingest_filters import ReadingFilter
+        from .ingest_pipeline import IngestPipeline
+
+        router = dec.DecoderRouter([], default=decoder)
+        pipeline = IngestPipeline(
+            engine, router.decode, workers=args.workers, batch_size=args.batch_size,
+            flush_ms=args.flush_ms, reading_filter=ReadingFilter(),
+        )
+        pipeline.start()
+
+        def send_factory():
+            return lambda device, payload: pipeline.submit(f"{args.topic_prefix}/{device}", payload)
+    else:
+        if args.spawn_ingest:
+            cmd = [
+                sys.executable, "-m", "backend.mqtt_ingest", "--broker", args.broker, "--port", str(args.port),
+                "--topic", f"{args.topic_prefix}/#", "--db", db_url, "--stats-interval", "0",
+                "--default-decoder", decoder, *args.ingest_arg,
+            ]
+            ingest = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+            time.sleep(3)
+
+        def send_factory():
+            return mqtt_sender(args)
+
+    poller = CommitPoller(engine, pattern, args.poll_ms, args.lookback_s)
+    before = db_counters(engine)
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    poller.start()
+
+    started = time.time()
+    published = run_publishers(send_factory, devices, args)
+    publish_s = time.time() - started
+    if pipeline is not None:
+        pipeline.close()
+    # Drain: whole-run sweeps, so readings committed after the lookback window are still found.
+    poller.stop()
+    deadline = time.time() + args.drain_timeout
+    while True:
+        poller.sweep()
+        if len(poller.latencies) >= published or time.time() >= deadline:
+            break
+        time.sleep(args.poll_ms / 1000.0)
+
+    after = db_counters(engine)
+    usage_after = resource.getrusage(resource.RUSAGE_SELF)
+    if ingest is not None:
+        ingest.send_signal(signal.SIGTERM)
+        ingest.wait(timeout=30)
+
+    committed = len(poller.latencies)
+    commit_s = (poller.last_commit or time.time()) - started
+    latencies = sorted(poller.latencies)
+    report = {
+        "config": {k: v for k, v in vars(args).items() if k not in ("db", "json")},
+        "published": published,
+        "committed": committed,
+        "missing": published - committed,
+        "publish_rate": round(published / publish_s, 1),
+        "commit_rate": round(committed / commit_s, 1) if commit_s > 0 else None,
+        "latency_ms": {
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": latencies[-1] if latencies else None,
+            "resolution": args.poll_ms,
+        },
+        "db": {k: round(after[k] - before[k], 2) for k in after if k in before},
+        "bench_cpu_s": round(
+            usage_after.ru_utime + usage_after.ru_stime - usage_before.ru_utime - usage_before.ru_stime, 2
+        ),
+    }
+    if pipeline is not None:
+        report["pipeline"] = pipeline.snapshot()
+    for key in ("p50", "p95", "p99", "max"):
+        if report["latency_ms"][key] is not None:
+            report["latency_ms"][key] = round(report["latency_ms"][key], 1)
+
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, "w") as fh:
+            json.dump(report, fh, indent=2)
+    if not args.keep:
+        cleanup(engine, pattern)
+
+    failed = []
+    if args.min_rate is not None and (report["commit_rate"] or 0) < args.min_rate:
+        failed.append(f"commit rate {report['commit_rate']} < {args.min_rate}")
+    p99 = report["latency_ms"]["p99"]
+    if args.max_p99_ms is not None and (p99 is None or p99 > args.max_p99_ms):
+        failed.append(f"p99 latency {p99} ms > {args.max_p99_ms}")
+    if report["missing"]:
+        failed.append(f"{report['missing']} readings never committed")
+    if failed:
+        print("FAIL: " + "; ".join(failed))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,126 @@
+"""
+Benchmark sensor_data access patterns with and without the indexes from
+`sensor_schema.py`.
+
+Loads N synthetic minute-level rows into a scratch UNLOGGED table
+(`bench_sensor_data`, same columns as `sensor_data`), times the typical
+dashboard and training queries, adds the `(device_id, ds)` btree and the BRIN
+index on `ds`, and times them again. The real `sensor_data` is not touched.
+
+Usage:
+  python -m backend.bench_queries --rows 5000000 --devices 200
+"""
+
+import argparse
+import json
+import statistics
+import time
+
+from sqlalchemy import create_engine, text
+
+from . import config as cfg
+
+TABLE = "bench_sensor_data"
+
+QUERIES = {
+    "dashboard: latest reading of one device": (
+        f"SELECT ds, value FROM {TABLE} WHERE device_id = :device ORDER BY ds DESC LIMIT 1"
+    ),
+    "dashboard: last hour of one device": (
+        f"SELECT ds, value FROM {TABLE} "
+        f"WHERE device_id = :device AND ds >= :end - interval '1 hour' ORDER BY ds"
+    ),
+    "training: 30 days of one device": (
+        f"SELECT ds, value FROM {TABLE} "
+        f"WHERE device_id = :device AND ds >= :end - interval '30 days' ORDER BY ds"
+    ),
+    "training: hourly means of all devices, last 7 days": (
+        f"SELECT date_trunc('hour', ds) AS ds, avg(value) FROM {TABLE} "
+        f"WHERE ds >= :end - interval '7 days' GROUP BY 1 ORDER BY 1"
+    ),
+}
+
+INDEXES = [
+    f"CREATE INDEX ix_{TABLE}_device_ds ON {TABLE} (device_id, ds)",
+    f"CREATE INDEX ix_{TABLE}_ds_brin ON {TABLE} USING brin (ds) WITH (pages_per_range = 32)",
+]
+
+
+def load(conn, rows, devices):
+    per_device = max(1, rows // devices)
+    conn.execute(text(f"DROP TABLE IF EXISTS {TABLE}"))
+    conn.execute(text(
+        f"CREATE UNLOGGED TABLE {TABLE} (id bigint GENERATED BY DEFAULT AS IDENTITY, "
+        f"ds timestamp NOT NULL, value double precision, device_id integer)"
+    ))
+    # Minute-level readings ending now, inserted in time order like live ingest.
+    conn.execute(text(
+        f"INSERT INTO {TABLE} (ds, value, device_id) "
+        f"SELECT date_trunc('minute', now()::timestamp) - m * interval '1 minute', random() * 50, d "
+        f"FROM generate_series(:per_device - 1, 0, -1) m, generate_series(1, :devices) d"
+    ), {"per_device": per_device, "devices": devices})
+    conn.execute(text(f"ANALYZE {TABLE}"))
+    return per_device * devices
+
+
+def time_queries(engine, devices, repeat):
+    results = {}
+    with engine.connect() as conn:
+        end = conn.execute(text(f"SELECT max(ds) FROM {TABLE}")).scalar()
+        for name, sql in QUERIES.items():
+            samples = []
+            for i in range(repeat):
+                params = {"device": 1 + (i * 7919) % devices, "end": end}
+                started = time.perf_counter()
+                conn.execute(text(sql), params).fetchall()
+                samples.append((time.perf_counter() - started) * 1000)
+            results[name] = round(statistics.median(samples), 2)
+    return results
+
+
+def relation_mb(conn, name):
+    return round(conn.execute(text("SELECT pg_relation_size(to_regclass(:n))"), {"n": name}).scalar() / 1024 / 1024, 1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", default=None, help="Database URL (overrides env DB_URL)")
+    parser.add_argument("--rows", type=int, default=2_000_000)
+    parser.add_argument("--devices", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=15, help="Runs per query; the median is reported")
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument("--keep", action="store_true", help=f"Keep {TABLE} afterwards")
+    args = parser.parse_args()
+
+    engine = create_engine(args.db or cfg.get_db_url())
+    started = time.perf_counter()
+    with engine.begin() as conn:
+        loaded = load(conn, args.rows, args.devices)
+    print(f"Loaded {loaded} rows for {args.devices} devices in {time.perf_counter() - started:.1f}s")
+
+    without = time_queries(engine, args.devices, args.repeat)
+    with engine.begin() as conn:
+        for ddl in INDEXES:
+            conn.execute(text(ddl))
+        conn.execute(text(f"ANALYZE {TABLE}"))
+        sizes = {
+            "table_mb": relation_mb(conn, TABLE),
+            "btree_mb": relation_mb(conn, f"ix_{TABLE}_device_ds"),
+            "brin_mb": relation_mb(conn, f"ix_{TABLE}_ds_brin"),
+        }
+    with_idx = time_queries(engine, args.devices, args.repeat)
+
+    print(f"Sizes: {sizes}")
+    print(f"{'query':<52} {'no index ms':>12} {'indexed ms':>12} {'speedup':>8}")
+    for name in QUERIES:
+        speedup = without[name] / with_idx[name] if with_idx[name] else float("inf")
+        print(f"{name:<52} {without[name]:>12.2f} {with_idx[name]:>12.2f} {speedup:>7.1f}x")
+
+    if args.json:
+        with open(args.json, "w") as fh:
+            json.dump({"rows": loaded, "devices": args.devices, "sizes": sizes,
+                       "without_indexes_ms": without, "with_indexes_ms": with_idx}, fh, indent=2)
+
+    if not args.keep:
+        with engine.begin() as conn:
+            conn.execute(text(f"DROP TABLE {TABLE}"))
@@ -1,4 +1,4 @@
-"""Simple DB initializer to create `users` and `sensor_data` tables and insert test users.
+"""Simple DB initializer to create `users`, `devices` and `sensor_data` tables and insert test users.
 Targets PostgreSQL by default; override DB_URL in .env or environment to point at your Postgres instance.
 """
 import os
@@ -9,11 +9,9 @@ from sqlalchemy import (
     Table,
     Column,
     Integer,
-    BigInteger,
     String,
     Text,
     DateTime,
-    Float,
     func,
     select,
     inspect,
@@ -21,6 +19,7 @@ from sqlalchemy import (
 )
 
 from . import config as cfg
+from . import sensor_schema
 
 # Load configuration from environment/.env and enforce PostgreSQL
 DB_URL = cfg.get_db_url()
@@ -43,15 +42,6 @@ users_table = Table(
     Column("created_at", DateTime, server_default=func.now()),
 )
 
-sensor_table = Table(
-    "sensor_data",
-    metadata,
-    Column("id", BigInteger, primary_key=True),
-    Column("ds", DateTime, nullable=False),
-    Column("device_id", String),
-    Column("value", Float),
-)
-
 # Authorized student representatives table for registration verification
 authorized_students_table = Table(
     "authorized_students",
@@ -79,6 +69,10 @@ class_representatives_table = Table(
 )
 
 metadata.create_all(engine)
+sensor_schema.init_sensor_schema(engine)
+reason = sensor_schema.needs_migration(engine)
+if reason:
+    print(f"sensor_data needs migrating ({reason}); run `python -m backend.migrate_sensor_data`")
 
 # Ensure email and name columns exist for existing deployments (idempotent)
 insp = inspect(engine)
@@ -0,0 +1,48 @@
+"""
+In-process cache of device name -> `devices.id`.
+
+Lookups are plain dict reads. Names the cache has not seen are registered in
+one short transaction (a multi-row `INSERT ... ON CONFLICT DO NOTHING` followed
+by a single lookup), separate from the caller's write transaction so a rolled
+back batch can never leave ids in the cache that were not committed.
+"""
+
+import threading
+
+from sqlalchemy import text
+
+REGISTER_SQL = text(
+    "INSERT INTO devices (name) SELECT unnest(CAST(:names AS text[])) ON CONFLICT (name) DO NOTHING"
+)
+LOOKUP_SQL = text("SELECT name, id FROM devices WHERE name = ANY(CAST(:names AS text[]))")
+
+
+class DeviceCache:
+    def __init__(self):
+        self._ids = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, engine, names):
+        """Return a mapping that contains an id for every name in `names`."""
+        ids = self._ids
+        missing = [name for name in names if name not in ids]
+        if missing:
+            self._register(engine, missing)
+        return ids
+
+    def _register(self, engine, names):
+        with self._lock:
+            names = [name for name in names if name not in self._ids]
+            if not names:
+                return
+            with engine.begin() as conn:
+                conn.execute(REGISTER_SQL, {"names": names})
+                found = conn.execute(LOOKUP_SQL, {"names": names}).fetchall()
+            self._ids.update((name, device_id) for name, device_id in found)
+
+    def clear(self):
+        with self._lock:
+            self._ids = {}
+
+
+device_cache = DeviceCache()
@@ -0,0 +1,61 @@
+"""
+Size-bounded TTL cache for forecast results.
+
+Keys are tuples that start with the model version, e.g.
+`(model_version, freq, period, model_key, mode)`, so results of a replaced model
+can never be served; `clear()` drops everything when a new model is loaded.
+Entries expire `ttl` seconds after they were stored and the least recently
+used entry is evicted once `max_entries` is reached.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class ForecastCache:
+    def __init__(self, ttl=60.0, max_entries=256):
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Cached value for `key`, or None when absent or expired."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def snapshot(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else None,
+            }
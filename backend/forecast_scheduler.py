@@ -0,0 +1,179 @@
+"""
+Scheduled next-hour forecasts for every registered model, stored in `forecasts`.
+
+Each run forecasts `periods` steps of `freq` starting at the next step after
+now, for every model in the registry plus the global `MODEL_PATH` model
+(stored under device `*`), and bulk-inserts all rows with one `generated_at`.
+`/model/forecast` then answers from the newest run with an index range scan
+instead of calling Prophet. Older runs are kept for `FORECAST_RETENTION_DAYS`
+so forecasts can be compared with what was actually measured.
+
+Runs in-process in the model service (`FORECAST_SCHEDULE_INTERVAL` > 0) or as
+a CLI next to the trainer:
+  python -m backend.forecast_scheduler --interval 300
+
+Several schedulers may run at once (uvicorn workers, or the CLI next to the
+service). A Postgres advisory lock keeps their runs from overlapping, and a
+run is skipped when the newest stored run is younger than half the interval,
+so together they still store about one run per interval.
+"""
+
+import argparse
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pandas as pd
+from sqlalchemy import create_engine, delete, text
+
+from .sensor_schema import ensure_forecast_tables, forecasts_table
+
+GLOBAL_KEY = "*"
+LOCK_KEY = 0x666F7265  # "fore"
+FORECAST_SCHEDULE_PERIODS = int(os.environ.get("FORECAST_SCHEDULE_PERIODS", 60))
+FORECAST_RETENTION_DAYS = float(os.environ.get("FORECAST_RETENTION_DAYS", 30))
+
+LATEST_SQL = text(
+    "SELECT generated_at, ds, yhat, yhat_lower, yhat_upper, model_version FROM forecasts "
+    "WHERE device = :device AND generated_at = (SELECT max(generated_at) FROM forecasts WHERE device = :device) "
+    "AND ds >= :start AND ds < :end ORDER BY ds"
+)
+NEWEST_RUN_SQL = text("SELECT max(generated_at) FROM forecasts")
+
+
+def registry_models(registry, served=(None, None)):
+    """`(key, model, version)` for the global model and each registered model, loaded one at a time.
+
+    Models already resident in `registry` are reused; the rest are loaded with
+    `registry.loader` outside its LRU and dropped once the caller moves on, so a
+    run never evicts the models the service is busy with.
+    """
+    model, version = served
+    if model is not None:
+        yield GLOBAL_KEY, model, version
+    for key, entry in list(registry.manifest()["models"].items()):
+        model = registry.peek(key, entry["version"])
+        if model is None:
+            try:
+                model = registry.loader(os.path.join(registry.directory, entry["path"]))
+            except Exception as exc:  # noqa: BLE001
+                print(f"Loading model {key} failed: {exc}")
+                continue
+        yield key, model, entry["version"]
+        model = None
+
+
+def next_step(now, freq):
+    return pd.Timestamp(now).floor(freq) + pd.tseries.frequencies.to_offset(freq)
+
+
+def run_once(engine, models, predict, freq="min", periods=FORECAST_SCHEDULE_PERIODS,
+             retention_days=FORECAST_RETENTION_DAYS, now=None, min_age=None):
+    """Forecast and store one run; returns `(models, rows)`, or None when skipped.
+
+    A run is skipped when another one holds the lock, or when the newest
+    stored run is less than `min_age` (a timedelta) old. `freq` is the pandas
+    offset of the forecast steps; `predict(model, start)` returns the records
+    for `periods` steps from `start`.
+
+    The session-level lock is held on an autocommit connection, so it does
+    not sit idle in a transaction while models predict; the server drops it
+    if the process dies.
+    """
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as lock_conn:
+        if not lock_conn.execute(text("SELECT pg_try_advisory_lock(:k)"), {"k": LOCK_KEY}).scalar():
+            return None
+        try:
+            generated_at = (now or datetime.utcnow()).replace(microsecond=0)
+            if min_age is not None:
+                newest = lock_conn.execute(NEWEST_RUN_SQL).scalar()
+                if newest is not None and generated_at - newest < min_age:
+                    return None
+            start = next_step(generated_at, freq)
+            rows, count = [], 0
+            for key, model, version in models:
+                try:
+                    records = predict(model, start)
+                except Exception as exc:  # noqa: BLE001
+                    print(f"Forecast for {key} failed: {exc}")
+                    continue
+                count += 1
+                rows.extend(
+                    {"device": key, "generated_at": generated_at, "ds": r["ds"], "yhat": r["yhat"],
+                     "yhat_lower": r["yhat_lower"], "yhat_upper": r["yhat_upper"], "model_version": version}
+                    for r in records
+                )
+            with engine.begin() as conn:
+                if rows:
+                    conn.execute(forecasts_table.insert(), rows)
+                if retention_days > 0:
+                    cutoff = generated_at - timedelta(days=retention_days)
+                    conn.execute(delete(forecasts_table).where(forecasts_table.c.generated_at < cutoff))
+            return count, len(rows)
+        finally:
+            try:
+                lock_conn.execute(text("SELECT pg_advisory_unlock(:k)"), {"k": LOCK_KEY})
+            except Exception:  # noqa: BLE001
+                # Never hand a connection that may still hold the lock back to the pool.
+                lock_conn.invalidate()
+                raise
+
+
+def latest_forecast(conn, device, start, end):
+    """Rows of the newest stored run for `device` with `start <= ds < end`."""
+    return conn.execute(LATEST_SQL, {"device": device, "start": start, "end": end}).fetchall()
+
+
+def run_forever(engine, make_models, predict, interval, stop, freq="min", periods=FORECAST_SCHEDULE_PERIODS):
+    """Call `run_once` every `interval` seconds until the `stop` event is set."""
+    ensure_forecast_tables(engine)
+    while True:
+        started = time.perf_counter()
+        try:
+            result = run_once(engine, make_models(), predict, freq=freq, periods=periods,
+                              min_age=timedelta(seconds=interval / 2))
+        except Exception as exc:  # noqa: BLE001
+            print(f"Forecast run failed: {exc}")
+        else:
+            if result is None:
+                print("Forecast run skipped: another scheduler is running or ran recently")
+            else:
+                print(f"Stored {result[1]} forecast rows for {result[0]} models "
+                      f"in {time.perf_counter() - started:.1f}s")
+        if stop.wait(max(0.0, interval - (time.perf_counter() - started))):
+            return
+
+
+if __name__ == "__main__":
+    from . import config as cfg
+    from . import serve_prophet
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", default=None, help="Database URL (overrides env DB_URL)")
+    parser.add_argument("--interval", type=float, default=300, help="Seconds between runs")
+    parser.add_argument("--once", action="store_true", help="Run once, even if a run was just stored, and exit")
+    parser.add_argument("--periods", type=int, default=FORECAST_SCHEDULE_PERIODS)
+    parser.add_argument("--freq", default="min", choices=list(serve_prophet.FREQ_MAP))
+    parser.add_argument("--mode", default="exact", choices=serve_prophet.INFERENCE_MODES)
+    args = parser.parse_args()
+
+    engine = create_engine(args.db or cfg.get_db_url())
+    serve_prophet.load_model()
+
+    def predict(model, start):
+        return serve_prophet.forecast(model, args.freq, args.periods, args.mode, start=start)
+
+    def make_models():
+        serve_prophet.load_model()
+        return registry_models(serve_prophet.registry, serve_prophet.app.state.served)
+
+    stop = threading.Event()
+    if args.once:
+        stop.set()
+        args.interval = 0
+    try:
+        run_forever(engine, make_models, predict, args.interval, stop, freq=serve_prophet.FREQ_MAP[args.freq],
+                    periods=args.periods)
+    except KeyboardInterrupt:
+        pass
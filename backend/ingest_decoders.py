@@ -0,0 +1,237 @@
+"""
+Pluggable payload decoders for the MQTT ingestor.
+
+Every decoder takes `(topic, payload_bytes)` and returns a
+`(ds, device_id, value)` row with `ds` as a naive UTC datetime, or raises
+`DecodeError`. Available formats:
+
+- `json`    - `{"device_id"|"id": ..., "ts": ..., "value"|"y": ...}`; uses orjson (stdlib json if it is missing)
+- `binary`  - fixed 18-byte header, see `BINARY_HEADER` below
+- `msgpack` - same fields as JSON, needs the `msgpack` package
+
+`ts` may be an ISO-8601 string or an epoch integer/float in seconds,
+milliseconds or microseconds. A missing device id falls back to the topic and
+a missing timestamp to the receive time. Device ids must be 1 to
+`MAX_DEVICE_ID_BYTES` bytes of UTF-8 without NUL, and values finite numbers
+(JSON booleans are not numbers here).
+
+`DecoderRouter` picks a decoder per topic from `PATTERN=FORMAT` rules using
+MQTT wildcards, e.g. `energia/sensors/bin/#=binary`.
+"""
+
+import math
+import struct
+from datetime import datetime, timezone
+
+try:
+    import orjson as _json
+
+    _loads = _json.loads
+except ImportError:  # pragma: no cover - orjson is in requirements.txt
+    import json as _json
+
+    _loads = _json.loads
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - msgpack is in requirements.txt
+    msgpack = None
+
+# Binary layout (little endian):
+#   offset 0   uint8    format version (1)
+#   offset 1   int64    timestamp, epoch milliseconds (0 = use receive time)
+#   offset 9   float64  value
+#   offset 17  uint8    device id length N (0 = use topic)
+#   offset 18  N bytes  device id, UTF-8
+BINARY_HEADER = struct.Struct("<BqdB")
+BINARY_VERSION = 1
+MAX_DEVICE_ID_BYTES = 255
+
+_EPOCH = datetime(1970, 1, 1)
+
+# What `str.decode` and `utcfromtimestamp` raise for bytes or timestamps out of range.
+_CONVERSION_ERRORS = (UnicodeDecodeError, ValueError, OverflowError, OSError)
+
+
+class DecodeError(ValueError):
+    """Raised when a payload cannot be turned into a sensor row."""
+
+
+def parse_timestamp(ts):
+    """Normalize an ISO string or epoch number to a naive UTC datetime."""
+    if ts is None or ts == "":
+        return datetime.utcnow()
+    if isinstance(ts, str):
+        if ts.isdigit():
+            ts = int(ts)
+        else:
+            # Fast path for the common UTC "Z" suffix: parse as naive, skip tz conversion.
+            if ts[-1] in "Zz":
+                ts = ts[:-1]
+            try:
+                parsed = datetime.fromisoformat(ts)
+            except ValueError as exc:
+                raise DecodeError(f"Invalid timestamp {ts!r}") from exc
+            if parsed.tzinfo is not None:
+                parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+            return parsed
+    if isinstance(ts, (int, float)) and not isinstance(ts, bool):
+        # Infer the unit from the magnitude: seconds, milliseconds or microseconds.
+        magnitude = abs(ts)
+        if magnitude >= 1e14:
+            ts = ts / 1e6
+        elif magnitude >= 1e11:
+            ts = ts / 1e3
+        try:
+            return datetime.utcfromtimestamp(ts)
+        except _CONVERSION_ERRORS as exc:
+            raise DecodeError(f"Timestamp {ts!r} out of range") from exc
+    raise DecodeError(f"Unsupported timestamp type {type(ts).__name__}")
+
+
+def check_device_id(device_id):
+    """Return `device_id` if Postgres can store it as a `devices.name`, else raise `DecodeError`."""
+    if "\x00" in device_id:
+        raise DecodeError(f"Device id {device_id!r} contains NUL")
+    try:
+        size = len(device_id.encode())
+    except UnicodeEncodeError as exc:  # lone surrogates from "\ud800"-style JSON escapes
+        raise DecodeError(f"Device id {device_id!r} is not valid Unicode") from exc
+    if not 0 < size <= MAX_DEVICE_ID_BYTES:
+        raise DecodeError(f"Device id is {size} bytes; expected 1 to {MAX_DEVICE_ID_BYTES}")
+    return device_id
+
+
+def check_value(value):
+    """Return `value` if it is finite, else raise `DecodeError`."""
+    if not math.isfinite(value):
+        raise DecodeError(f"Value {value!r} is not finite")
+    return value
+
+
+def _row_from_mapping(topic, payload):
+    if not isinstance(payload, dict):
+        raise DecodeError("Payload is not an object")
+    value = payload.get("value")
+    if value is None:
+        value = payload.get("y")
+        if value is None:
+            raise DecodeError("No value field in payload")
+    if isinstance(value, bool):
+        raise DecodeError("Value is a boolean, not a number")
+    device_id = payload.get("device_id") or payload.get("id") or topic
+    try:
+        row = (parse_timestamp(payload.get("ts")), str(device_id), float(value))
+    except (TypeError, *_CONVERSION_ERRORS) as exc:
+        raise DecodeError(str(exc)) from exc
+    check_device_id(row[1])
+    check_value(row[2])
+    return row
+
+
+def decode_json(topic, payload):
+    try:
+        data = _loads(payload)
+    except ValueError as exc:
+        raise DecodeError(f"Invalid JSON payload: {exc}") from exc
+    return _row_from_mapping(topic, data)
+
+
+def decode_binary(topic, payload):
+    if len(payload) < BINARY_HEADER.size:
+        raise DecodeError(f"Binary payload too short ({len(payload)} bytes)")
+    version, ts_ms, value, size = BINARY_HEADER.unpack_from(payload)
+    if version != BINARY_VERSION:
+        raise DecodeError(f"Unsupported binary payload version {version}")
+    if size:
+        end = BINARY_HEADER.size + size
+        if len(payload) < end:
+            raise DecodeError("Binary payload truncated in device id")
+        try:
+            device_id = payload[BINARY_HEADER.size:end].decode()
+        except UnicodeDecodeError as exc:
+            raise DecodeError(f"Binary device id is not UTF-8: {exc}") from exc
+    else:
+        device_id = topic
+    check_device_id(device_id)
+    check_value(value)
+    try:
+        ds = datetime.utcfromtimestamp(ts_ms / 1000) if ts_ms else datetime.utcnow()
+    except _CONVERSION_ERRORS as exc:
+        raise DecodeError(f"Binary timestamp {ts_ms} out of range") from exc
+    return (ds, device_id, value)
+
+
+def encode_binary(ds, device_id, value):
+    """Build a binary payload; mirrors what the firmware sends. Used by tools and benchmarks."""
+    name = device_id.encode() if device_id else b""
+    ts_ms = int((ds - _EPOCH).total_seconds() * 1000) if ds is not None else 0
+    return BINARY_HEADER.pack(BINARY_VERSION, ts_ms, value, len(name)) + name
+
+
+def decode_msgpack(topic, payload):
+    try:
+        data = msgpack.unpackb(payload, raw=False)
+    except Exception as exc:  # noqa: BLE001
+        raise DecodeError(f"Invalid msgpack payload: {exc}") from exc
+    return _row_from_mapping(topic, data)
+
+
+DECODERS = {"json": decode_json, "binary": decode_binary}
+if msgpack is not None:
+    DECODERS["msgpack"] = decode_msgpack
+
+
+def topic_matches(pattern, topic):
+    """MQTT subscription matching with `+` and `#` wildcards."""
+    pattern_parts = pattern.split("/")
+    topic_parts = topic.split("/")
+    for i, part in enumerate(pattern_parts):
+        if part == "#":
+            return True
+        if i >= len(topic_parts):
+            return False
+        if part != "+" and part != topic_parts[i]:
+            return False
+    return len(pattern_parts) == len(topic_parts)
+
+
+def parse_rules(specs):
+    """Parse `PATTERN=FORMAT` strings (comma separated or repeated) into rule tuples."""
+    rules = []
+    for spec in specs:
+        for item in spec.split(","):
+            item = item.strip()
+            if not item:
+                continue
+            pattern, sep, name = item.rpartition("=")
+            if not sep or not pattern:
+                raise ValueError(f"Decoder rule {item!r} must look like PATTERN=FORMAT")
+            if name not in DECODERS:
+                raise ValueError(f"Unknown decoder {name!r}; available: {', '.join(sorted(DECODERS))}")
+            rules.append((pattern, name))
+    return rules
+
+
+class DecoderRouter:
+    """Selects a decoder per topic; the first matching rule wins, else `default`."""
+
+    def __init__(self, rules=(), default="json"):
+        self.rules = [(pattern, DECODERS[name]) for pattern, name in rules]
+        self.default = DECODERS[default]
+        self._by_topic = {}
+
+    def decoder_for(self, topic):
+        decoder = self._by_topic.get(topic)
+        if decoder is None:
+            decoder = next((d for pattern, d in self.rules if topic_matches(pattern, topic)), self.default)
+            self._by_topic[topic] = decoder
+        return decoder
+
+    def decode(self, topic, payload):
+        """Decode a message, returning None (and logging) when it is invalid."""
+        try:
+            return self.decoder_for(topic)(topic, payload)
+        except DecodeError as exc:
+            print(f"Invalid payload on {topic}: {exc}")
+            return None
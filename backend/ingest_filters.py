@@ -0,0 +1,104 @@
+"""
+Pre-write filters for decoded readings.
+
+`RecentKeys` remembers the last `size` timestamps seen per device, so QoS 1
+redeliveries and firmware retransmits after a reconnect are dropped before
+they cost a database round-trip. It is only a shortcut: the unique
+`(device_id, ds)` key on `sensor_data` is what guarantees idempotency, and
+duplicates that slip past the filter (evicted keys, another worker process
+in supervisor mode, a restart) are discarded by `ON CONFLICT DO NOTHING`.
+
+Keys are recorded when a reading is accepted, before it is written; the
+pipeline calls `ReadingFilter.forget()` for a batch that failed and was not
+spooled, so its redeliveries get through.
+
+`ReadingFilter` also applies the late-reading policy. A reading is *late*
+when its timestamp is more than `max_lateness` seconds behind the wall clock;
+`late_policy` decides whether it is written anyway (`accept`) or discarded
+(`drop`). Readings that are merely out of order (older than the newest reading
+of the same device, but within `max_lateness`) are always accepted and only
+counted; rollups merge them into their own buckets.
+"""
+
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+
+LATE_POLICIES = ("accept", "drop")
+
+
+class RecentKeys:
+    """Bounded per-device set of recently seen timestamps (oldest evicted first)."""
+
+    def __init__(self, size=256):
+        self.size = size
+        self._devices = {}
+
+    def seen(self, device_id, ds):
+        """Record `(device_id, ds)`; return True if it was already present."""
+        entry = self._devices.get(device_id)
+        if entry is None:
+            entry = self._devices[device_id] = (set(), deque())
+        keys, order = entry
+        if ds in keys:
+            return True
+        keys.add(ds)
+        order.append(ds)
+        if len(order) > self.size:
+            keys.discard(order.popleft())
+        return False
+
+    def forget(self, device_id, ds):
+        """Drop `(device_id, ds)` so a redelivery of it is accepted again."""
+        entry = self._devices.get(device_id)
+        if entry is not None and ds in entry[0]:
+            entry[0].discard(ds)
+            entry[1].remove(ds)
+
+
+class ReadingFilter:
+    """Thread-safe duplicate/late filter shared by all writer threads of a pipeline."""
+
+    def __init__(self, recent_keys=256, max_lateness=0, late_policy="accept"):
+        if late_policy not in LATE_POLICIES:
+            raise ValueError(f"Unknown late policy {late_policy!r}; expected one of {', '.join(LATE_POLICIES)}")
+        self.keys = RecentKeys(recent_keys) if recent_keys > 0 else None
+        self.max_lateness = timedelta(seconds=max_lateness) if max_lateness > 0 else None
+        self.late_policy = late_policy
+        self._newest = {}
+        self._lock = threading.Lock()
+        self.duplicates = 0
+        self.late = 0
+        self.out_of_order = 0
+
+    def accept(self, row, now=None):
+        """Return True if `row` (`(ds, device_id, value)`) should be written."""
+        ds, device_id, _ = row
+        with self._lock:
+            if self.max_lateness is not None:
+                now = now or datetime.utcnow()
+                if now - ds > self.max_lateness:
+                    self.late += 1
+                    if self.late_policy == "drop":
+                        return False
+            if self.keys is not None and self.keys.seen(device_id, ds):
+                self.duplicates += 1
+                return False
+            newest = self._newest.get(device_id)
+            if newest is not None and ds < newest:
+                self.out_of_order += 1
+            else:
+                self._newest[device_id] = ds
+        return True
+
+    def forget(self, rows):
+        """Forget the keys of accepted rows whose write failed, so redeliveries are not dropped as duplicates."""
+        if self.keys is None:
+            return
+        with self._lock:
+            for ds, device_id, _ in rows:
+                self.keys.forget(device_id, ds)
+
+    def snapshot(self):
+        with self._lock:
+            return {"duplicates_filtered": self.duplicates, "late": self.late, "out_of_order": self.out_of_order}
@@ -0,0 +1,235 @@
+"""
+Ingest pipeline stage between the MQTT network thread and the database.
+
+The paho callback only calls `IngestPipeline.submit()`, which puts the raw
+message on a bounded queue. A pool of writer threads drains the queue, decodes
+payloads and writes them through `BatchWriter`s, so a slow commit never stalls
+keepalives or QoS acks on the network loop. There is one writer per thread and
+every device is sharded to a fixed writer, so one device's batches are
+committed (and reported) in the order they were cut.
+
+Backpressure policies when the queue is full:
+- `block`       - the network thread waits for space (broker flow control)
+- `drop-oldest` - discard the oldest queued message to make room
+- `spill`       - decode the message and append it to the on-disk spool instead
+
+When a `Spool` is attached, writers also fall back to it whenever the
+database is unreachable; rows the database refuses are counted as `rejected`
+instead of blocking the rest (see `ingest_writer.py` and `ingest_spool.py`).
+An optional `ReadingFilter` drops recently seen
+`(device, ds)` keys and late readings before they reach a writer; see
+`ingest_filters.py`. An optional `AnomalyDetector` checks every reading a
+writer committed (never duplicates or failed batches) against its forecast
+band; see `anomaly_detector.py`.
+"""
+
+import queue
+import threading
+import time
+
+from .ingest_writer import BatchWriter
+
+POLICIES = ("block", "drop-oldest", "spill")
+
+_STOP = object()
+
+
+class IngestStats:
+    """Thread-safe counters for the pipeline."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.enqueued = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.invalid = 0
+        self.rejected = 0
+        self.written = 0
+        self.duplicates = 0
+        self.batches = 0
+        self.lag_last = 0.0
+        self.lag_max = 0.0
+        self._lag_total = 0.0
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def record_flush(self, rows, lag, duplicates=0):
+        with self._lock:
+            self.written += rows - duplicates
+            self.duplicates += duplicates
+            self.batches += 1
+            self.lag_last = lag
+            self.lag_max = max(self.lag_max, lag)
+            self._lag_total += lag
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "enqueued": self.enqueued,
+                "dropped": self.dropped,
+                "spilled": self.spilled,
+                "invalid": self.invalid,
+                "rejected": self.rejected,
+                "written": self.written,
+                "duplicates": self.duplicates,
+                "batches": self.batches,
+                "lag_last_ms": round(self.lag_last * 1000, 1),
+                "lag_max_ms": round(self.lag_max * 1000, 1),
+                "lag_avg_ms": round(self._lag_total / self.batches * 1000, 1) if self.batches else 0.0,
+            }
+
+
+class IngestPipeline:
+    """Bounded queue plus a pool of writer threads.
+
+    `decode(topic, payload)` turns a raw message into a `(ds, device_id, value)`
+    row, or returns None for payloads that should be skipped.
+    """
+
+    def __init__(
+        self,
+        engine,
+        decode,
+        workers=2,
+        queue_size=10000,
+        policy="block",
+        spool=None,
+        batch_size=500,
+        flush_ms=1000,
+        reading_filter=None,
+        anomaly_detector=None,
+    ):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown backpressure policy {policy!r}; expected one of {', '.join(POLICIES)}")
+        if policy == "spill" and spool is None:
+            raise ValueError("Backpressure policy 'spill' requires a spool")
+
+        self.engine = engine
+        self.decode = decode
+        self.workers = max(1, workers)
+        self.policy = policy
+        self.spool = spool
+        self.batch_size = batch_size
+        self.flush_ms = flush_ms
+        self.reading_filter = reading_filter
+        self.anomaly_detector = anomaly_detector
+        self.stats = IngestStats()
+
+        self._queue = queue.Queue(maxsize=max(1, queue_size))
+        self._writers = []
+        self._threads = []
+        self._reporter = None
+        self._stop = threading.Event()
+
+    def submit(self, topic, payload):
+        """Enqueue a raw message. Called from the MQTT network thread."""
+        item = (time.monotonic(), topic, payload)
+        if self.policy == "block":
+            self._queue.put(item)
+        elif self.policy == "drop-oldest":
+            while True:
+                try:
+                    self._queue.put_nowait(item)
+                    break
+                except queue.Full:
+                    try:
+                        self._queue.get_nowait()
+                        self.stats.incr("dropped")
+                    except queue.Empty:
+                        pass
+        else:
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                row = self.decode(topic, payload)
+                if row is None:
+                    self.stats.incr("invalid")
+                elif self._accept(row):
+                    self.spool.append([row])
+                    self.stats.incr("spilled")
+                return
+        self.stats.incr("enqueued")
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def snapshot(self):
+        snap = self.stats.snapshot()
+        snap["queue_depth"] = self.depth()
+        if self.reading_filter is not None:
+            snap.update(self.reading_filter.snapshot())
+        if self.anomaly_detector is not None:
+            snap.update(self.anomaly_detector.snapshot())
+        if self.spool is not None:
+            snap.update(self.spool.snapshot())
+        return snap
+
+    def start(self, stats_interval=0):
+        self._writers = [
+            BatchWriter(
+                self.engine, self.batch_size, self.flush_ms, on_flush=self._on_flush, spool=self.spool,
+                on_drop=self.reading_filter.forget if self.reading_filter is not None else None,
+                on_insert=self.anomaly_detector.observe_many if self.anomaly_detector is not None else None,
+                on_reject=self._on_reject,
+            )
+            for _ in range(self.workers)
+        ]
+        for i, writer in enumerate(self._writers):
+            t = threading.Thread(target=self._work, args=(writer,), name=f"ingest-writer-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        if stats_interval > 0:
+            self._reporter = threading.Thread(
+                target=self._report, args=(stats_interval,), name="ingest-stats", daemon=True
+            )
+            self._reporter.start()
+
+    def close(self):
+        """Drain the queue, flush every writer and stop the pool."""
+        for _ in self._threads:
+            self._queue.put(_STOP)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+        # Threads add to each other's writers, so flush only once all of them stopped.
+        for writer in self._writers:
+            writer.flush()
+        self._stop.set()
+
+    def _accept(self, row):
+        return self.reading_filter is None or self.reading_filter.accept(row)
+
+    def _on_flush(self, rows, seconds, oldest, duplicates=0):
+        lag = time.monotonic() - oldest if oldest is not None else seconds
+        self.stats.record_flush(rows, lag, duplicates)
+
+    def _writer_for(self, device):
+        return self._writers[hash(device) % len(self._writers)]
+
+    def _on_reject(self, rows):
+        self.stats.incr("rejected", len(rows))
+
+    def _work(self, writer):
+        """Decode messages into their device's writer; flush `writer`, the one this thread owns, when due."""
+        timeout = self.flush_ms / 1000.0
+        while True:
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                writer.flush_if_due()
+                continue
+            if item is _STOP:
+                break
+            received, topic, payload = item
+            row = self.decode(topic, payload)
+            if row is None:
+                self.stats.incr("invalid")
+            elif self._accept(row):
+                self._writer_for(row[1]).add(row, received)
+            writer.flush_if_due()
+
+    def _report(self, interval):
+        while not self._stop.wait(interval):
+            print("Ingest stats", self.snapshot())
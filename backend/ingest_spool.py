@@ -0,0 +1,318 @@
+"""
+Durable on-disk spool for sensor rows the database could not take.
+
+The spool is an append-only log split into numbered segment files
+(`000000000001.seg`, ...). Each `append(rows)` writes one CRC-checked record;
+fsyncs are batched (every `fsync_every` records or `fsync_ms` milliseconds).
+Segments rotate at `segment_bytes`, and when the spool grows past `max_bytes`
+the oldest segments are discarded so disk usage stays bounded.
+
+`SpoolReplayer` drains the spool in bulk once the database is reachable and
+persists a checkpoint (`checkpoint.json`) after every committed batch, so a
+restarted ingestor resumes replay where it stopped. Replay is strictly in
+append order, which keeps readings ordered per device. A batch Postgres
+refuses for anything but a lost connection is split until the offending rows
+are isolated; those go to `deadletter.jsonl` and replay moves on.
+"""
+
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+
+from .ingest_writer import write_isolating
+
+_HEADER = struct.Struct("<II")  # body length, crc32
+_COUNT = struct.Struct("<I")
+_ROW = struct.Struct("<ddH")  # epoch seconds, value, device id length
+_EPOCH = datetime(1970, 1, 1)
+
+
+def _encode(rows):
+    parts = [_COUNT.pack(len(rows))]
+    for ds, device_id, value in rows:
+        if ds.tzinfo is not None:
+            ds = ds.astimezone(timezone.utc).replace(tzinfo=None)
+        name = str(device_id).encode()
+        parts.append(_ROW.pack((ds - _EPOCH).total_seconds(), value, len(name)))
+        parts.append(name)
+    return b"".join(parts)
+
+
+def _decode(body):
+    (count,) = _COUNT.unpack_from(body, 0)
+    offset = _COUNT.size
+    rows = []
+    for _ in range(count):
+        ts, value, size = _ROW.unpack_from(body, offset)
+        offset += _ROW.size
+        device_id = body[offset:offset + size].decode()
+        offset += size
+        rows.append((datetime.utcfromtimestamp(ts), device_id, value))
+    return rows
+
+
+class Spool:
+    """Segment-rotated append-only spool with a persisted read checkpoint."""
+
+    def __init__(
+        self,
+        directory,
+        segment_bytes=16 * 1024 * 1024,
+        max_bytes=1024 * 1024 * 1024,
+        fsync_every=64,
+        fsync_ms=1000,
+    ):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync_every = fsync_every
+        self.fsync_ms = fsync_ms
+
+        self.appended_rows = 0
+        self.replayed_rows = 0
+        self.discarded_bytes = 0
+        self.dead_letter_rows = 0
+
+        self._lock = threading.Lock()
+        self._checkpoint_path = os.path.join(directory, "checkpoint.json")
+        self.dead_letter_path = os.path.join(directory, "deadletter.jsonl")
+        os.makedirs(directory, exist_ok=True)
+
+        segments = self._segments()
+        self._committed = self._load_checkpoint(segments)
+        self._read = self._committed
+        # Always start a fresh segment so a torn tail from a crash is never appended to.
+        self._write_seq = (segments[-1] if segments else 0) + 1
+        self._fh = open(self._segment_path(self._write_seq), "ab")
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        if self._unread_bytes(segments) == 0:
+            # Everything was replayed: start reading at the new segment so nothing looks pending.
+            self.commit((self._write_seq, 0))
+            self._read = self._committed
+
+    def _segment_path(self, seq):
+        return os.path.join(self.directory, f"{seq:012d}.seg")
+
+    def _segments(self):
+        return sorted(int(name[:-4]) for name in os.listdir(self.directory) if name.endswith(".seg"))
+
+    def _load_checkpoint(self, segments):
+        first = segments[0] if segments else 1
+        try:
+            with open(self._checkpoint_path) as fh:
+                data = json.load(fh)
+            position = (int(data["segment"]), int(data["offset"]))
+        except (OSError, ValueError, KeyError):
+            return (first, 0)
+        return max(position, (first, 0))
+
+    def _unread_bytes(self, segments):
+        seq, offset = self._committed
+        total = -offset
+        for s in segments:
+            if s >= seq:
+                total += os.path.getsize(self._segment_path(s))
+        return max(total, 0)
+
+    def _write_position(self):
+        return (self._write_seq, self._fh.tell())
+
+    def pending(self):
+        """True while there are appended rows that have not been replayed and committed."""
+        with self._lock:
+            return self._committed < self._write_position()
+
+    def pending_bytes(self):
+        with self._lock:
+            return self._unread_bytes(self._segments())
+
+    def append(self, rows):
+        if not rows:
+            return
+        body = _encode(rows)
+        with self._lock:
+            self._fh.write(_HEADER.pack(len(body), zlib.crc32(body)))
+            self._fh.write(body)
+            self._fh.flush()
+            self.appended_rows += len(rows)
+            self._unsynced += 1
+            if (
+                self._unsynced >= self.fsync_every
+                or (time.monotonic() - self._last_sync) * 1000 >= self.fsync_ms
+            ):
+                self._sync()
+            if self._fh.tell() >= self.segment_bytes:
+                self._rotate()
+
+    def _sync(self):
+        os.fsync(self._fh.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def _rotate(self):
+        self._sync()
+        self._fh.close()
+        self._write_seq += 1
+        self._fh = open(self._segment_path(self._write_seq), "ab")
+        self._enforce_limit()
+
+    def _enforce_limit(self):
+        segments = self._segments()
+        sizes = {s: os.path.getsize(self._segment_path(s)) for s in segments}
+        total = sum(sizes.values())
+        for seq in segments:
+            if total <= self.max_bytes or seq >= self._write_seq:
+                break
+            os.remove(self._segment_path(seq))
+            total -= sizes[seq]
+            self.discarded_bytes += sizes[seq]
+            print(f"Spool over {self.max_bytes} bytes; discarded segment {seq} ({sizes[seq]} bytes)")
+            if self._committed[0] <= seq:
+                self._committed = (seq + 1, 0)
+                self._save_checkpoint()
+            if self._read[0] <= seq:
+                self._read = self._committed
+
+    def read(self, max_rows):
+        """Return `(rows, position)` for the next unread records, up to about `max_rows`."""
+        rows = []
+        with self._lock:
+            self._fh.flush()
+            seq, offset = self._read
+            write_seq, write_offset = self._write_position()
+            while len(rows) < max_rows and (seq, offset) < (write_seq, write_offset):
+                path = self._segment_path(seq)
+                if not os.path.exists(path):
+                    seq, offset = seq + 1, 0
+                    continue
+                with open(path, "rb") as fh:
+                    fh.seek(offset)
+                    while len(rows) < max_rows:
+                        header = fh.read(_HEADER.size)
+                        if len(header) < _HEADER.size:
+                            break
+                        size, crc = _HEADER.unpack(header)
+                        body = fh.read(size)
+                        if len(body) < size or zlib.crc32(body) != crc:
+                            # Torn write from a crash: the rest of this segment is unusable.
+                            print(f"Spool segment {seq} is corrupt at offset {offset}; skipping remainder")
+                            offset = os.path.getsize(path)
+                            break
+                        rows.extend(_decode(body))
+                        offset = fh.tell()
+                if len(rows) >= max_rows or seq == write_seq:
+                    break
+                seq, offset = seq + 1, 0
+            self._read = (seq, offset)
+            return rows, self._read
+
+    def rewind(self):
+        """Forget uncommitted reads so they are returned again."""
+        with self._lock:
+            self._read = self._committed
+
+    def commit(self, position, rows=0):
+        """Persist `position` as replayed and delete fully consumed segments."""
+        with self._lock:
+            self._committed = position
+            self.replayed_rows += rows
+            self._save_checkpoint()
+            for seq in self._segments():
+                if seq >= position[0] or seq >= self._write_seq:
+                    break
+                os.remove(self._segment_path(seq))
+
+    def dead_letter(self, rows):
+        """Append rows the database refused to `deadletter.jsonl`, one JSON object per row."""
+        with self._lock:
+            with open(self.dead_letter_path, "a") as fh:
+                for ds, device_id, value in rows:
+                    fh.write(json.dumps({"ds": ds.isoformat(), "device_id": device_id, "value": value}) + "\n")
+                fh.flush()
+                os.fsync(fh.fileno())
+            self.dead_letter_rows += len(rows)
+
+    def _save_checkpoint(self):
+        tmp = self._checkpoint_path + ".tmp"
+        with open(tmp, "w") as fh:
+            json.dump({"segment": self._committed[0], "offset": self._committed[1]}, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp, self._checkpoint_path)
+
+    def snapshot(self):
+        return {
+            "spool_appended": self.appended_rows,
+            "spool_replayed": self.replayed_rows,
+            "spool_pending_bytes": self.pending_bytes(),
+            "spool_discarded_bytes": self.discarded_bytes,
+            "spool_dead_letter": self.dead_letter_rows,
+        }
+
+    def close(self):
+        with self._lock:
+            self._sync()
+            self._fh.close()
+
+
+class SpoolReplayer:
+    """Background thread that drains a `Spool` into the database in bulk."""
+
+    def __init__(self, engine, spool, batch_rows=5000, idle_ms=500, max_backoff=30.0):
+        self.engine = engine
+        self.spool = spool
+        self.batch_rows = batch_rows
+        self.idle_ms = idle_ms
+        self.max_backoff = max_backoff
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="spool-replayer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def replay_once(self):
+        """Replay one batch. Returns the number of rows committed."""
+        rows, position = self.spool.read(self.batch_rows)
+        if not rows:
+            # Nothing decodable (e.g. a skipped torn record); still move the checkpoint.
+            self.spool.commit(position)
+            return 0
+        try:
+            _, rejected = write_isolating(self.engine, rows)
+        except Exception:
+            self.spool.rewind()
+            raise
+        if rejected:
+            self.spool.dead_letter(rejected)
+            print(f"Moved {len(rejected)} spooled rows the database refused to {self.spool.dead_letter_path}")
+        self.spool.commit(position, len(rows) - len(rejected))
+        return len(rows) - len(rejected)
+
+    def _run(self):
+        backoff = 1.0
+        while not self._stop.is_set():
+            if not self.spool.pending():
+                self._stop.wait(self.idle_ms / 1000.0)
+                continue
+            try:
+                count = self.replay_once()
+            except Exception as exc:  # noqa: BLE001
+                print(f"Spool replay failed, retrying in {backoff:.0f}s: {exc}")
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+            backoff = 1.0
+            if count:
+                print(f"Replayed {count} spooled rows")
@@ -0,0 +1,225 @@
+"""
+Supervisor mode for the MQTT ingestor: N worker processes, one per core.
+
+Each worker is a full `mqtt_ingest.run()` subscribed to
+`$share/<group>/<topic>`, so the broker (Mosquitto 2 supports shared
+subscriptions on MQTT 3.1.1 and 5) hands every message to exactly one worker
+of the group. Shared subscriptions distribute per message, not per device, so
+two readings from one device may be committed by different workers.
+
+Workers send a heartbeat with their pipeline counters over a
+multiprocessing queue. The supervisor restarts workers that exit or stop
+heartbeating (with exponential backoff), prints an aggregate health line and,
+with `--health-file`, writes per-worker health as JSON.
+
+With `--anomalies` the workers forward their committed rows over another
+queue to the one `AnomalyDetector` run by the supervisor, so readings of a
+device split across workers still share one detector state.
+"""
+
+import copy
+import json
+import multiprocessing as mp
+import os
+import queue
+import signal
+import time
+
+HEARTBEAT_INTERVAL = 5.0
+HEALTH_TIMEOUT = 30.0
+MAX_BACKOFF = 60.0
+
+
+def _worker_main(index, args, heartbeats, anomaly_rows=None):
+    from . import mqtt_ingest
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the supervisor owns Ctrl-C
+
+    def heartbeat(status):
+        status.update({"worker": index, "pid": os.getpid(), "ts": time.time()})
+        heartbeats.put(status)
+
+    mqtt_ingest.run(args, heartbeat=heartbeat, heartbeat_interval=HEARTBEAT_INTERVAL, anomaly_rows=anomaly_rows)
+
+
+class _Worker:
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.started_at = 0.0
+        self.last_heartbeat = None
+        self.status = {}
+        self.restarts = 0
+        self.backoff = 1.0
+        self.restart_at = 0.0
+
+
+class Supervisor:
+    """Launches, monitors and restarts ingest worker processes."""
+
+    def __init__(self, args, health_timeout=HEALTH_TIMEOUT, report_interval=None):
+        self.args = args
+        self.health_timeout = health_timeout
+        self.report_interval = report_interval or args.stats_interval or 30.0
+        self._ctx = mp.get_context("spawn")
+        self._heartbeats = self._ctx.Queue()
+        self._anomaly_rows = self._ctx.Queue() if args.anomalies else None
+        self._detector = None
+        self._workers = [_Worker(i) for i in range(args.processes)]
+        self._stopping = False
+
+    def worker_args(self, index):
+        """Per-worker copy of the CLI args: shared topic and a private spool directory.
+
+        Only worker 0 runs partition maintenance so workers do not race on DDL.
+        """
+        wargs = copy.copy(self.args)
+        wargs.processes = 1
+        if index > 0:
+            wargs.maintenance_interval = 0
+        topic = self.args.topic
+        if not topic.startswith("$share/"):
+            topic = f"$share/{self.args.share_group}/{topic}"
+        wargs.topic = topic
+        wargs.spool_dir = os.path.join(self.args.spool_dir, f"worker-{index}")
+        return wargs
+
+    def _start(self, worker):
+        worker.process = self._ctx.Process(
+            target=_worker_main,
+            args=(worker.index, self.worker_args(worker.index), self._heartbeats, self._anomaly_rows),
+            name=f"ingest-worker-{worker.index}",
+        )
+        worker.process.start()
+        worker.started_at = time.monotonic()
+        worker.last_heartbeat = None
+        print(f"Started ingest worker {worker.index} (pid {worker.process.pid})")
+
+    def _drain_heartbeats(self):
+        while True:
+            try:
+                status = self._heartbeats.get_nowait()
+            except queue.Empty:
+                return
+            worker = self._workers[status["worker"]]
+            if worker.process is not None and status["pid"] == worker.process.pid:
+                worker.last_heartbeat = time.monotonic()
+                worker.status = status
+                worker.backoff = 1.0
+
+    def _drain_anomaly_rows(self):
+        while True:
+            try:
+                rows = self._anomaly_rows.get_nowait()
+            except queue.Empty:
+                return
+            self._detector.observe_many(rows)
+
+    def _start_detector(self):
+        from sqlalchemy import create_engine
+
+        from .anomaly_detector import AnomalyDetector
+
+        args = self.args
+        self._detector = AnomalyDetector(create_engine(args.db), args.anomaly_margin, args.anomaly_debounce,
+                                         args.anomaly_refresh, reorder_s=args.anomaly_reorder)
+        self._detector.start()
+
+    def _check(self, worker):
+        if self._stopping:
+            return
+        now = time.monotonic()
+        proc = worker.process
+        if proc is None:
+            if now >= worker.restart_at:
+                worker.restarts += 1
+                self._start(worker)
+            return
+
+        seen = worker.last_heartbeat or worker.started_at
+        if proc.is_alive() and now - seen > self.health_timeout:
+            print(f"Ingest worker {worker.index} missed heartbeats for {now - seen:.0f}s; killing it")
+            proc.kill()
+            proc.join(5)
+
+        if not proc.is_alive():
+            print(f"Ingest worker {worker.index} exited with code {proc.exitcode}; restarting in {worker.backoff:.0f}s")
+            worker.process = None
+            worker.restart_at = now + worker.backoff
+            worker.backoff = min(worker.backoff * 2, MAX_BACKOFF)
+
+    def health(self):
+        now = time.monotonic()
+        workers = []
+        for w in self._workers:
+            alive = w.process is not None and w.process.is_alive()
+            workers.append({
+                "worker": w.index,
+                "pid": w.process.pid if w.process is not None else None,
+                "alive": alive,
+                "connected": alive and w.status.get("connected", False),
+                "restarts": w.restarts,
+                "heartbeat_age_s": round(now - w.last_heartbeat, 1) if w.last_heartbeat else None,
+                "stats": w.status.get("stats", {}),
+            })
+        healthy = sum(1 for w in workers if w["alive"] and w["connected"])
+        health = {"updated": time.time(), "healthy": healthy, "workers": workers}
+        if self._detector is not None:
+            health["anomalies"] = self._detector.snapshot()
+        return health
+
+    def _report(self):
+        health = self.health()
+        written = sum(w["stats"].get("written", 0) for w in health["workers"])
+        depth = sum(w["stats"].get("queue_depth", 0) for w in health["workers"])
+        print(f"Supervisor: {health['healthy']}/{len(self._workers)} workers healthy, {written} rows written, queue depth {depth}")
+        if self.args.health_file:
+            tmp = self.args.health_file + ".tmp"
+            with open(tmp, "w") as fh:
+                json.dump(health, fh, indent=2)
+            os.replace(tmp, self.args.health_file)
+
+    def _request_stop(self, *_):
+        self._stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._request_stop)
+        signal.signal(signal.SIGINT, self._request_stop)
+        print(f"Supervising {len(self._workers)} ingest workers on group {self.args.share_group!r}")
+        if self._anomaly_rows is not None:
+            self._start_detector()
+        for worker in self._workers:
+            self._start(worker)
+
+        next_report = time.monotonic() + self.report_interval
+        while not self._stopping:
+            time.sleep(0.5)
+            self._drain_heartbeats()
+            if self._detector is not None:
+                self._drain_anomaly_rows()
+            for worker in self._workers:
+                self._check(worker)
+            if time.monotonic() >= next_report:
+                self._report()
+                next_report = time.monotonic() + self.report_interval
+        self.shutdown()
+
+    def shutdown(self, timeout=30.0):
+        """SIGTERM every worker so it drains its pipeline, then wait for it."""
+        for worker in self._workers:
+            if worker.process is not None and worker.process.is_alive():
+                worker.process.terminate()
+        deadline = time.monotonic() + timeout
+        for worker in self._workers:
+            if worker.process is not None:
+                # A worker cannot exit while its forwarded rows are stuck in a full queue pipe.
+                while worker.process.is_alive() and time.monotonic() < deadline:
+                    if self._detector is not None:
+                        self._drain_anomaly_rows()
+                    worker.process.join(min(0.5, max(0.0, deadline - time.monotonic())))
+                if worker.process.is_alive():
+                    worker.process.kill()
+        if self._detector is not None:
+            self._drain_anomaly_rows()
+            self._detector.close()
+        self._report()
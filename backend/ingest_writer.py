@@ -0,0 +1,218 @@
+"""
+Buffered bulk writer for sensor readings.
+
+Rows are collected in memory and written to `sensor_data` in bulk: Postgres
+`COPY ... FROM STDIN` into a per-connection temporary staging table when the
+driver supports it (psycopg2), then one `INSERT ... SELECT ... ON CONFLICT
+(device_id, ds) DO NOTHING`, so redelivered readings are ignored. Without
+COPY the rows go through a single array-parameter INSERT with the same
+conflict handling. A flush is triggered when the buffer
+reaches `batch_size` rows or when the oldest buffered row has waited
+`flush_ms` milliseconds, whichever comes first.
+
+With a `spool` attached, a batch that fails to commit because the database
+is unreachable is appended to the on-disk spool instead of being lost, and
+while the spool still holds a backlog new batches go there too so replay keeps
+per-device ordering. Any other failure is blamed on the rows themselves: the
+batch is written again in halves until the rows Postgres refuses are isolated,
+and those are rejected (to the spool's dead-letter file, when there is one)
+while the rest commit.
+
+Each row is a `(ds, device_name, value)` tuple; names are translated to
+`devices.id` keys through the shared `DeviceCache` just before the write.
+The same transaction merges the rows that were actually inserted (the
+`RETURNING` set, never the duplicates) into the minute/hour/day rollups.
+"""
+
+import csv
+import io
+import threading
+import time
+
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError, InterfaceError, OperationalError
+
+from .devices import device_cache
+from .rollups import upsert_rollups
+
+STAGE_DDL = text(
+    "CREATE TEMP TABLE IF NOT EXISTS sensor_data_stage "
+    "(ds timestamp, device_id integer, value double precision) ON COMMIT DELETE ROWS"
+)
+COPY_SQL = "COPY sensor_data_stage (ds, device_id, value) FROM STDIN WITH (FORMAT csv)"
+MERGE_SQL = text(
+    "INSERT INTO sensor_data (ds, device_id, value) "
+    "SELECT ds, device_id, value FROM sensor_data_stage "
+    "ON CONFLICT (device_id, ds) DO NOTHING RETURNING ds, device_id, value"
+)
+INSERT_SQL = text(
+    "INSERT INTO sensor_data (ds, device_id, value) "
+    "SELECT * FROM unnest(CAST(:ds AS timestamp[]), CAST(:device_id AS integer[]), "
+    "CAST(:value AS float8[])) "
+    "ON CONFLICT (device_id, ds) DO NOTHING RETURNING ds, device_id, value"
+)
+
+
+def write_rows(conn, rows):
+    """Write `rows` on an open SQLAlchemy connection (inside its transaction).
+
+    Returns the rows actually inserted as `(ds, device_name, value)`; the rest
+    already existed.
+    """
+    names = {name for _, name, _ in rows}
+    ids = device_cache.resolve(conn.engine, names)
+    rows = [(ds, ids[name], value) for ds, name, value in rows]
+
+    cursor = conn.connection.driver_connection.cursor()
+    try:
+        if hasattr(cursor, "copy_expert"):
+            conn.execute(STAGE_DDL)
+            buf = io.StringIO()
+            csv.writer(buf).writerows(rows)
+            buf.seek(0)
+            cursor.copy_expert(COPY_SQL, buf)
+            inserted = conn.execute(MERGE_SQL).fetchall()
+        else:
+            inserted = conn.execute(INSERT_SQL, {
+                "ds": [r[0] for r in rows],
+                "device_id": [r[1] for r in rows],
+                "value": [r[2] for r in rows],
+            }).fetchall()
+    finally:
+        cursor.close()
+
+    upsert_rollups(conn, inserted)
+    by_id = {ids[name]: name for name in names}
+    return [(ds, by_id[device_id], value) for ds, device_id, value in inserted]
+
+
+def is_disconnect(engine, exc):
+    """True when `exc` means the database could not be reached, rather than that it refused the rows."""
+    if isinstance(exc, DBAPIError):
+        return exc.connection_invalidated or isinstance(exc, (OperationalError, InterfaceError))
+    # COPY runs on the raw driver cursor, whose errors SQLAlchemy does not wrap.
+    dbapi = engine.dialect.dbapi
+    return dbapi is not None and isinstance(exc, (dbapi.OperationalError, dbapi.InterfaceError))
+
+
+def write_isolating(engine, rows):
+    """Write `rows`, splitting the batch on failure to set aside the rows that cannot be stored.
+
+    Returns `(inserted, rejected)`; every part commits in its own transaction.
+    Disconnects are raised: rows of parts that already committed are then
+    written again, which the `(device_id, ds)` key makes harmless.
+    """
+    try:
+        with engine.begin() as conn:
+            return write_rows(conn, rows), []
+    except Exception as exc:  # noqa: BLE001
+        if is_disconnect(engine, exc):
+            raise
+        if len(rows) == 1:
+            print(f"Rejected row {rows[0]!r}: {exc}")
+            return [], list(rows)
+    mid = len(rows) // 2
+    inserted, rejected = write_isolating(engine, rows[:mid])
+    more_inserted, more_rejected = write_isolating(engine, rows[mid:])
+    return inserted + more_inserted, rejected + more_rejected
+
+
+class BatchWriter:
+    """Collects rows and flushes them to Postgres in bulk.
+
+    `add()` is safe to call from any thread. When the buffer is full the
+    flush runs in the calling thread; the owner calls `flush_if_due()` to
+    enforce the `flush_ms` latency bound for slow trickles.
+
+    `on_flush(rows, seconds, oldest, duplicates)` is called after every
+    successful flush with the monotonic arrival time of the oldest row in the
+    batch and the number of rows skipped as already stored. `on_drop(rows)`
+    is called with a batch that failed to commit and had no spool to go to;
+    `on_reject(rows)` with the rows the database refused.
+    `on_insert(rows)` gets the rows a committed batch actually inserted, in
+    `ds` order, batch by batch in commit order.
+    """
+
+    def __init__(self, engine, batch_size=500, flush_ms=1000, on_flush=None, spool=None, on_drop=None,
+                 on_insert=None, on_reject=None):
+        self.engine = engine
+        self.spool = spool
+        self.batch_size = max(1, batch_size)
+        self.flush_ms = max(1, flush_ms)
+        self.on_flush = on_flush
+        self.on_drop = on_drop
+        self.on_insert = on_insert
+        self.on_reject = on_reject
+
+        self._rows = []
+        self._oldest = None
+        self._lock = threading.Lock()
+        # Serializes DB writes so batches are committed in the order they were cut.
+        self._write_lock = threading.Lock()
+
+    def add(self, row, received=None):
+        """Buffer `row`. `received` is the monotonic time the reading arrived, if known."""
+        with self._lock:
+            if not self._rows:
+                self._oldest = received if received is not None else time.monotonic()
+            self._rows.append(row)
+            full = len(self._rows) >= self.batch_size
+        if full:
+            self.flush()
+
+    def due(self):
+        """Return True when buffered rows have waited at least `flush_ms`."""
+        with self._lock:
+            oldest = self._oldest
+        return oldest is not None and (time.monotonic() - oldest) * 1000 >= self.flush_ms
+
+    def flush_if_due(self):
+        if self.due():
+            self.flush()
+
+    def flush(self):
+        """Write all buffered rows in one transaction. Returns the row count."""
+        with self._write_lock:
+            with self._lock:
+                rows, self._rows = self._rows, []
+                oldest, self._oldest = self._oldest, None
+            if not rows:
+                return 0
+
+            if self.spool is not None and self.spool.pending():
+                self.spool.append(rows)
+                return 0
+
+            started = time.perf_counter()
+            try:
+                inserted, rejected = write_isolating(self.engine, rows)
+            except Exception as exc:  # noqa: BLE001
+                if self.spool is None:
+                    print(f"Failed to write batch of {len(rows)} rows: {exc}")
+                    if self.on_drop is not None:
+                        self.on_drop(rows)
+                else:
+                    print(f"Failed to write batch of {len(rows)} rows, spooling to disk: {exc}")
+                    self.spool.append(rows)
+                return 0
+            elapsed = time.perf_counter() - started
+            if rejected:
+                if self.spool is not None:
+                    self.spool.dead_letter(rejected)
+                if self.on_reject is not None:
+                    self.on_reject(rejected)
+            # Still under the write lock, so batches reach `on_insert` in commit order.
+            if self.on_insert is not None and inserted:
+                self.on_insert(sorted(inserted, key=lambda row: row[0]))
+
+        stored = len(rows) - len(rejected)
+        rate = len(rows) / elapsed if elapsed > 0 else float("inf")
+        duplicates = stored - len(inserted)
+        print(
+            f"Flushed {len(rows)} rows in {elapsed * 1000:.1f} ms ({rate:.0f} rows/s)"
+            + (f", {duplicates} duplicates skipped" if duplicates else "")
+            + (f", {len(rejected)} rejected" if rejected else "")
+        )
+        if self.on_flush is not None:
+            self.on_flush(stored, elapsed, oldest, duplicates)
+        return stored
@@ -0,0 +1,129 @@
+"""
+Migrate `sensor_data` to the layout defined in `sensor_schema.py`.
+
+Older deployments have a plain heap `sensor_data` and may store free-form
+device names in `sensor_data.device_id`. This script registers every distinct
+name in `devices`, then rebuilds `sensor_data` as the partitioned table with
+integer device keys by copying into a fresh table (an in-place UPDATE would
+leave every old tuple behind as dead space). Partitions covering the existing
+data are created before the copy, and duplicate `(device_id, ds)` readings are
+skipped, and the rollups are rebuilt from the copied rows. Table/index sizes
+are printed before and after. Everything runs in one transaction.
+
+Tables that are already partitioned but predate the unique `(device_id, ds)`
+key are deduplicated in place instead (the oldest row of each key is kept),
+the affected rollups are rebuilt and the unique index replaces the old one.
+
+Usage:
+  python -m backend.migrate_sensor_data [--keep-legacy]
+"""
+
+import argparse
+
+from sqlalchemy import create_engine, text
+
+from . import config as cfg
+from . import sensor_partitions
+from . import sensor_schema
+from .rollups import rebuild_rollups
+
+
+def _fmt(sizes):
+    return ", ".join(f"{k} {v / 1024 / 1024:.1f} MiB" for k, v in sizes.items())
+
+
+def dedupe(engine):
+    """Delete duplicate readings, rebuild the rollups they inflated and add the unique key."""
+    with engine.begin() as conn:
+        removed, oldest = conn.execute(text(
+            "WITH d AS ("
+            "  DELETE FROM sensor_data a USING sensor_data b "
+            "  WHERE a.device_id = b.device_id AND a.ds = b.ds AND a.id > b.id RETURNING a.ds"
+            ") SELECT count(*), min(ds) FROM d"
+        )).fetchone()
+        print(f"Removed {removed} duplicate readings")
+        if oldest is not None:
+            rebuild_rollups(conn, oldest)
+            print(f"Rebuilt rollups since {oldest}")
+        sensor_schema.ensure_sensor_indexes(conn, unique=True)
+        conn.execute(text(f"DROP INDEX IF EXISTS {sensor_schema.LEGACY_DEVICE_DS_INDEX}"))
+    with engine.begin() as conn:
+        conn.execute(text("ANALYZE sensor_data"))
+
+
+def migrate(engine, keep_legacy=False):
+    sensor_schema.init_sensor_schema(engine)
+    reason = sensor_schema.needs_migration(engine)
+    if reason is None:
+        print("sensor_data is already up to date; nothing to do")
+        return
+    print(f"Migrating sensor_data: {reason}")
+    with engine.connect() as conn:
+        rebuild = not sensor_partitions.is_partitioned(conn)
+    if not rebuild and not sensor_schema.device_id_is_legacy(engine):
+        dedupe(engine)
+        return
+    legacy_names = sensor_schema.device_id_is_legacy(engine)
+
+    with engine.begin() as conn:
+        before = sensor_schema.table_sizes(conn)
+        print(f"Before: {_fmt(before)}")
+
+        if legacy_names:
+            registered = conn.execute(text(
+                "INSERT INTO devices (name) "
+                "SELECT DISTINCT device_id FROM sensor_data WHERE device_id IS NOT NULL "
+                "ON CONFLICT (name) DO NOTHING"
+            )).rowcount
+            print(f"Registered {registered} devices")
+        oldest = conn.execute(text("SELECT MIN(ds) FROM sensor_data")).scalar()
+
+        seq = conn.execute(text("SELECT pg_get_serial_sequence('sensor_data', 'id')")).scalar()
+        conn.execute(text("ALTER TABLE sensor_data RENAME TO sensor_data_legacy"))
+        conn.execute(text("ALTER INDEX sensor_data_pkey RENAME TO sensor_data_legacy_pkey"))
+        if seq:
+            conn.execute(text(f"ALTER SEQUENCE {seq} RENAME TO sensor_data_legacy_id_seq"))
+        names = [index.name for index in sensor_schema.sensor_table.indexes]
+        for name in names + [sensor_schema.LEGACY_DEVICE_DS_INDEX]:
+            conn.execute(text(f"ALTER INDEX IF EXISTS {name} RENAME TO {name}_legacy"))
+
+        sensor_schema.sensor_table.create(conn)
+        created = sensor_partitions.ensure_partitions(conn, start=oldest)
+        print(f"Created {len(created)} partitions")
+        if legacy_names:
+            select = (
+                "SELECT s.id, s.ds, s.value, d.id "
+                "FROM sensor_data_legacy s LEFT JOIN devices d ON d.name = s.device_id"
+            )
+        else:
+            select = "SELECT id, ds, value, device_id FROM sensor_data_legacy"
+        copied = conn.execute(text(
+            f"INSERT INTO sensor_data (id, ds, value, device_id) {select} "
+            f"ORDER BY 1 ON CONFLICT (device_id, ds) DO NOTHING"
+        )).rowcount
+        conn.execute(text(
+            "SELECT setval(pg_get_serial_sequence('sensor_data', 'id'), COALESCE(MAX(id), 0) + 1, false) "
+            "FROM sensor_data"
+        ))
+        if not keep_legacy:
+            conn.execute(text("DROP TABLE sensor_data_legacy"))
+        print(f"Copied {copied} rows into the new sensor_data")
+        if oldest is not None:
+            rebuild_rollups(conn, oldest)
+            print(f"Rebuilt rollups since {oldest}")
+
+    with engine.begin() as conn:
+        conn.execute(text("ANALYZE sensor_data"))
+        after = sensor_schema.table_sizes(conn)
+    print(f"After:  {_fmt(after)}")
+    if before["total"]:
+        print(f"Total size change: {100.0 * (after['total'] - before['total']) / before['total']:+.1f}%")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", default=None, help="Database URL (overrides env DB_URL)")
+    parser.add_argument("--keep-legacy", action="store_true", help="Keep the old table as sensor_data_legacy")
+    args = parser.parse_args()
+
+    migrate(create_engine(args.db or cfg.get_db_url()), keep_legacy=args.keep_legacy)
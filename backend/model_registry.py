@@ -0,0 +1,270 @@
+"""
+Registry of per-device and per-department Prophet models.
+
+Layout of `MODEL_REGISTRY_DIR`:
+
+  manifest.json         {"models": {key: entry}, "departments": {device: department}}
+  <key>-<hash>.joblib   one artifact per model
+  <key>-<hash>.joblib.params.json   fitted parameters for warm-started retrains
+
+Keys are device names, or `dept:<department>` for a model shared by a
+department. Each manifest entry records `path`, `version`, the training
+`watermark` (newest `ds` the model has seen), `trained_at` and `rows`.
+
+`ModelRegistry.get(device_id)` resolves a device to its own model, then to its
+department's model, and loads the artifact lazily on first use. Loaded models
+sit in an LRU bounded by `memory_budget` bytes (artifact size on disk is used
+as the estimate), so hundreds of registered models never have to be resident
+at once. The manifest is re-read when its mtime changes; a model whose entry
+has a new version is reloaded on its next use.
+
+Writers (`train_prophet.py`) use `save_model()`, which writes the artifact,
+its params sidecar and the manifest atomically (temp file + rename), the
+manifest under a lock file (`flock` on POSIX, `msvcrt.locking` on Windows).
+"""
+
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+
+import joblib
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+MANIFEST = "manifest.json"
+
+
+def department_key(department):
+    return f"dept:{department}"
+
+
+def artifact_name(key):
+    safe = re.sub(r"[^A-Za-z0-9._-]", "_", key)[:64]
+    return f"{safe}-{hashlib.sha1(key.encode()).hexdigest()[:8]}.joblib"
+
+
+def read_manifest(directory):
+    try:
+        with open(os.path.join(directory, MANIFEST)) as fh:
+            manifest = json.load(fh)
+    except FileNotFoundError:
+        manifest = {}
+    manifest.setdefault("models", {})
+    manifest.setdefault("departments", {})
+    return manifest
+
+
+def _atomic_write(path, write):
+    directory = os.path.dirname(path) or "."
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            write(fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def dump_model(model, path):
+    """`joblib.dump` via a temp file and rename, so readers (and memory maps) never see a partial file."""
+    _atomic_write(path, lambda fh: joblib.dump(model, fh))
+
+
+def params_path(artifact_path):
+    return f"{artifact_path}.params.json"
+
+
+def write_json(path, obj):
+    data = json.dumps(obj, indent=2, sort_keys=True).encode()
+    _atomic_write(path, lambda fh: fh.write(data))
+
+
+def read_json(path):
+    try:
+        with open(path) as fh:
+            return json.load(fh)
+    except FileNotFoundError:
+        return None
+
+
+def _lock_file(fh):
+    if fcntl is not None:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        return
+    # msvcrt locks a byte range from the current position; LK_LOCK gives up after ~10 s.
+    fh.seek(0)
+    while True:
+        try:
+            msvcrt.locking(fh.fileno(), msvcrt.LK_LOCK, 1)
+            return
+        except OSError:
+            continue
+
+
+def _unlock_file(fh):
+    if fcntl is not None:
+        fcntl.flock(fh, fcntl.LOCK_UN)
+    else:
+        fh.seek(0)
+        msvcrt.locking(fh.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+@contextmanager
+def _manifest_lock(directory):
+    with open(os.path.join(directory, ".manifest.lock"), "a+") as fh:
+        _lock_file(fh)
+        try:
+            yield
+        finally:
+            _unlock_file(fh)
+
+
+def update_manifest(directory, update):
+    """Apply `update(manifest)` to the manifest and write it back atomically."""
+    os.makedirs(directory, exist_ok=True)
+    with _manifest_lock(directory):
+        manifest = read_manifest(directory)
+        update(manifest)
+        write_json(os.path.join(directory, MANIFEST), manifest)
+
+
+def save_model(directory, key, model, watermark=None, rows=None, params=None, **extra):
+    """Write `model` (and its `params` sidecar) as the artifact for `key` and register it."""
+    os.makedirs(directory, exist_ok=True)
+    name = artifact_name(key)
+    dump_model(model, os.path.join(directory, name))
+    if params is not None:
+        write_json(params_path(os.path.join(directory, name)), params)
+    now = datetime.utcnow()
+    entry = {
+        "path": name,
+        "version": now.strftime("%Y%m%dT%H%M%S%f"),
+        "watermark": watermark.isoformat() if watermark is not None else None,
+        "trained_at": now.isoformat(timespec="seconds"),
+        "rows": rows,
+        **extra,
+    }
+    update_manifest(directory, lambda manifest: manifest["models"].__setitem__(key, entry))
+    return entry
+
+
+def load_params(directory, key):
+    """Params sidecar of the registered model for `key`, or None."""
+    entry = read_manifest(directory)["models"].get(key)
+    if entry is None:
+        return None
+    return read_json(params_path(os.path.join(directory, entry["path"])))
+
+
+class ModelRegistry:
+    def __init__(self, directory, memory_budget=512 * 1024 * 1024, loader=joblib.load):
+        self.directory = directory
+        self.memory_budget = memory_budget
+        self.loader = loader
+        self._manifest = read_manifest(directory)
+        self._manifest_mtime = None
+        self._loaded = OrderedDict()  # key -> (version, model, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._load_locks = {}
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+
+    def manifest(self):
+        """Current manifest, re-read from disk when the file changed."""
+        try:
+            mtime = os.stat(os.path.join(self.directory, MANIFEST)).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime != self._manifest_mtime:
+            self._manifest = read_manifest(self.directory)
+            self._manifest_mtime = mtime
+        return self._manifest
+
+    def resolve(self, device_id):
+        """`(key, entry)` of the model serving `device_id`, or None."""
+        manifest = self.manifest()
+        models = manifest["models"]
+        if device_id in models:
+            return device_id, models[device_id]
+        department = manifest["departments"].get(device_id)
+        if department is not None and department_key(department) in models:
+            key = department_key(department)
+            return key, models[key]
+        return None
+
+    def get(self, device_id):
+        """`(model, version, key)` for `device_id`, loading it if needed; None if unregistered."""
+        resolved = self.resolve(device_id)
+        if resolved is None:
+            return None
+        key, entry = resolved
+        version = entry["version"]
+        with self._lock:
+            loaded = self._loaded.get(key)
+            if loaded is not None and loaded[0] == version:
+                self._loaded.move_to_end(key)
+                self.hits += 1
+                return loaded[1], version, key
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+        # One loader per key; other requests for the same model wait for it.
+        with load_lock:
+            with self._lock:
+                loaded = self._loaded.get(key)
+                if loaded is not None and loaded[0] == version:
+                    self.hits += 1
+                    return loaded[1], version, key
+            path = os.path.join(self.directory, entry["path"])
+            model = self.loader(path)
+            size = os.path.getsize(path)
+            with self._lock:
+                previous = self._loaded.pop(key, None)
+                if previous is not None:
+                    self._bytes -= previous[2]
+                self._loaded[key] = (version, model, size)
+                self._bytes += size
+                self.loads += 1
+                self._evict(keep=key)
+        return model, version, key
+
+    def peek(self, key, version):
+        """The resident model for `key` at `version`, or None; neither loads nor touches the LRU order."""
+        with self._lock:
+            loaded = self._loaded.get(key)
+        return loaded[1] if loaded is not None and loaded[0] == version else None
+
+    def _evict(self, keep):
+        while self._bytes > self.memory_budget and len(self._loaded) > 1:
+            key = next(iter(self._loaded))
+            if key == keep:
+                self._loaded.move_to_end(key)
+                continue
+            _, _, size = self._loaded.pop(key)
+            self._bytes -= size
+            self.evictions += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "registered": len(self._manifest["models"]),
+                "loaded": len(self._loaded),
+                "loaded_mb": round(self._bytes / 1024 / 1024, 1),
+                "budget_mb": round(self.memory_budget / 1024 / 1024, 1),
+                "hits": self.hits,
+                "loads": self.loads,
+                "evictions": self.evictions,
+            }
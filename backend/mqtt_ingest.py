@@ -6,77 +6,274 @@ Expects sensor messages as JSON payloads containing at least:
     "ts": "2025-12-06T12:34:00Z",
     "value": 12.34
   }
+`ts` may also be an epoch integer. Firmware can instead send the compact binary
+format from `ingest_decoders.py`; pick the decoder per topic with
+`--decoder PATTERN=FORMAT` (e.g. `--decoder 'energia/sensors/bin/#=binary'`).
 
-Writes to a Postgres table `sensor_data(ds timestamp, device_id text, value double precision)`
+Writes to a Postgres table `sensor_data(ds timestamp, value double precision, device_id int)`,
+where `device_id` references `devices(id, name)`; unseen device names are registered
+automatically (see `devices.py`).
+Readings are buffered and written in bulk (COPY); tune with `--batch-size` and `--flush-ms`.
+
+The MQTT callback only enqueues raw messages; `--workers` writer threads decode
+and write them. When the queue (`--queue-size`) is full, `--backpressure`
+decides whether to block the network thread, drop the oldest message, or spill
+rows to the on-disk spool.
+
+Batches that cannot be committed (e.g. the `db` service is restarting) are
+written to a segment-rotated spool under `--spool-dir` and replayed in bulk
+once Postgres is reachable again; replay resumes from a checkpoint on restart.
+Use `--no-spool` to disable it.
+
+Ingest is idempotent: `sensor_data` has a unique `(device_id, ds)` key and the
+writer inserts with `ON CONFLICT DO NOTHING`. A per-device recent-keys filter
+(`--dedupe-keys`) drops QoS 1 redeliveries before they reach the database, and
+readings older than `--max-lateness` seconds are written or dropped according
+to `--late-policy`. See `ingest_filters.py`.
+
+With `--anomalies` every committed reading is checked against the newest stored
+forecast band of its device (see `forecast_scheduler.py`); readings outside the
+band by more than `--anomaly-margin` x its width for `--anomaly-debounce`
+consecutive readings open an episode in the `anomalies` table, which closes
+once as many readings are back inside. Readings are held `--anomaly-reorder`
+seconds per device so they are checked in `ds` order; under `--processes` the
+supervisor runs the detector for all workers. See `anomaly_detector.py`.
+
+With `--processes N` the ingestor runs as a supervisor that launches N worker
+processes sharing the subscription through `$share/<--share-group>/<topic>`,
+so the broker load-balances messages across cores. See `ingest_supervisor.py`.
 """
 
 import os
-import json
-import time
+import signal
 import argparse
+import threading
 import paho.mqtt.client as mqtt
-from sqlalchemy import create_engine, text
-from datetime import datetime
+from sqlalchemy import create_engine
+from sqlalchemy.exc import SQLAlchemyError
 
 from . import config as cfg
+from . import sensor_schema
+from .ingest_decoders import DECODERS, DecoderRouter, parse_rules
+from .ingest_filters import LATE_POLICIES, ReadingFilter
+from .ingest_pipeline import POLICIES, IngestPipeline
+from .ingest_spool import Spool, SpoolReplayer
+from .sensor_partitions import MAINTENANCE_INTERVAL, PartitionMaintainer
 
 MQTT_BROKER = os.environ.get("MQTT_BROKER", "localhost")
 MQTT_PORT = int(os.environ.get("MQTT_PORT", 1883))
 TOPIC = os.environ.get("MQTT_TOPIC", "energia/sensors/#")
 DB_URL = cfg.get_db_url()
+BATCH_SIZE = int(os.environ.get("INGEST_BATCH_SIZE", 500))
+FLUSH_MS = int(os.environ.get("INGEST_FLUSH_MS", 1000))
+WORKERS = int(os.environ.get("INGEST_WORKERS", 2))
+QUEUE_SIZE = int(os.environ.get("INGEST_QUEUE_SIZE", 10000))
+BACKPRESSURE = os.environ.get("INGEST_BACKPRESSURE", "block")
+SPOOL_DIR = os.environ.get("INGEST_SPOOL_DIR", "spool")
+SPOOL_MAX_MB = int(os.environ.get("INGEST_SPOOL_MAX_MB", 1024))
+SPOOL_SEGMENT_MB = int(os.environ.get("INGEST_SPOOL_SEGMENT_MB", 16))
+DEDUPE_KEYS = int(os.environ.get("INGEST_DEDUPE_KEYS", 256))
+MAX_LATENESS = float(os.environ.get("INGEST_MAX_LATENESS", 0))
+LATE_POLICY = os.environ.get("INGEST_LATE_POLICY", "accept")
+STATS_INTERVAL = float(os.environ.get("INGEST_STATS_INTERVAL", 30))
+DECODER_RULES = os.environ.get("INGEST_DECODERS", "")
+DEFAULT_DECODER = os.environ.get("INGEST_DEFAULT_DECODER", "json")
+PROCESSES = int(os.environ.get("INGEST_PROCESSES", 1))
+SHARE_GROUP = os.environ.get("INGEST_SHARE_GROUP", "energia-ingest")
+HEALTH_FILE = os.environ.get("INGEST_HEALTH_FILE", "")
+ANOMALIES = os.environ.get("INGEST_ANOMALIES", "0") == "1"
+ANOMALY_MARGIN = float(os.environ.get("INGEST_ANOMALY_MARGIN", 0.1))
+ANOMALY_DEBOUNCE = int(os.environ.get("INGEST_ANOMALY_DEBOUNCE", 3))
+ANOMALY_REFRESH = float(os.environ.get("INGEST_ANOMALY_REFRESH", 60))
+ANOMALY_REORDER = float(os.environ.get("INGEST_ANOMALY_REORDER", 5))
 
 engine = create_engine(DB_URL)
+pipeline = None
 
 
 def on_connect(client, userdata, flags, rc):
     print("Connected to MQTT broker", rc)
     client.subscribe(TOPIC)
+    if userdata is not None:
+        userdata["connected"] = rc == 0
 
 
-def on_message(client, userdata, msg):
-    try:
-        payload = json.loads(msg.payload.decode())
-    except Exception as e:
-        print("Invalid JSON payload", e)
-        return
+def on_disconnect(client, userdata, rc):
+    if userdata is not None:
+        userdata["connected"] = False
 
-    device_id = payload.get("device_id") or payload.get("id") or msg.topic
-    ts = payload.get("ts")
-    if ts:
-        try:
-            ts = datetime.fromisoformat(ts.replace("Z", "+00:00"))
-        except Exception:
-            ts = datetime.utcnow()
-    else:
-        ts = datetime.utcnow()
-
-    value = payload.get("value") if payload.get("value") is not None else payload.get("y")
-    if value is None:
-        print("No value field in payload")
-        return
 
-    with engine.begin() as conn:
-        conn.execute(
-            text("INSERT INTO sensor_data(ds, device_id, value) VALUES (:ds, :device_id, :value)"),
-            {"ds": ts, "device_id": device_id, "value": float(value)},
-        )
-    print(f"Inserted {device_id}@{ts} -> {value}")
+def on_message(client, userdata, msg):
+    # Runs on paho's network thread: enqueue only, never touch the database here.
+    pipeline.submit(msg.topic, msg.payload)
 
 
-if __name__ == "__main__":
+def build_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("--broker", default=MQTT_BROKER)
     parser.add_argument("--port", default=MQTT_PORT, type=int)
     parser.add_argument("--topic", default=TOPIC)
     parser.add_argument("--db", default=DB_URL)
-    args = parser.parse_args()
+    parser.add_argument("--batch-size", default=BATCH_SIZE, type=int, help="Flush after this many rows")
+    parser.add_argument("--flush-ms", default=FLUSH_MS, type=int, help="Flush rows older than this many ms")
+    parser.add_argument("--workers", default=WORKERS, type=int, help="Writer threads draining the queue")
+    parser.add_argument("--queue-size", default=QUEUE_SIZE, type=int, help="Max messages waiting for a writer")
+    parser.add_argument("--backpressure", default=BACKPRESSURE, choices=POLICIES)
+    parser.add_argument("--spool-dir", default=SPOOL_DIR, help="Directory for the on-disk spool")
+    parser.add_argument("--spool-max-mb", default=SPOOL_MAX_MB, type=int, help="Disk budget for the spool")
+    parser.add_argument("--spool-segment-mb", default=SPOOL_SEGMENT_MB, type=int, help="Spool segment size")
+    parser.add_argument("--no-spool", action="store_true", help="Drop batches that fail to commit instead of spooling")
+    parser.add_argument(
+        "--decoder",
+        action="append",
+        default=[DECODER_RULES] if DECODER_RULES else [],
+        help="PATTERN=FORMAT rule selecting the payload decoder per topic (repeatable)",
+    )
+    parser.add_argument("--default-decoder", default=DEFAULT_DECODER, choices=sorted(DECODERS))
+    parser.add_argument("--dedupe-keys", default=DEDUPE_KEYS, type=int, help="Recent timestamps remembered per device (0 disables)")
+    parser.add_argument("--max-lateness", default=MAX_LATENESS, type=float, help="Seconds behind now after which a reading counts as late (0 = never)")
+    parser.add_argument("--late-policy", default=LATE_POLICY, choices=LATE_POLICIES, help="What to do with late readings")
+    parser.add_argument("--anomalies", action="store_true", default=ANOMALIES, help="Check readings against stored forecast bands")
+    parser.add_argument("--anomaly-margin", default=ANOMALY_MARGIN, type=float, help="Band widths beyond the band before a reading counts as outside")
+    parser.add_argument("--anomaly-debounce", default=ANOMALY_DEBOUNCE, type=int, help="Consecutive readings that open or close an anomaly")
+    parser.add_argument("--anomaly-refresh", default=ANOMALY_REFRESH, type=float, help="Seconds between forecast band reloads")
+    parser.add_argument("--anomaly-reorder", default=ANOMALY_REORDER, type=float, help="Seconds readings are held per device to check them in ds order")
+    parser.add_argument("--stats-interval", default=STATS_INTERVAL, type=float, help="Seconds between stats lines (0 disables)")
+    parser.add_argument(
+        "--maintenance-interval",
+        default=MAINTENANCE_INTERVAL,
+        type=float,
+        help="Seconds between sensor_data partition maintenance passes (0 disables)",
+    )
+    parser.add_argument("--processes", default=PROCESSES, type=int, help="Worker processes; >1 enables supervisor mode")
+    parser.add_argument("--share-group", default=SHARE_GROUP, help="MQTT shared-subscription group for worker processes")
+    parser.add_argument("--health-file", default=HEALTH_FILE, help="Supervisor writes worker health JSON here")
+    return parser
+
+
+def parse_args(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    try:
+        args.decoder_rules = parse_rules(args.decoder)
+    except ValueError as exc:
+        parser.error(str(exc))
+    if args.no_spool and args.backpressure == "spill":
+        parser.error("--backpressure spill needs the spool; drop --no-spool")
+    return args
+
+
+def check_schema(engine):
+    """Exit if `sensor_data` lacks the layout the writer needs (its `ON CONFLICT` needs the unique key).
+
+    An unreachable database is not fatal: batches go to the spool until it is back.
+    """
+    try:
+        reason = sensor_schema.needs_migration(engine)
+    except SQLAlchemyError as exc:
+        print(f"Could not check the sensor_data schema: {exc}")
+        return
+    if reason:
+        raise SystemExit(f"sensor_data needs migrating ({reason}); run `python -m backend.migrate_sensor_data` first")
+
+
+def run(args, heartbeat=None, heartbeat_interval=5.0, anomaly_rows=None):
+    """Run one ingestor until the MQTT loop stops (SIGTERM/SIGINT or disconnect).
 
-    client = mqtt.Client()
+    `heartbeat(status)` is called every `heartbeat_interval` seconds with the
+    pipeline counters; the supervisor uses it for health reporting. With an
+    `anomaly_rows` queue, committed rows are sent there for the supervisor's
+    detector instead of being checked here.
+    """
+    global engine, pipeline, TOPIC
+
+    TOPIC = args.topic
+    decoder = DecoderRouter(args.decoder_rules, default=args.default_decoder)
+    state = {"connected": False}
+
+    client = mqtt.Client(userdata=state)
     client.on_connect = on_connect
+    client.on_disconnect = on_disconnect
     client.on_message = on_message
 
     print("Connecting to DB at", args.db)
     engine = create_engine(args.db)
+    check_schema(engine)
+
+    spool = replayer = None
+    if not args.no_spool:
+        spool = Spool(
+            args.spool_dir,
+            segment_bytes=args.spool_segment_mb * 1024 * 1024,
+            max_bytes=args.spool_max_mb * 1024 * 1024,
+        )
+        replayer = SpoolReplayer(engine, spool)
+        replayer.start()
+
+    detector = None
+    if anomaly_rows is not None:
+        from .anomaly_detector import AnomalyForwarder
+
+        detector = AnomalyForwarder(anomaly_rows)
+    elif args.anomalies:
+        # Imported only when enabled: it pulls in the model registry (joblib, file locks).
+        from .anomaly_detector import AnomalyDetector
+
+        detector = AnomalyDetector(engine, args.anomaly_margin, args.anomaly_debounce, args.anomaly_refresh,
+                                   reorder_s=args.anomaly_reorder)
+        detector.start()
+
+    pipeline = IngestPipeline(
+        engine,
+        decoder.decode,
+        workers=args.workers,
+        queue_size=args.queue_size,
+        policy=args.backpressure,
+        spool=spool,
+        batch_size=args.batch_size,
+        flush_ms=args.flush_ms,
+        reading_filter=ReadingFilter(args.dedupe_keys, args.max_lateness, args.late_policy),
+        anomaly_detector=detector,
+    )
+    pipeline.start(stats_interval=args.stats_interval)
+
+    maintainer = PartitionMaintainer(engine, interval=args.maintenance_interval)
+    maintainer.start()
+
+    stop = threading.Event()
+    if heartbeat is not None:
+        def _beat():
+            while not stop.wait(heartbeat_interval):
+                heartbeat({"connected": state["connected"], "stats": pipeline.snapshot()})
+
+        threading.Thread(target=_beat, name="ingest-heartbeat", daemon=True).start()
+
+    # Disconnecting makes loop_forever() return so the pipeline can drain cleanly.
+    signal.signal(signal.SIGTERM, lambda *_: client.disconnect())
 
     client.connect(args.broker, args.port, 60)
-    client.loop_forever()
+    try:
+        client.loop_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        maintainer.stop()
+        pipeline.close()
+        if detector is not None:
+            detector.close()
+        if replayer is not None:
+            replayer.stop()
+            spool.close()
+        print("Ingest stats", pipeline.snapshot())
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.processes > 1:
+        from .ingest_supervisor import Supervisor
+
+        check_schema(create_engine(args.db))
+        Supervisor(args).run()
+    else:
+        run(args)
@@ -0,0 +1,162 @@
+"""
+Incrementally maintained per-device rollups at 1-minute, 1-hour and 1-day grain.
+
+`upsert_rollups(conn, rows)` runs inside the ingest writer's transaction: the
+batch is aggregated in Python per `(device, bucket)` and merged into
+`sensor_rollup_<grain>` with one `INSERT ... ON CONFLICT DO UPDATE` per grain,
+so only buckets touched by the batch are written and a rollup changes exactly
+when its raw rows commit. Late readings simply merge into their (older)
+bucket; `last_value` follows the reading with the greatest `ds`.
+
+Readers pick the coarsest grain that still gives enough points with
+`pick_grain()` and bin its buckets further in SQL (see `sensor_series.py`).
+
+History that predates the rollups can be backfilled with:
+  python -m backend.rollups --rebuild --since 2025-01-01
+"""
+
+import argparse
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, text
+
+from .sensor_schema import ROLLUP_GRAINS
+
+GRAIN_SECONDS = {"1m": 60, "1h": 3600, "1d": 86400}
+_TRUNC = {"1m": "minute", "1h": "hour", "1d": "day"}
+
+
+def bucket_of(ds, grain):
+    if grain == "1m":
+        return ds.replace(second=0, microsecond=0)
+    if grain == "1h":
+        return ds.replace(minute=0, second=0, microsecond=0)
+    return ds.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def aggregate(rows, grain):
+    """Fold `(ds, device_id, value)` rows into `{(device_id, bucket): [count, sum, min, max, last_ds, last]}`."""
+    buckets = {}
+    for ds, device_id, value in rows:
+        key = (device_id, bucket_of(ds, grain))
+        agg = buckets.get(key)
+        if agg is None:
+            buckets[key] = [1, value, value, value, ds, value]
+            continue
+        agg[0] += 1
+        agg[1] += value
+        if value < agg[2]:
+            agg[2] = value
+        if value > agg[3]:
+            agg[3] = value
+        if ds >= agg[4]:
+            agg[4] = ds
+            agg[5] = value
+    return buckets
+
+
+def _upsert_sql(grain):
+    table = f"sensor_rollup_{grain}"
+    return text(
+        f"INSERT INTO {table} AS r "
+        f"(device_id, bucket, count, sum_value, min_value, max_value, last_ds, last_value) "
+        f"SELECT * FROM unnest("
+        f"CAST(:device_id AS integer[]), CAST(:bucket AS timestamp[]), CAST(:count AS bigint[]), "
+        f"CAST(:sum_value AS float8[]), CAST(:min_value AS float8[]), CAST(:max_value AS float8[]), "
+        f"CAST(:last_ds AS timestamp[]), CAST(:last_value AS float8[])) "
+        f"ON CONFLICT (device_id, bucket) DO UPDATE SET "
+        f"count = r.count + EXCLUDED.count, "
+        f"sum_value = r.sum_value + EXCLUDED.sum_value, "
+        f"min_value = LEAST(r.min_value, EXCLUDED.min_value), "
+        f"max_value = GREATEST(r.max_value, EXCLUDED.max_value), "
+        f"last_value = CASE WHEN EXCLUDED.last_ds >= r.last_ds THEN EXCLUDED.last_value ELSE r.last_value END, "
+        f"last_ds = GREATEST(r.last_ds, EXCLUDED.last_ds)"
+    )
+
+
+UPSERT_SQL = {grain: _upsert_sql(grain) for grain in ROLLUP_GRAINS}
+
+
+def upsert_rollups(conn, rows):
+    """Merge a batch of `(ds, device_id, value)` rows (integer device ids) into every rollup grain."""
+    if not rows:
+        return
+    for grain in ROLLUP_GRAINS:
+        # Sorted keys make concurrent writers lock buckets in the same order (no deadlocks).
+        items = sorted(aggregate(rows, grain).items())
+        params = {
+            "device_id": [k[0] for k, _ in items],
+            "bucket": [k[1] for k, _ in items],
+            "count": [a[0] for _, a in items],
+            "sum_value": [a[1] for _, a in items],
+            "min_value": [a[2] for _, a in items],
+            "max_value": [a[3] for _, a in items],
+            "last_ds": [a[4] for _, a in items],
+            "last_value": [a[5] for _, a in items],
+        }
+        conn.execute(UPSERT_SQL[grain], params)
+
+
+def pick_grain(start, end, max_points):
+    """Coarsest-useful source for `[start, end)`: None (raw rows) or a rollup grain.
+
+    Chooses the largest grain whose bucket count still reaches `max_points`,
+    so the caller never reads more rows than needed for the requested detail.
+    """
+    span = (end - start).total_seconds()
+    for grain in reversed(ROLLUP_GRAINS):
+        if span / GRAIN_SECONDS[grain] >= max_points:
+            return grain
+    return None
+
+
+def grain_for_step(seconds):
+    """Coarsest rollup grain that `seconds`-wide buckets can be built from, or None for raw rows."""
+    for grain in reversed(ROLLUP_GRAINS):
+        if seconds >= GRAIN_SECONDS[grain] and seconds % GRAIN_SECONDS[grain] == 0:
+            return grain
+    return None
+
+
+def rebuild_rollups(conn, start, end=None):
+    """Recompute every grain from raw `sensor_data` for `[start, end)`; used to backfill history.
+
+    Both ends are widened to whole buckets of each grain, so no bucket is
+    rewritten from only part of its rows.
+    """
+    end = end or datetime.utcnow() + timedelta(days=1)
+    for grain in ROLLUP_GRAINS:
+        table = f"sensor_rollup_{grain}"
+        trunc = _TRUNC[grain]
+        lo = bucket_of(start, grain)
+        hi = bucket_of(end, grain)
+        if hi < end:
+            hi += timedelta(seconds=GRAIN_SECONDS[grain])
+        conn.execute(text(f"DELETE FROM {table} WHERE bucket >= :lo AND bucket < :hi"), {"lo": lo, "hi": hi})
+        conn.execute(text(
+            f"INSERT INTO {table} "
+            f"(device_id, bucket, count, sum_value, min_value, max_value, last_ds, last_value) "
+            f"SELECT device_id, date_trunc('{trunc}', ds), count(*), sum(value), min(value), max(value), "
+            f"max(ds), (array_agg(value ORDER BY ds DESC))[1] "
+            f"FROM sensor_data WHERE ds >= :lo AND ds < :hi AND device_id IS NOT NULL AND value IS NOT NULL "
+            f"GROUP BY 1, 2"
+        ), {"lo": lo, "hi": hi})
+
+
+if __name__ == "__main__":
+    from . import config as cfg
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", default=None, help="Database URL (overrides env DB_URL)")
+    parser.add_argument("--rebuild", action="store_true", help="Recompute rollups from raw sensor_data")
+    parser.add_argument("--since", type=datetime.fromisoformat, help="Start of the range to rebuild")
+    parser.add_argument("--until", type=datetime.fromisoformat, help="End of the range (default: now)")
+    args = parser.parse_args()
+
+    if not args.rebuild:
+        parser.error("nothing to do; pass --rebuild")
+    if args.since is None:
+        parser.error("--rebuild needs --since")
+    with create_engine(args.db or cfg.get_db_url()).begin() as conn:
+        rebuild_rollups(conn, args.since, args.until)
+    print("Rollups rebuilt")
@@ -0,0 +1,78 @@
+"""
+In-process ring buffer of the most recent readings per device.
+
+Serves "current load" style reads without a database round-trip. The buffer is
+filled from the live MQTT feed (`sensor_feed.py`) and warmed from Postgres at
+startup so a restart does not leave the dashboards empty.
+"""
+
+import threading
+from collections import deque
+
+from sqlalchemy import text
+
+WARM_SQL = text(
+    "SELECT d.name, r.ds, r.value FROM devices d "
+    "CROSS JOIN LATERAL ("
+    "  SELECT ds, value FROM sensor_data s "
+    "  WHERE s.device_id = d.id AND s.ds >= :since ORDER BY s.ds DESC LIMIT :n"
+    ") r "
+    "ORDER BY d.name, r.ds"
+)
+
+
+class RecentReadings:
+    """Bounded per-device history of `(ds, value)` pairs, ordered by `ds`."""
+
+    def __init__(self, size=120):
+        self.size = size
+        self._buffers = {}
+        self._lock = threading.Lock()
+
+    def add(self, device_id, ds, value):
+        """Store a reading; returns False when it was not kept (a repeated `ds` or too old)."""
+        with self._lock:
+            buf = self._buffers.get(device_id)
+            if buf is None:
+                buf = self._buffers[device_id] = deque(maxlen=self.size)
+            if not buf or ds > buf[-1][0]:
+                buf.append((ds, value))
+                return True
+            # Late reading: slot it in place, unless it is older than everything kept.
+            if len(buf) == buf.maxlen and ds < buf[0][0]:
+                return False
+            i = len(buf)
+            while i > 0 and buf[i - 1][0] > ds:
+                i -= 1
+            if i > 0 and buf[i - 1][0] == ds:
+                return False  # QoS 1 redelivery of a reading already kept
+            if len(buf) == buf.maxlen:
+                buf.popleft()
+                i -= 1
+            buf.insert(i, (ds, value))
+            return True
+
+    def add_rows(self, rows):
+        """Store `(ds, device_id, value)` rows; returns the ones that were new."""
+        return [row for row in rows if self.add(row[1], row[0], row[2])]
+
+    def latest(self):
+        with self._lock:
+            return {device: buf[-1] for device, buf in self._buffers.items() if buf}
+
+    def recent(self, device_id, limit=None):
+        """Newest-last readings for `device_id`, or None if the device is unknown."""
+        with self._lock:
+            buf = self._buffers.get(device_id)
+            if buf is None:
+                return None
+            items = list(buf)
+        return items[-limit:] if limit else items
+
+    def warm(self, engine, since):
+        """Load the last `size` readings per device newer than `since` from the database."""
+        with engine.connect() as conn:
+            rows = conn.execute(WARM_SQL, {"since": since, "n": self.size}).fetchall()
+        for name, ds, value in rows:
+            self.add(name, ds, value)
+        return len(rows)
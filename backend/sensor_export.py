@@ -0,0 +1,146 @@
+"""
+Streaming export of `sensor_data` as CSV, gzip-compressed CSV or Parquet.
+
+Rows are read through a server-side cursor (`stream_results`) in chunks of
+`chunk_rows` and every chunk is encoded and handed out before the next one is
+fetched, so memory stays flat regardless of how many rows match. Parquet is
+written with `pyarrow`; each chunk becomes one row group.
+
+Rows come out partition by partition, i.e. roughly in time order, without a
+server-side sort of the whole result.
+"""
+
+import csv
+import io
+import zlib
+
+from sqlalchemy import text
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover - pyarrow is optional
+    pa = pq = None
+
+COLUMNS = ("ds", "device_id", "department", "value")
+FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "csv.gz": ("application/gzip", "csv.gz"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+
+class ExportError(ValueError):
+    pass
+
+
+def check_format(fmt):
+    if fmt not in FORMATS:
+        raise ExportError(f"format must be one of {', '.join(FORMATS)}")
+    if fmt == "parquet" and pa is None:
+        raise ExportError("parquet export needs pyarrow, which is not installed")
+
+
+def build_query(devices=None, departments=None, start=None, end=None):
+    """SELECT returning `COLUMNS` for the given filters, and its parameters."""
+    where, params = [], {}
+    if devices:
+        where.append("d.name = ANY(CAST(:devices AS text[]))")
+        params["devices"] = list(devices)
+    if departments:
+        where.append("d.department = ANY(CAST(:departments AS text[]))")
+        params["departments"] = list(departments)
+    if start is not None:
+        where.append("s.ds >= :start")
+        params["start"] = start
+    if end is not None:
+        where.append("s.ds < :end")
+        params["end"] = end
+    sql = (
+        "SELECT s.ds, d.name, d.department, s.value "
+        "FROM sensor_data s JOIN devices d ON d.id = s.device_id"
+    )
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    return sql, params
+
+
+def _csv_chunks(chunks):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(COLUMNS)
+    for rows in chunks:
+        writer.writerows((ds.isoformat(), name, dept, value) for ds, name, dept, value in rows)
+        yield buf.getvalue().encode()
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue().encode()
+
+
+def _gzip_chunks(chunks):
+    gz = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for data in _csv_chunks(chunks):
+        out = gz.compress(data)
+        if out:
+            yield out
+    yield gz.flush()
+
+
+class _Sink(io.RawIOBase):
+    """Write-only file that hands written bytes back to the generator."""
+
+    def __init__(self):
+        self.parts = []
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.size
+
+    def take(self):
+        data, self.parts = b"".join(self.parts), []
+        return data
+
+
+def _parquet_chunks(chunks):
+    schema = pa.schema([
+        ("ds", pa.timestamp("us")),
+        ("device_id", pa.string()),
+        ("department", pa.string()),
+        ("value", pa.float64()),
+    ])
+    sink = _Sink()
+    writer = pq.ParquetWriter(sink, schema, compression="zstd")
+    for rows in chunks:
+        columns = list(zip(*rows))
+        writer.write_table(pa.Table.from_arrays(
+            [pa.array(col, type=field.type) for col, field in zip(columns, schema)], schema=schema,
+        ))
+        yield sink.take()
+    writer.close()
+    yield sink.take()
+
+
+ENCODERS = {"csv": _csv_chunks, "csv.gz": _gzip_chunks, "parquet": _parquet_chunks}
+
+
+def fetch_chunks(engine, sql, params, chunk_rows):
+    """Yield lists of rows from a server-side cursor, `chunk_rows` at a time."""
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, max_row_buffer=chunk_rows).execute(text(sql), params)
+        for rows in result.partitions(chunk_rows):
+            yield rows
+
+
+def export(engine, fmt, sql, params, chunk_rows=50_000):
+    """Generator of encoded bytes for the rows of `sql` in format `fmt`."""
+    check_format(fmt)
+    return ENCODERS[fmt](fetch_chunks(engine, sql, params, chunk_rows))
@@ -0,0 +1,74 @@
+"""
+Live sensor feed for the API process.
+
+A plain (non-shared) MQTT subscription to the sensor topic, decoded with the
+same decoders and per-topic rules as the ingestor (`INGEST_DECODERS`). Every
+decoded `(ds, device_name, value)` row is handed to the registered listeners,
+e.g. the in-process `RecentReadings` cache. Nothing here touches the database.
+
+paho runs the network loop on its own thread and reconnects on its own, so a
+broker outage only pauses the feed.
+"""
+
+import os
+
+import paho.mqtt.client as mqtt
+
+from .ingest_decoders import DecoderRouter, parse_rules
+
+MQTT_BROKER = os.environ.get("MQTT_BROKER", "localhost")
+MQTT_PORT = int(os.environ.get("MQTT_PORT", 1883))
+TOPIC = os.environ.get("MQTT_TOPIC", "energia/sensors/#")
+DECODER_RULES = os.environ.get("INGEST_DECODERS", "")
+DEFAULT_DECODER = os.environ.get("INGEST_DEFAULT_DECODER", "json")
+
+
+class SensorFeed:
+    def __init__(self, broker=MQTT_BROKER, port=MQTT_PORT, topic=TOPIC):
+        self.broker = broker
+        self.port = port
+        self.topic = topic
+        self.decoder = DecoderRouter(parse_rules([DECODER_RULES]), default=DEFAULT_DECODER)
+        self.listeners = []
+        self.connected = False
+        self._client = None
+
+    def add_listener(self, listener):
+        """`listener(rows)` is called on the MQTT thread with a list of decoded rows."""
+        self.listeners.append(listener)
+
+    def _on_connect(self, client, userdata, flags, rc):
+        self.connected = rc == 0
+        print("Sensor feed connected to MQTT broker", rc)
+        client.subscribe(self.topic)
+
+    def _on_disconnect(self, client, userdata, rc):
+        self.connected = False
+
+    def _on_message(self, client, userdata, msg):
+        row = self.decoder.decode(msg.topic, msg.payload)
+        if row is None:
+            return
+        rows = [row]
+        for listener in self.listeners:
+            try:
+                listener(rows)
+            except Exception as exc:  # noqa: BLE001
+                print(f"Sensor feed listener failed: {exc}")
+
+    def start(self):
+        if self._client is not None:
+            return
+        self._client = mqtt.Client()
+        self._client.on_connect = self._on_connect
+        self._client.on_disconnect = self._on_disconnect
+        self._client.on_message = self._on_message
+        self._client.connect_async(self.broker, self.port, 60)
+        self._client.loop_start()
+
+    def stop(self):
+        if self._client is None:
+            return
+        self._client.disconnect()
+        self._client.loop_stop()
+        self._client = None
@@ -0,0 +1,189 @@
+"""
+Partition maintenance for the range-partitioned `sensor_data` table.
+
+`sensor_data` is partitioned by `ds` into daily or monthly partitions
+(`SENSOR_PARTITION_INTERVAL=day|month`) named `sensor_data_pYYYYMMDD` after
+their first day, plus a `sensor_data_default` partition that catches readings
+outside every range so a bad device clock never fails an ingest batch.
+
+- `ensure_partitions()` pre-creates partitions up to `SENSOR_PARTITIONS_AHEAD`
+  intervals in the future. New partitions are built standalone and attached,
+  moving any matching rows out of the default partition in the same
+  transaction.
+- `apply_retention()` detaches (or drops, `SENSOR_RETENTION_ACTION=drop`)
+  partitions that end more than `SENSOR_RETENTION_DAYS` days ago, so expiring
+  old data is a metadata operation instead of a `DELETE`.
+
+Run from cron (or rely on the ingestor's hourly maintenance thread):
+  python -m backend.sensor_partitions [--dry-run]
+"""
+
+import argparse
+import os
+import re
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, text
+
+PARENT = "sensor_data"
+DEFAULT_PARTITION = "sensor_data_default"
+INTERVALS = ("day", "month")
+
+PARTITION_INTERVAL = os.environ.get("SENSOR_PARTITION_INTERVAL", "month")
+PARTITIONS_AHEAD = int(os.environ.get("SENSOR_PARTITIONS_AHEAD", 2))
+RETENTION_DAYS = int(os.environ.get("SENSOR_RETENTION_DAYS", 0))
+RETENTION_ACTION = os.environ.get("SENSOR_RETENTION_ACTION", "detach")
+MAINTENANCE_INTERVAL = float(os.environ.get("SENSOR_MAINTENANCE_INTERVAL", 3600))
+
+_BOUND_RE = re.compile(r"FROM \('([^']+)'\) TO \('([^']+)'\)")
+
+
+def period_start(ts, interval=PARTITION_INTERVAL):
+    day = ts.replace(hour=0, minute=0, second=0, microsecond=0)
+    return day if interval == "day" else day.replace(day=1)
+
+
+def next_period(start, interval=PARTITION_INTERVAL):
+    if interval == "day":
+        return start + timedelta(days=1)
+    if start.month == 12:
+        return start.replace(year=start.year + 1, month=1)
+    return start.replace(month=start.month + 1)
+
+
+def is_partitioned(conn, table=PARENT):
+    return bool(conn.execute(
+        text("SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:t))"),
+        {"t": table},
+    ).scalar())
+
+
+def list_partitions(conn, table=PARENT):
+    """Return `[(name, lower, upper)]` for range partitions, sorted by lower bound."""
+    rows = conn.execute(text(
+        "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) "
+        "FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = to_regclass(:t)"
+    ), {"t": table}).fetchall()
+    parts = []
+    for name, bound in rows:
+        match = _BOUND_RE.search(bound or "")
+        if match:
+            parts.append((name, datetime.fromisoformat(match.group(1)), datetime.fromisoformat(match.group(2))))
+    return sorted(parts, key=lambda p: p[1])
+
+
+def _create_partition(conn, name, lower, upper):
+    conn.execute(text(f"CREATE TABLE {name} (LIKE {PARENT} INCLUDING DEFAULTS)"))
+    has_default = conn.execute(text("SELECT to_regclass(:t) IS NOT NULL"), {"t": DEFAULT_PARTITION}).scalar()
+    if has_default:
+        conn.execute(text(
+            f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION} WHERE ds >= :lo AND ds < :hi "
+            f"RETURNING id, ds, value, device_id) "
+            f"INSERT INTO {name} (id, ds, value, device_id) SELECT id, ds, value, device_id FROM moved"
+        ), {"lo": lower, "hi": upper})
+    conn.execute(text(
+        f"ALTER TABLE {PARENT} ATTACH PARTITION {name} "
+        f"FOR VALUES FROM ('{lower.isoformat(' ')}') TO ('{upper.isoformat(' ')}')"
+    ))
+
+
+def ensure_partitions(conn, start=None, ahead=PARTITIONS_AHEAD, interval=PARTITION_INTERVAL, now=None, dry_run=False):
+    """Create missing partitions from `start` (default: the current period) to `ahead` periods past now.
+
+    Ranges that overlap an existing partition are skipped, so changing the
+    interval never collides with partitions created under the old setting.
+    Returns the names of the partitions created.
+    """
+    if interval not in INTERVALS:
+        raise ValueError(f"Unknown partition interval {interval!r}; expected one of {', '.join(INTERVALS)}")
+    now = now or datetime.utcnow()
+    if not dry_run and conn.execute(text("SELECT to_regclass(:t) IS NULL"), {"t": DEFAULT_PARTITION}).scalar():
+        conn.execute(text(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {PARENT} DEFAULT"))
+
+    existing = list_partitions(conn)
+    lower = period_start(start or now, interval)
+    last = period_start(now, interval)
+    for _ in range(ahead):
+        last = next_period(last, interval)
+
+    created = []
+    while lower <= last:
+        upper = next_period(lower, interval)
+        if not any(lo < upper and lower < hi for _, lo, hi in existing):
+            name = f"{PARENT}_p{lower:%Y%m%d}"
+            if not dry_run:
+                _create_partition(conn, name, lower, upper)
+            existing.append((name, lower, upper))
+            created.append(name)
+        lower = upper
+    return created
+
+
+def apply_retention(conn, retention_days=RETENTION_DAYS, action=RETENTION_ACTION, now=None, dry_run=False):
+    """Detach or drop partitions whose upper bound is older than the retention window."""
+    if retention_days <= 0:
+        return []
+    if action not in ("detach", "drop"):
+        raise ValueError(f"Unknown retention action {action!r}; expected 'detach' or 'drop'")
+    cutoff = (now or datetime.utcnow()) - timedelta(days=retention_days)
+    expired = [name for name, _, upper in list_partitions(conn) if upper <= cutoff]
+    if not dry_run:
+        for name in expired:
+            conn.execute(text(f"ALTER TABLE {PARENT} DETACH PARTITION {name}"))
+            if action == "drop":
+                conn.execute(text(f"DROP TABLE {name}"))
+    return expired
+
+
+def maintain(engine, dry_run=False):
+    """Run one maintenance pass; returns `(created, expired)` partition names."""
+    with engine.begin() as conn:
+        if not is_partitioned(conn):
+            print(f"{PARENT} is not partitioned; run `python -m backend.migrate_sensor_data` first")
+            return [], []
+        created = ensure_partitions(conn, dry_run=dry_run)
+        expired = apply_retention(conn, dry_run=dry_run)
+    return created, expired
+
+
+class PartitionMaintainer:
+    """Daemon thread that runs `maintain()` every `interval` seconds."""
+
+    def __init__(self, engine, interval=MAINTENANCE_INTERVAL):
+        self.engine = engine
+        self.interval = interval
+        self._stop = threading.Event()
+
+    def start(self):
+        if self.interval > 0:
+            threading.Thread(target=self._run, name="partition-maintenance", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while True:
+            try:
+                created, expired = maintain(self.engine)
+                if created or expired:
+                    print(f"Partition maintenance: created {created}, expired {expired}")
+            except Exception as exc:  # noqa: BLE001
+                print(f"Partition maintenance failed: {exc}")
+            if self._stop.wait(self.interval):
+                return
+
+
+if __name__ == "__main__":
+    from . import config as cfg
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", default=None, help="Database URL (overrides env DB_URL)")
+    parser.add_argument("--dry-run", action="store_true", help="Only print what would change")
+    args = parser.parse_args()
+
+    created, expired = maintain(create_engine(args.db or cfg.get_db_url()), dry_run=args.dry_run)
+    verb = "Would" if args.dry_run else "Did"
+    print(f"{verb} create {len(created)} partitions: {', '.join(created) or '-'}")
+    print(f"{verb} {RETENTION_ACTION} {len(expired)} partitions: {', '.join(expired) or '-'}")
@@ -0,0 +1,207 @@
+"""
+Schema for the sensor tables, shared by `db_init.py`, the ingestor and the
+maintenance scripts. Importing this module has no side effects; call
+`init_sensor_schema(engine)` to create missing tables.
+
+Device names are dictionary-encoded: `devices` maps each name to a small
+integer surrogate key and `sensor_data.device_id` stores that key. The optional
+`devices.department` groups devices for live-stream subscriptions.
+
+`sensor_data` is range-partitioned on `ds`; partitions are created and expired
+by `sensor_partitions.py`. The primary key has to include the partition key,
+hence `(id, ds)`.
+
+Indexes on `sensor_data` (defined on the parent, so every partition gets them):
+- `ux_sensor_data_device_ds` unique btree `(device_id, ds)`: one reading per device
+  and timestamp (the ingest writer relies on it for `ON CONFLICT DO NOTHING`),
+  and the access path for "device X over a time range"
+- `ix_sensor_data_ds_brin` BRIN on `ds` for whole-table time windows; rows arrive
+  roughly in time order, so the BRIN index stays tiny and effective
+
+`sensor_rollup_1m` / `_1h` / `_1d` hold per-device count/sum/min/max/last per
+time bucket, maintained incrementally by the ingest writer (see `rollups.py`).
+
+`forecasts` stores every scheduled forecast run (see `forecast_scheduler.py`),
+keyed `(device, generated_at, ds)` so the newest run of a model is one index
+range scan. `device` is the model registry key (a device name, `dept:<name>`)
+or `*` for the global model. `ix_forecasts_generated_at` serves "recent runs of
+every model" (anomaly detection) and the retention delete.
+
+`anomalies` records readings outside their forecast band (see
+`anomaly_detector.py`): one row per episode, opened with `ended_at` NULL and
+closed when readings return inside the band.
+"""
+
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    DateTime,
+    Float,
+    ForeignKey,
+    Identity,
+    Index,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    func,
+    inspect,
+    text,
+)
+from sqlalchemy.schema import CreateIndex
+
+from . import sensor_partitions
+
+metadata = MetaData()
+
+devices_table = Table(
+    "devices",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("name", String, unique=True, nullable=False),
+    Column("department", String),
+    Column("created_at", DateTime, server_default=func.now()),
+)
+
+# `device_id` goes last so the 4-byte key does not force alignment padding
+# in front of the 8-byte `value`.
+sensor_table = Table(
+    "sensor_data",
+    metadata,
+    Column("id", BigInteger, Identity(), primary_key=True),
+    Column("ds", DateTime, primary_key=True),
+    Column("value", Float),
+    Column("device_id", Integer, ForeignKey("devices.id")),
+    postgresql_partition_by="RANGE (ds)",
+)
+
+Index("ux_sensor_data_device_ds", sensor_table.c.device_id, sensor_table.c.ds, unique=True)
+# Non-unique predecessor of ux_sensor_data_device_ds; dropped by migrate_sensor_data.
+LEGACY_DEVICE_DS_INDEX = "ix_sensor_data_device_ds"
+Index(
+    "ix_sensor_data_ds_brin",
+    sensor_table.c.ds,
+    postgresql_using="brin",
+    postgresql_with={"pages_per_range": 32},
+)
+
+
+def _rollup_table(grain):
+    return Table(
+        f"sensor_rollup_{grain}",
+        metadata,
+        Column("device_id", Integer, ForeignKey("devices.id"), primary_key=True),
+        Column("bucket", DateTime, primary_key=True),
+        Column("count", BigInteger, nullable=False),
+        Column("sum_value", Float, nullable=False),
+        Column("min_value", Float, nullable=False),
+        Column("max_value", Float, nullable=False),
+        Column("last_ds", DateTime, nullable=False),
+        Column("last_value", Float, nullable=False),
+    )
+
+
+ROLLUP_GRAINS = ("1m", "1h", "1d")
+rollup_tables = {grain: _rollup_table(grain) for grain in ROLLUP_GRAINS}
+
+
+forecasts_table = Table(
+    "forecasts",
+    metadata,
+    Column("device", String, primary_key=True),
+    Column("generated_at", DateTime, primary_key=True),
+    Column("ds", DateTime, primary_key=True),
+    Column("yhat", Float, nullable=False),
+    Column("yhat_lower", Float),
+    Column("yhat_upper", Float),
+    Column("model_version", String),
+    Index("ix_forecasts_generated_at", "generated_at"),
+)
+
+anomalies_table = Table(
+    "anomalies",
+    metadata,
+    Column("id", BigInteger, Identity(), primary_key=True),
+    Column("device_id", Integer, ForeignKey("devices.id"), nullable=False),
+    Column("started_at", DateTime, nullable=False),
+    Column("ended_at", DateTime),
+    Column("direction", String, nullable=False),  # 'high' or 'low'
+    Column("readings", Integer, nullable=False),
+    Column("peak_value", Float, nullable=False),
+    Column("peak_deviation", Float, nullable=False),  # distance outside the band at the peak
+    Column("expected_lower", Float),
+    Column("expected_upper", Float),
+    Column("model", String),
+    Index("ix_anomalies_device_started", "device_id", "started_at"),
+)
+
+
+def ensure_forecast_tables(engine):
+    """Create `forecasts` / `anomalies` and their indexes if missing (idempotent)."""
+    metadata.create_all(engine, tables=[forecasts_table, anomalies_table])
+    with engine.begin() as conn:
+        for index in forecasts_table.indexes:
+            conn.execute(CreateIndex(index, if_not_exists=True))
+
+
+def device_id_is_legacy(engine):
+    """True when `sensor_data.device_id` still stores free-form device names."""
+    insp = inspect(engine)
+    if not insp.has_table("sensor_data"):
+        return False
+    for col in insp.get_columns("sensor_data"):
+        if col["name"] == "device_id":
+            return col["type"].python_type is str
+    return False
+
+
+def has_unique_key(conn):
+    return conn.execute(text("SELECT to_regclass('ux_sensor_data_device_ds') IS NOT NULL")).scalar()
+
+
+def needs_migration(engine):
+    """Return why `sensor_data` must be migrated by `migrate_sensor_data`, or None."""
+    if device_id_is_legacy(engine):
+        return "device_id still stores device names"
+    with engine.connect() as conn:
+        if not sensor_partitions.is_partitioned(conn):
+            return "table is not partitioned by ds"
+        if not has_unique_key(conn):
+            return "no unique (device_id, ds) key yet; duplicate readings must be removed first"
+    return None
+
+
+def table_sizes(conn, table="sensor_data"):
+    """Heap, index and total on-disk size in bytes for `table`, including partitions."""
+    row = conn.exec_driver_sql(
+        "SELECT COALESCE(SUM(pg_relation_size(relid)), 0), COALESCE(SUM(pg_indexes_size(relid)), 0), "
+        "COALESCE(SUM(pg_total_relation_size(relid)), 0) "
+        "FROM (SELECT relid FROM pg_partition_tree(%(t)s::regclass) UNION SELECT %(t)s::regclass) parts",
+        {"t": table},
+    ).fetchone()
+    return {"table": int(row[0]), "indexes": int(row[1]), "total": int(row[2])}
+
+
+def ensure_sensor_indexes(conn, unique=False):
+    """Create any missing `sensor_data` indexes (idempotent; used for existing deployments).
+
+    Unless `unique` is set, the unique key is only created while the table is
+    empty: existing data may contain duplicates, which `migrate_sensor_data`
+    removes first.
+    """
+    if not unique:
+        unique = not conn.execute(text("SELECT EXISTS (SELECT 1 FROM sensor_data)")).scalar()
+    for index in sensor_table.indexes:
+        if index.unique and not unique and not has_unique_key(conn):
+            continue
+        conn.execute(CreateIndex(index, if_not_exists=True))
+
+
+def init_sensor_schema(engine):
+    metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE devices ADD COLUMN IF NOT EXISTS department VARCHAR"))
+        # Tables still in a legacy layout get their indexes from migrate_sensor_data.
+        if sensor_partitions.is_partitioned(conn):
+            ensure_sensor_indexes(conn)
+            sensor_partitions.ensure_partitions(conn)
@@ -0,0 +1,144 @@
+"""
+Downsampled time-range reads for one device, used by `/sensors/{device_id}/series`.
+
+The source is chosen from the range width with `rollups.pick_grain()`: raw
+`sensor_data` rows for short ranges, otherwise the coarsest rollup grain that
+still has at least `max_points` buckets. Whatever the source, rows are binned
+in SQL into at most `max_points` bins (LTTB gets the minimum and maximum point
+of each bin), so the rows returned stay within a small multiple of
+`max_points` however wide the range is or however often the device reports.
+
+Methods:
+- `avg`    - equal-width time buckets with the mean, aggregated in SQL
+- `minmax` - equal-width buckets with min and max (half as many buckets, so
+             the payload matches `max_points` values)
+- `lttb`   - Largest-Triangle-Three-Buckets over the source points, which
+             keeps peaks and dips that averaging would flatten
+"""
+
+import math
+from datetime import timedelta
+
+import numpy as np
+from sqlalchemy import text
+
+from .rollups import GRAIN_SECONDS, bucket_of, pick_grain
+
+METHODS = ("lttb", "minmax", "avg")
+
+
+def device_key(conn, name):
+    """`devices.id` for a device name, or None. Read-only: unknown names are not registered."""
+    return conn.execute(text("SELECT id FROM devices WHERE name = :name"), {"name": name}).scalar()
+
+
+def lttb(x, y, n):
+    """Indices of the `n` points of `(x, y)` selected by Largest-Triangle-Three-Buckets."""
+    size = len(x)
+    if n >= size:
+        return np.arange(size)
+    if n < 3:
+        return np.array([0, size - 1][:n])
+    # n - 2 buckets between the fixed first and last point.
+    edges = np.linspace(1, size - 1, n - 1).astype(int)
+    picked = np.empty(n, dtype=int)
+    picked[0], picked[-1] = 0, size - 1
+    a = 0
+    for i in range(n - 2):
+        lo, hi = edges[i], edges[i + 1]
+        if i == n - 3:
+            next_x, next_y = x[-1], y[-1]
+        else:
+            next_x, next_y = x[hi:edges[i + 2]].mean(), y[hi:edges[i + 2]].mean()
+        area = np.abs((x[a] - next_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (next_y - y[a]))
+        a = lo + int(area.argmax())
+        picked[i + 1] = a
+    return picked
+
+
+def _step(start, end, buckets, grain):
+    """Bucket width covering `[start, end)` in `buckets` steps, rounded up to whole source buckets."""
+    unit = GRAIN_SECONDS[grain] if grain else 1
+    seconds = (end - start).total_seconds() / max(1, buckets)
+    return timedelta(seconds=max(1, math.ceil(seconds / unit)) * unit)
+
+
+def _binned(conn, grain, device_id, start, end, step):
+    """`(bin, mean, min, max)` rows in bins of `step` starting at `start`."""
+    if grain is None:
+        sql = (
+            "SELECT date_bin(:step, ds, :start) AS b, avg(value), min(value), max(value) "
+            "FROM sensor_data WHERE device_id = :device_id AND ds >= :start AND ds < :end "
+            "AND value IS NOT NULL GROUP BY 1 ORDER BY 1"
+        )
+    else:
+        sql = (
+            f"SELECT date_bin(:step, bucket, :start) AS b, sum(sum_value) / sum(count), "
+            f"min(min_value), max(max_value) FROM sensor_rollup_{grain} "
+            f"WHERE device_id = :device_id AND bucket >= :start AND bucket < :end GROUP BY 1 ORDER BY 1"
+        )
+    params = {"device_id": device_id, "start": start, "end": end, "step": step}
+    return conn.execute(text(sql), params).fetchall()
+
+
+def _extremes(conn, grain, device_id, start, end, step):
+    """Per `step` bin, `(ds, value)` of its minimum and its maximum, in `ds` order.
+
+    From raw rows `ds` is the reading's own; from a rollup it is the start of
+    the bucket that holds the extreme.
+    """
+    if grain is None:
+        sql = (
+            "SELECT (array_agg(ds ORDER BY value, ds))[1], min(value), "
+            "(array_agg(ds ORDER BY value DESC, ds))[1], max(value) "
+            "FROM sensor_data WHERE device_id = :device_id AND ds >= :start AND ds < :end "
+            "AND value IS NOT NULL GROUP BY date_bin(:step, ds, :start) ORDER BY 1"
+        )
+    else:
+        sql = (
+            f"SELECT (array_agg(bucket ORDER BY min_value, bucket))[1], min(min_value), "
+            f"(array_agg(bucket ORDER BY max_value DESC, bucket))[1], max(max_value) "
+            f"FROM sensor_rollup_{grain} WHERE device_id = :device_id AND bucket >= :start AND bucket < :end "
+            f"GROUP BY date_bin(:step, bucket, :start) ORDER BY 1"
+        )
+    params = {"device_id": device_id, "start": start, "end": end, "step": step}
+    rows = conn.execute(text(sql), params).fetchall()
+    points = []
+    for min_ds, min_value, max_ds, max_value in rows:
+        points.extend(sorted({(min_ds, min_value), (max_ds, max_value)}))
+    return points
+
+
+def _points(conn, grain, device_id, start, end, max_points):
+    """Source points `(ds, value)` for LTTB: the extremes of `max_points` bins of raw rows or rollups."""
+    points = _extremes(conn, grain, device_id, start, end, _step(start, end, max_points, grain))
+    return [p[0] for p in points], [p[1] for p in points]
+
+
+def fetch_series(conn, device_id, start, end, max_points, method="lttb"):
+    """Downsample one device's readings in `[start, end)` to at most `max_points` values."""
+    grain = pick_grain(start, end, max_points)
+    if grain is not None:
+        start = bucket_of(start, grain)
+    result = {"source": grain or "raw", "method": method}
+
+    if method == "lttb":
+        ds, values = _points(conn, grain, device_id, start, end, max_points)
+        if len(ds) > max_points:
+            x = np.array([(d - ds[0]).total_seconds() for d in ds])
+            keep = lttb(x, np.asarray(values, dtype=float), max_points)
+            ds = [ds[i] for i in keep]
+            values = [values[i] for i in keep]
+        result.update(ds=ds, value=values)
+        return result
+
+    buckets = max_points // 2 if method == "minmax" else max_points
+    step = _step(start, end, buckets, grain)
+    rows = _binned(conn, grain, device_id, start, end, step)
+    result["step_seconds"] = step.total_seconds()
+    result["ds"] = [r[0] for r in rows]
+    if method == "minmax":
+        result.update(min=[r[2] for r in rows], max=[r[3] for r in rows])
+    else:
+        result["value"] = [r[1] for r in rows]
+    return result
@@ -0,0 +1,166 @@
+"""
+Fan-out hub for live sensor streaming (WebSocket / SSE).
+
+One upstream subscription (the API's `SensorFeed`) publishes decoded rows into
+the hub from the MQTT thread; the hub hands them to the event loop in batches
+and routes each reading to the subscribers interested in its device or its
+device's department. Each reading is serialized once and the same string is
+queued for every matching client.
+
+Every client has a bounded send queue. A client that falls `queue_size`
+messages behind is evicted (its queue is cleared and closed) instead of
+letting memory grow or slowing everybody else down.
+
+With `throttle_s > 0` at most one update per device is sent per interval; the
+newest reading within the interval wins and is delivered when it ends.
+"""
+
+import asyncio
+import json
+import threading
+import time
+
+
+class Subscriber:
+    def __init__(self, devices=None, departments=None, queue_size=256):
+        self.devices = set(devices or ())
+        self.departments = set(departments or ())
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.evicted = False
+
+    @property
+    def wildcard(self):
+        return not self.devices and not self.departments
+
+    async def get(self):
+        """Next serialized reading, or None once the subscriber has been evicted."""
+        return await self.queue.get()
+
+
+class StreamHub:
+    def __init__(self, queue_size=256, throttle_s=0.0):
+        self.queue_size = queue_size
+        self.throttle_s = throttle_s
+        self.departments = {}
+        self.stats = {"published": 0, "sent": 0, "throttled": 0, "evicted": 0}
+        self._loop = None
+        self._subscribers = set()
+        self._wildcard = set()
+        self._by_device = {}
+        self._by_department = {}
+        self._incoming = []
+        self._incoming_lock = threading.Lock()
+        self._scheduled = False
+        self._last_sent = {}
+        self._held = {}
+
+    # -- subscription management (event loop thread) ------------------------
+
+    def subscribe(self, devices=None, departments=None):
+        self._loop = asyncio.get_running_loop()
+        sub = Subscriber(devices, departments, self.queue_size)
+        self._subscribers.add(sub)
+        if sub.wildcard:
+            self._wildcard.add(sub)
+        for device in sub.devices:
+            self._by_device.setdefault(device, set()).add(sub)
+        for department in sub.departments:
+            self._by_department.setdefault(department, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        if sub not in self._subscribers:
+            return
+        self._subscribers.discard(sub)
+        self._wildcard.discard(sub)
+        for device in sub.devices:
+            _discard(self._by_device, device, sub)
+        for department in sub.departments:
+            _discard(self._by_department, department, sub)
+
+    def set_departments(self, mapping):
+        """Replace the device name -> department mapping used for department subscriptions."""
+        self.departments = dict(mapping)
+
+    def snapshot(self):
+        return {"clients": len(self._subscribers), **self.stats}
+
+    # -- publishing (any thread) --------------------------------------------
+
+    def publish(self, rows):
+        """Queue `(ds, device_id, value)` rows for delivery; safe to call from the MQTT thread."""
+        loop = self._loop
+        if loop is None or not self._subscribers:
+            return
+        with self._incoming_lock:
+            self._incoming.extend(rows)
+            if self._scheduled:
+                return
+            self._scheduled = True
+        try:
+            loop.call_soon_threadsafe(self._drain)
+        except RuntimeError:  # loop closed during shutdown
+            pass
+
+    def _drain(self):
+        with self._incoming_lock:
+            rows, self._incoming = self._incoming, []
+            self._scheduled = False
+        now = time.monotonic()
+        for ds, device_id, value in rows:
+            self.stats["published"] += 1
+            if self.throttle_s > 0:
+                due = self._last_sent.get(device_id, 0.0) + self.throttle_s
+                if now < due:
+                    self.stats["throttled"] += 1
+                    if device_id not in self._held:
+                        self._loop.call_later(due - now, self._release, device_id)
+                    self._held[device_id] = (ds, value)
+                    continue
+                self._last_sent[device_id] = now
+            self._deliver(device_id, ds, value)
+
+    def _release(self, device_id):
+        held = self._held.pop(device_id, None)
+        if held is None:
+            return
+        self._last_sent[device_id] = time.monotonic()
+        self._deliver(device_id, *held)
+
+    def _deliver(self, device_id, ds, value):
+        targets = set(self._wildcard)
+        targets.update(self._by_device.get(device_id, ()))
+        department = self.departments.get(device_id)
+        if department is not None:
+            targets.update(self._by_department.get(department, ()))
+        if not targets:
+            return
+        message = json.dumps({
+            "device_id": device_id,
+            "department": department,
+            "ds": ds.isoformat(),
+            "value": value,
+        })
+        for sub in targets:
+            try:
+                sub.queue.put_nowait(message)
+                self.stats["sent"] += 1
+            except asyncio.QueueFull:
+                self._evict(sub)
+
+    def _evict(self, sub):
+        self.stats["evicted"] += 1
+        sub.evicted = True
+        self.unsubscribe(sub)
+        while not sub.queue.empty():
+            sub.queue.get_nowait()
+        sub.queue.put_nowait(None)
+
+
+def _discard(index, key, sub):
+    subs = index.get(key)
+    if subs is None:
+        return
+    subs.discard(sub)
+    if not subs:
+        del index[key]
@@ -0,0 +1,227 @@
+"""
+Read API for live sensor data.
+- /sensors/latest                GET -> newest reading of every device
+- /sensors/{device_id}/recent    GET ?limit=N -> last N readings of one device
+- /sensors/{device_id}/series    GET ?start&end&max_points&method=lttb|minmax|avg -> downsampled history
+- /sensors/export                GET ?format=csv|csv.gz|parquet&device&department&start&end -> file download
+- /sensors/stream                GET (SSE) ?device=..&department=.. -> live readings
+- /sensors/stream/ws             WebSocket, same filters
+- /sensors/stream/stats          GET -> connected clients, sent/throttled/evicted counters
+
+The read endpoints are served from the in-process `RecentReadings` ring buffer
+fed by the MQTT sensor feed, so they never hit Postgres. The stream endpoints
+share that single feed through `StreamHub`; without filters a client receives
+every device. `/series` reads Postgres, choosing raw rows or a rollup table by
+range width (see `sensor_series.py`); `/export` streams from a server-side
+cursor (see `sensor_export.py`). `start()` warms the buffer from the database and starts the feed;
+it is called from `app_main` because mounted sub-apps do not receive
+startup/shutdown events.
+"""
+
+import asyncio
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+
+from fastapi import FastAPI, HTTPException, Query, WebSocket
+from fastapi.responses import StreamingResponse
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import SQLAlchemyError
+
+from . import config as cfg
+from .sensor_cache import RecentReadings
+from .sensor_export import FORMATS, ExportError, build_query, check_format, export
+from .sensor_series import METHODS, device_key, fetch_series
+from .sensor_stream import StreamHub
+
+CACHE_SIZE = int(os.environ.get("SENSOR_CACHE_SIZE", 120))
+WARM_HOURS = float(os.environ.get("SENSOR_CACHE_WARM_HOURS", 24))
+FEED_ENABLED = os.environ.get("SENSOR_FEED_ENABLED", "1") == "1"
+STREAM_QUEUE_SIZE = int(os.environ.get("SENSOR_STREAM_QUEUE_SIZE", 256))
+STREAM_THROTTLE_MS = int(os.environ.get("SENSOR_STREAM_THROTTLE_MS", 0))
+SERIES_MAX_POINTS = int(os.environ.get("SENSOR_SERIES_MAX_POINTS", 5000))
+EXPORT_CHUNK_ROWS = int(os.environ.get("SENSOR_EXPORT_CHUNK_ROWS", 50000))
+STREAM_KEEPALIVE_S = 15
+DEPARTMENT_REFRESH_S = 300
+
+app = FastAPI(title="Sensor Service")
+
+engine = create_engine(cfg.get_db_url())
+cache = RecentReadings(CACHE_SIZE)
+hub = StreamHub(queue_size=STREAM_QUEUE_SIZE, throttle_s=STREAM_THROTTLE_MS / 1000.0)
+feed = None
+_stop = threading.Event()
+
+
+def _reading(device_id, item):
+    ds, value = item
+    return {"device_id": device_id, "ds": ds, "value": value}
+
+
+def _naive_utc(value):
+    if value is not None and value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _load_departments():
+    with engine.connect() as conn:
+        rows = conn.execute(text("SELECT name, department FROM devices WHERE department IS NOT NULL")).fetchall()
+    hub.set_departments(rows)
+
+
+def _refresh_departments():
+    while not _stop.wait(DEPARTMENT_REFRESH_S):
+        try:
+            _load_departments()
+        except SQLAlchemyError as exc:  # noqa: BLE001
+            print(f"Device department refresh failed: {exc}")
+
+
+def start():
+    global feed
+    _stop.clear()
+    try:
+        _load_departments()
+    except SQLAlchemyError as exc:  # noqa: BLE001
+        print(f"Loading device departments failed: {exc}")
+    try:
+        warmed = cache.warm(engine, datetime.utcnow() - timedelta(hours=WARM_HOURS))
+        print(f"Sensor cache warmed with {warmed} readings")
+    except SQLAlchemyError as exc:  # noqa: BLE001
+        print(f"Sensor cache warm-up failed: {exc}")
+    if FEED_ENABLED and feed is None:
+        from .sensor_feed import SensorFeed
+
+        feed = SensorFeed()
+        feed.add_listener(_on_rows)
+        feed.start()
+        threading.Thread(target=_refresh_departments, name="device-departments", daemon=True).start()
+
+
+def _on_rows(rows):
+    # Only readings new to the cache are streamed, so redeliveries reach no client twice.
+    fresh = cache.add_rows(rows)
+    if fresh:
+        hub.publish(fresh)
+
+
+def stop():
+    global feed
+    _stop.set()
+    if feed is not None:
+        feed.stop()
+        feed = None
+
+
+@app.get("/latest")
+def latest():
+    readings = [_reading(device, item) for device, item in sorted(cache.latest().items())]
+    return {"readings": readings, "live": bool(feed and feed.connected)}
+
+
+@app.get("/export")
+def export_readings(
+    format: str = "csv",
+    device: List[str] = Query([]),
+    department: List[str] = Query([]),
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+):
+    try:
+        check_format(format)
+    except ExportError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    sql, params = build_query(device, department, _naive_utc(start), _naive_utc(end))
+    media_type, extension = FORMATS[format]
+    return StreamingResponse(
+        export(engine, format, sql, params, EXPORT_CHUNK_ROWS),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="sensor_data.{extension}"'},
+    )
+
+
+@app.get("/{device_id:path}/recent")
+def recent(device_id: str, limit: int = Query(CACHE_SIZE, ge=1, le=CACHE_SIZE)):
+    items = cache.recent(device_id, limit)
+    if items is None:
+        raise HTTPException(status_code=404, detail="Unknown device")
+    return {"device_id": device_id, "readings": [_reading(device_id, item) for item in items]}
+
+
+@app.get("/{device_id:path}/series")
+def series(
+    device_id: str,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    max_points: int = Query(500, ge=2, le=SERIES_MAX_POINTS),
+    method: str = "lttb",
+):
+    if method not in METHODS:
+        raise HTTPException(status_code=400, detail=f"method must be one of {', '.join(METHODS)}")
+    end = _naive_utc(end) or datetime.utcnow()
+    start = _naive_utc(start) or end - timedelta(days=1)
+    if start >= end:
+        raise HTTPException(status_code=400, detail="start must be before end")
+    with engine.connect() as conn:
+        key = device_key(conn, device_id)
+        if key is None:
+            raise HTTPException(status_code=404, detail="Unknown device")
+        result = fetch_series(conn, key, start, end, max_points, method)
+    return {"device_id": device_id, "start": start, "end": end, **result}
+
+
+@app.get("/stream/stats")
+def stream_stats():
+    return hub.snapshot()
+
+
+@app.get("/stream")
+async def stream_sse(device: List[str] = Query([]), department: List[str] = Query([])):
+    sub = hub.subscribe(device, department)
+
+    async def events():
+        try:
+            while True:
+                try:
+                    message = await asyncio.wait_for(sub.get(), STREAM_KEEPALIVE_S)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if message is None:
+                    yield "event: evicted\ndata: {}\n\n"
+                    return
+                yield f"data: {message}\n\n"
+        finally:
+            hub.unsubscribe(sub)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@app.websocket("/stream/ws")
+async def stream_ws(websocket: WebSocket, device: List[str] = Query([]), department: List[str] = Query([])):
+    await websocket.accept()
+    sub = hub.subscribe(device, department)
+
+    async def send():
+        while True:
+            message = await sub.get()
+            if message is None:
+                await websocket.close(code=1013, reason="slow consumer")
+                return
+            await websocket.send_text(message)
+
+    async def receive():
+        # Clients don't send anything; this only notices disconnects promptly.
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+
+    tasks = [asyncio.create_task(send()), asyncio.create_task(receive())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        hub.unsubscribe(sub)
@@ -1,54 +1,309 @@
 from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+import copy
 import joblib
 import os
+import threading
 import pandas as pd
-from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from typing import List, Literal, Optional
+
+from sqlalchemy import create_engine
+
+from . import config as cfg
+from .forecast_cache import ForecastCache
+from .forecast_scheduler import FORECAST_SCHEDULE_PERIODS, GLOBAL_KEY, latest_forecast, registry_models, run_forever
+from .model_registry import ModelRegistry
 
-app = FastAPI(title="Prophet Model Service")
 MODEL_PATH = os.environ.get("MODEL_PATH", "models/prophet_model.joblib")
+# Seconds between checks of MODEL_PATH for a new artifact (0: load once at startup)
+MODEL_WATCH_INTERVAL = float(os.environ.get("MODEL_WATCH_INTERVAL", 30))
+# Memory-map artifact arrays read-only so uvicorn workers share their pages
+MODEL_MMAP = os.environ.get("MODEL_MMAP", "1") == "1"
+# Forecasts only change when the model does; the TTL bounds staleness anyway.
+FORECAST_CACHE_TTL = float(os.environ.get("FORECAST_CACHE_TTL", 60))
+FORECAST_CACHE_SIZE = int(os.environ.get("FORECAST_CACHE_SIZE", 256))
+# Per-device/per-department models; MODEL_PATH stays the fallback for everything else.
+MODEL_REGISTRY_DIR = os.environ.get("MODEL_REGISTRY_DIR", "models/registry")
+MODEL_MEMORY_BUDGET_MB = float(os.environ.get("MODEL_MEMORY_BUDGET_MB", 512))
+# /predict_batch: request size limit and threads predicting model groups concurrently
+PREDICT_BATCH_MAX_ITEMS = int(os.environ.get("PREDICT_BATCH_MAX_ITEMS", 500))
+PREDICT_WORKERS = int(os.environ.get("PREDICT_WORKERS", 4))
+MAX_PERIODS = 7 * 24 * 60
+FREQ_MAP = {"min": "T", "H": "H"}
+# Inference modes: 'exact' samples the model's own uncertainty_samples (1000 by default) for
+# yhat_lower/yhat_upper, 'fast' only FAST_UNCERTAINTY_SAMPLES, 'point' skips intervals.
+INFERENCE_MODES = ("exact", "fast", "point")
+FAST_UNCERTAINTY_SAMPLES = int(os.environ.get("FAST_UNCERTAINTY_SAMPLES", 100))
+# Seconds between in-process forecast runs into the `forecasts` table (0: disabled;
+# enable it in one service process or run `python -m backend.forecast_scheduler` instead)
+FORECAST_SCHEDULE_INTERVAL = float(os.environ.get("FORECAST_SCHEDULE_INTERVAL", 0))
+
+
+def load_artifact(path):
+    # Artifacts are replaced by rename, so a mapped file is never rewritten under a running model.
+    return joblib.load(path, mmap_mode="r" if MODEL_MMAP else None)
+
+
+forecast_cache = ForecastCache(ttl=FORECAST_CACHE_TTL, max_entries=FORECAST_CACHE_SIZE)
+registry = ModelRegistry(MODEL_REGISTRY_DIR, memory_budget=int(MODEL_MEMORY_BUDGET_MB * 1024 * 1024),
+                         loader=load_artifact)
+predict_pool = ThreadPoolExecutor(max_workers=PREDICT_WORKERS, thread_name_prefix="predict")
+_stop = threading.Event()
+_engine = None
+
+
+def get_engine():
+    global _engine
+    if _engine is None:
+        _engine = create_engine(cfg.get_db_url(), pool_pre_ping=True)
+    return _engine
+
+
+@asynccontextmanager
+async def lifespan(app):
+    start()
+    yield
+    stop()
+
+
+app = FastAPI(title="Prophet Model Service", lifespan=lifespan)
+# (model, version) of the global model, replaced as one reference so a request never
+# pairs a model with another model's version; in-flight requests keep the old model.
+app.state.served = (None, None)
+app.state.model_loading = False
 
 class PredictNowRequest(BaseModel):
     lookback_minutes: int = 60
     freq: str = "min"   # 'min' for minute-level, 'H' for hourly
+    device_id: Optional[str] = None   # None uses the global model at MODEL_PATH
+    mode: Literal[INFERENCE_MODES] = "exact"
+
+
+class ForecastItem(BaseModel):
+    device_id: Optional[str] = None
+    freq: str = "min"
+    periods: Optional[int] = Field(None, ge=1, le=MAX_PERIODS)   # default: 60 for 'min', else 1
+
+
+class PredictBatchRequest(BaseModel):
+    items: List[ForecastItem]
+    mode: Literal[INFERENCE_MODES] = "exact"
+
+
+def artifact_version(path):
+    """Identity of the file at `path` (None if missing); changes whenever it is replaced."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return f"{st.st_mtime_ns}-{st.st_size}-{st.st_ino}"
 
 
-@app.on_event("startup")
 def load_model():
-    global model
-    if not os.path.exists(MODEL_PATH):
-        model = None
-        app.state.model = None
-        app.logger = lambda *args, **kwargs: None
+    """Load MODEL_PATH if it differs from the served model; returns True when swapped in."""
+    version = artifact_version(MODEL_PATH)
+    if version is None or version == app.state.served[1]:
+        return False
+    model = load_artifact(MODEL_PATH)
+    app.state.served = (model, version)
+    # Old-version entries can never be hit again; drop them instead of waiting for TTL/LRU.
+    forecast_cache.clear()
+    print(f"Loaded model {MODEL_PATH} (version {version})")
+    return True
+
+
+def _watch_model():
+    while True:
+        try:
+            load_model()
+        except Exception as exc:  # noqa: BLE001
+            # Keep serving the previous model; retry on the next check.
+            print(f"Loading {MODEL_PATH} failed: {exc}")
+        app.state.model_loading = False
+        if MODEL_WATCH_INTERVAL <= 0 or _stop.wait(MODEL_WATCH_INTERVAL):
+            return
+
+
+def _schedule_forecasts():
+    def predict(model, start):
+        return forecast(model, "min", FORECAST_SCHEDULE_PERIODS, start=start)
+
+    try:
+        run_forever(get_engine(), lambda: registry_models(registry, app.state.served), predict,
+                    FORECAST_SCHEDULE_INTERVAL, _stop, freq=FREQ_MAP["min"])
+    except Exception as exc:  # noqa: BLE001
+        print(f"Forecast scheduler stopped: {exc}")
+
+
+def start():
+    """Load the global model in the background and watch for new artifacts."""
+    _stop.clear()
+    app.state.model_loading = True
+    threading.Thread(target=_watch_model, name="model-watcher", daemon=True).start()
+    if FORECAST_SCHEDULE_INTERVAL > 0:
+        threading.Thread(target=_schedule_forecasts, name="forecast-scheduler", daemon=True).start()
+
+
+def stop():
+    _stop.set()
+
+
+def resolve_model(device_id):
+    """`(model, version, model_key)` serving `device_id`; falls back to the global model."""
+    if device_id is not None:
+        found = registry.get(device_id)
+        if found is not None:
+            return found
+    model, version = app.state.served
+    if model is None:
+        if app.state.model_loading:
+            raise HTTPException(status_code=503, detail="Model is still loading")
+        raise HTTPException(status_code=500, detail="Model not found. Train the model first and place at MODEL_PATH")
+    return model, version, None
+
+
+def forecast(model, freq, periods, mode="exact", start=None):
+    """`periods` future steps of `model` at `freq` as ds/yhat/yhat_lower/yhat_upper records.
+
+    Steps follow the end of the training history unless `start` is given. In
+    `point` mode (or for a model without uncertainty samples) the interval
+    bounds are None.
+    """
+    if mode != "exact":
+        # Shallow copy: the shared model may be predicting in other threads.
+        model = copy.copy(model)
+        model.uncertainty_samples = FAST_UNCERTAINTY_SAMPLES if mode == "fast" else 0
+    if start is not None:
+        future = pd.DataFrame({"ds": pd.date_range(start, periods=periods, freq=FREQ_MAP.get(freq, "T"))})
     else:
-        model = joblib.load(MODEL_PATH)
-        app.state.model = model
+        # Only the horizon is predicted; the training history is not re-scored.
+        future = model.make_future_dataframe(periods=periods, freq=FREQ_MAP.get(freq, "T"), include_history=False)
+    result = model.predict(future)
+    if "yhat_lower" not in result:
+        return [dict(r, yhat_lower=None, yhat_upper=None) for r in result[["ds", "yhat"]].to_dict(orient="records")]
+    return result[["ds", "yhat", "yhat_lower", "yhat_upper"]].to_dict(orient="records")
 
 
 @app.post("/predict_next_hour")
 def predict_next_hour(req: PredictNowRequest):
-    # This endpoint expects a trained Prophet model at MODEL_PATH.
+    # This endpoint expects a trained Prophet model in the registry or at MODEL_PATH.
     # For demo: we create a future dataframe using last timestamp frequency and request 60 minutes ahead.
-    if app.state.model is None:
-        raise HTTPException(status_code=500, detail="Model not found. Train the model first and place at MODEL_PATH")
-
-    model = app.state.model
-
-    # Create future dataframe for 60 steps depending on freq
-    # freq map
-    freq_map = {"min": "T", "H": "H"}
+    model, version, model_key = resolve_model(req.device_id)
     period = 60 if req.freq == "min" else 1
+    key = (version, req.freq, period, model_key, req.mode)
+    cached = forecast_cache.get(key)
+    if cached is not None:
+        return {"model": model_key, "predictions": cached}
+
     try:
-        future = model.make_future_dataframe(periods=period, freq=freq_map.get(req.freq, "T"))
+        result = forecast(model, req.freq, period, req.mode)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
+    forecast_cache.put(key, result)
+    return {"model": model_key, "predictions": result}
+
+
+def _predict_group(device_id, freq, periods, mode):
+    """Forecast the longest horizon of one (model, freq) group; shorter ones are its prefixes."""
+    model, version, model_key = resolve_model(device_id)
+    records = forecast(model, freq, max(periods), mode)
+    for n in set(periods):
+        forecast_cache.put((version, freq, n, model_key, mode), records[:n])
+    return model_key, records
+
+
+@app.post("/predict_batch")
+def predict_batch(req: PredictBatchRequest):
+    """Forecasts for many (device, freq, periods) items in one call.
+
+    Items served by the same model and freq share one future frame and one
+    `predict`; the groups run concurrently on `predict_pool`. Results come back
+    in request order, with an `error` instead of `predictions` for items whose
+    model is missing or failed.
+    """
+    if len(req.items) > PREDICT_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {PREDICT_BATCH_MAX_ITEMS} items per batch")
+
+    results = [None] * len(req.items)
+    groups = {}
+    global_model, global_version = app.state.served
+    for i, item in enumerate(req.items):
+        periods = item.periods or (60 if item.freq == "min" else 1)
+        results[i] = {"device_id": item.device_id, "freq": item.freq, "periods": periods}
+        resolved = registry.resolve(item.device_id) if item.device_id is not None else None
+        if resolved is not None:
+            model_key, version = resolved[0], resolved[1]["version"]
+        elif global_model is not None:
+            model_key, version = None, global_version
+        else:
+            results[i]["error"] = "No model for this device and no global model at MODEL_PATH"
+            continue
+        cached = forecast_cache.get((version, item.freq, periods, model_key, req.mode))
+        if cached is not None:
+            results[i].update(model=model_key, predictions=cached)
+            continue
+        group = groups.setdefault((model_key, item.freq), {"device_id": item.device_id, "items": []})
+        group["items"].append((i, periods))
+
+    futures = {
+        predict_pool.submit(_predict_group, group["device_id"], freq, [n for _, n in group["items"]], req.mode):
+            group["items"]
+        for (_, freq), group in groups.items()
+    }
+    for future, items in futures.items():
+        try:
+            model_key, records = future.result()
+        except Exception as e:
+            error = e.detail if isinstance(e, HTTPException) else str(e)
+            for i, _ in items:
+                results[i]["error"] = error
+            continue
+        for i, n in items:
+            results[i].update(model=model_key, predictions=records[:n])
+    return {"results": results}
+
+
+def _naive_utc(value):
+    if value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+@app.get("/forecast")
+def stored_forecast(device_id: Optional[str] = None, start: Optional[datetime] = None, end: Optional[datetime] = None):
+    """Newest scheduled forecast for `device_id` (or the global model), read from `forecasts`."""
+    resolved = registry.resolve(device_id) if device_id is not None else None
+    key = resolved[0] if resolved is not None else GLOBAL_KEY
+    start = _naive_utc(start) if start else datetime.min
+    end = _naive_utc(end) if end else datetime.max
+    with get_engine().connect() as conn:
+        rows = latest_forecast(conn, key, start, end)
+    if not rows:
+        raise HTTPException(status_code=404, detail="No stored forecast for this device")
+    return {
+        "model": key,
+        "generated_at": rows[0].generated_at,
+        "model_version": rows[0].model_version,
+        "predictions": [
+            {"ds": r.ds, "yhat": r.yhat, "yhat_lower": r.yhat_lower, "yhat_upper": r.yhat_upper} for r in rows
+        ],
+    }
+
 
-    forecast = model.predict(future.tail(period))
-    # return the last period predictions
-    result = forecast[["ds", "yhat", "yhat_lower", "yhat_upper"]].to_dict(orient="records")
-    return {"predictions": result}
+@app.get("/models")
+def list_models():
+    return {"models": registry.manifest()["models"], "registry": registry.snapshot()}
 
 
 @app.get("/health")
 def health():
-    return {"status": "ok", "model_loaded": app.state.model is not None}
+    return {
+        "status": "ok",
+        "model_loaded": app.state.served[0] is not None,
+        "model_loading": app.state.model_loading,
+        "forecast_cache": forecast_cache.snapshot(),
+        "model_registry": registry.snapshot(),
+    }
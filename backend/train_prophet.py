@@ -5,32 +5,135 @@ Saves a joblib model file `models/prophet_model.joblib`.
 Usage:
   # with DB
   export DB_URL=postgresql://user:pass@db:5432/energia
-  python train_prophet.py
+  python -m backend.train_prophet
 
   # or point to CSV
-  python train_prophet.py --csv data/sample_sensor.csv
+  python -m backend.train_prophet --csv data/sample_sensor.csv
+
+  # one model per device into the registry (see model_registry.py), 8 processes
+  python -m backend.train_prophet --per-device --workers 8
+
+  # 5-minute averages of one device for a time window, aggregated in Postgres
+  python -m backend.train_prophet --device esp32-meter-1 --freq 5min --since 2025-01-01
 
 The input data must have two columns: `ds` (timestamp ISO) and `y` (value to predict).
+
+`--per-device` is resumable: a device whose registered model already covers its
+newest reading (manifest watermark >= max(ds), or >= the start of the bucket
+holding max(ds) with `--freq`) is skipped unless `--force`.
+
+Every model is saved with a `.params.json` sidecar holding its `ds` watermark,
+enabled seasonalities and fitted parameters. With `--incremental` a retrain
+only reads rows newer than `watermark - --window-days` (the trailing window
+keeps enough history for the seasonalities) and warm-starts Stan from the
+previous parameters; models without a sidecar are trained from full history.
 """
 
 import os
+import sys
+import time
 import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
 from pathlib import Path
+import numpy as np
 import pandas as pd
+from pandas.tseries.frequencies import to_offset
 from prophet import Prophet
-import joblib
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
+
+from .rollups import grain_for_step
+from .model_registry import dump_model, load_params, params_path, read_json, read_manifest, save_model, update_manifest, write_json
 
 MODEL_DIR = Path("models")
 MODEL_DIR.mkdir(parents=True, exist_ok=True)
+MODEL_REGISTRY_DIR = os.environ.get("MODEL_REGISTRY_DIR", str(MODEL_DIR / "registry"))
+SEASONALITIES = ("yearly", "weekly", "daily")
+LOAD_CHUNK_ROWS = int(os.environ.get("TRAIN_LOAD_CHUNK_ROWS", 100_000))
+# Fixed origin so `--freq` buckets line up across (incremental) runs.
+BUCKET_ORIGIN = datetime(2000, 1, 1)
 
+# Newest reading per device; uses the (device_id, ds) index instead of scanning sensor_data.
+DEVICES_SQL = text(
+    "SELECT d.name, d.department, "
+    "(SELECT max(s.ds) FROM sensor_data s WHERE s.device_id = d.id) AS newest "
+    "FROM devices d ORDER BY d.name"
+)
 
-def load_from_db(db_url, table_name="sensor_data", ts_col="ts", value_col="value", limit=None):
-    engine = create_engine(db_url)
-    query = f"SELECT {ts_col} as ds, {value_col} as y FROM {table_name} ORDER BY {ts_col}"
+
+def _step(freq):
+    return pd.to_timedelta(to_offset(freq)).to_pytimedelta()
+
+
+def bucket_start(ts, freq):
+    """Start of the `freq` bucket holding `ts`, as `date_bin` computes it in `load_from_db`."""
+    step = _step(freq)
+    return BUCKET_ORIGIN + (ts - BUCKET_ORIGIN) // step * step
+
+
+def _aggregated_query(table_name, ts_col, value_col, freq):
+    """`(select, timestamp column, extra params)` bucketing readings into `freq` in Postgres."""
+    step = _step(freq)
+    grain = grain_for_step(step.total_seconds()) if table_name == "sensor_data" else None
+    if grain is not None:
+        # Whole-minute/hour/day steps are rebuilt from the rollups instead of raw rows.
+        return (
+            f"SELECT date_bin(:step, bucket, :origin) AS ds, sum(sum_value) / sum(count) AS y "
+            f"FROM sensor_rollup_{grain}",
+            "bucket",
+            {"step": step, "origin": BUCKET_ORIGIN},
+        )
+    return (
+        f"SELECT date_bin(:step, {ts_col}, :origin) AS ds, avg({value_col}) AS y FROM {table_name}",
+        ts_col,
+        {"step": step, "origin": BUCKET_ORIGIN},
+    )
+
+
+def load_from_db(db_url, table_name="sensor_data", ts_col="ds", value_col="value", limit=None, device=None,
+                 since=None, until=None, freq=None, chunksize=LOAD_CHUNK_ROWS):
+    """Read `ds`/`y` training rows, optionally for one device, `[since, until)` and bucketed to `freq`.
+
+    With `freq` (a pandas offset such as `5min` or `H`) readings are averaged
+    per bucket in Postgres, across devices when `device` is None; whole-minute
+    steps read the rollups, so history older than them needs `rollups --rebuild`
+    first. Rows are streamed from a server-side cursor `chunksize` at a time and
+    kept as datetime64/float32, so peak memory is about 12 bytes per returned row.
+    """
+    if freq:
+        select, ts_col, params = _aggregated_query(table_name, ts_col, value_col, freq)
+    else:
+        select, params = f"SELECT {ts_col} AS ds, {value_col} AS y FROM {table_name}", {}
+    where = []
+    if device is not None:
+        where.append("device_id = (SELECT id FROM devices WHERE name = :device)")
+        params["device"] = device
+    if since is not None:
+        where.append(f"{ts_col} >= :since")
+        params["since"] = since
+    if until is not None:
+        where.append(f"{ts_col} < :until")
+        params["until"] = until
+    query = select
+    if where:
+        query += " WHERE " + " AND ".join(where)
+    if freq:
+        query += " GROUP BY 1"
+    query += " ORDER BY 1"
     if limit:
-        query += f" LIMIT {limit}"
-    df = pd.read_sql(query, engine)
+        query += f" LIMIT {int(limit)}"
+
+    engine = create_engine(db_url)
+    chunks = []
+    with engine.connect() as conn:
+        conn = conn.execution_options(stream_results=True, max_row_buffer=chunksize)
+        for chunk in pd.read_sql_query(text(query), conn, params=params, chunksize=chunksize,
+                                       dtype={"y": "float32"}, parse_dates=["ds"]):
+            chunks.append(chunk)
+    engine.dispose()
+    if not chunks:
+        return pd.DataFrame({"ds": pd.Series(dtype="datetime64[ns]"), "y": pd.Series(dtype="float32")})
+    df = pd.concat(chunks, ignore_index=True)
     df["ds"] = pd.to_datetime(df["ds"])
     return df
 
@@ -41,32 +144,180 @@ def load_from_csv(path):
     return df
 
 
-def train(df, freq=None):
+def train(df, freq=None, state=None):
+    """Fit a Prophet model; `state` (a params sidecar) warm-starts it from a previous fit."""
     # Prophet works with ds/y
     df = df[["ds", "y"]].dropna().sort_values("ds")
-    # Simple example: no extra regressors
-    m = Prophet()
-    m.fit(df)
+    if state is None:
+        # Simple example: no extra regressors
+        m = Prophet()
+        m.fit(df)
+        return m
+    # Keep the previous model's seasonalities so `beta` has the same shape on a shorter window.
+    enabled = state["seasonalities"]
+    m = Prophet(**{f"{name}_seasonality": name in enabled for name in SEASONALITIES})
+    init = {name: np.asarray(value) for name, value in state["params"].items()}
+    n_changepoints = min(m.n_changepoints, int(np.floor(len(df) * m.changepoint_range)) - 1)
+    if len(init["delta"]) != n_changepoints:
+        # Fewer rows than changepoints; start those from zero like Prophet's default init.
+        init["delta"] = np.zeros(max(n_changepoints, 0))
+    m.fit(df, init=init)
     return m
 
 
+def model_state(model, watermark):
+    """Params sidecar for `model`: watermark, seasonalities and point estimates for `init=`."""
+    params = {name: model.params[name].mean(axis=0) for name in ("k", "m", "sigma_obs", "delta", "beta")}
+    return {
+        "watermark": pd.Timestamp(watermark).isoformat(),
+        "seasonalities": [name for name in SEASONALITIES if name in model.seasonalities],
+        "params": {
+            "k": float(params["k"][0]),
+            "m": float(params["m"][0]),
+            "sigma_obs": float(params["sigma_obs"][0]),
+            "delta": params["delta"].tolist(),
+            "beta": params["beta"].tolist(),
+        },
+    }
+
+
+def incremental_since(state, window_days):
+    """Start of the rows to read for a warm-started retrain, or None for full history."""
+    if state is None:
+        return None
+    return datetime.fromisoformat(state["watermark"]) - timedelta(days=window_days)
+
+
+def list_devices(db_url):
+    """`[(name, department, newest ds)]` for devices that have readings."""
+    engine = create_engine(db_url)
+    with engine.connect() as conn:
+        rows = conn.execute(DEVICES_SQL).all()
+    engine.dispose()
+    return [tuple(row) for row in rows if row.newest is not None]
+
+
+def fit_device(db_url, registry_dir, device, department=None, limit=None, min_rows=2, window_days=None, freq=None):
+    """Train and register the model for one device (runs in a worker process).
+
+    With `window_days` set, a device that already has a params sidecar is
+    retrained incrementally from it.
+    """
+    state = load_params(registry_dir, device) if window_days is not None else None
+    df = load_from_db(db_url, limit=limit, device=device, since=incremental_since(state, window_days), freq=freq)
+    if state is not None and len(df) < min_rows:
+        # The window is too sparse to fit on; retrain from full history instead.
+        state = None
+        df = load_from_db(db_url, limit=limit, device=device, freq=freq)
+    if len(df) < min_rows:
+        return device, len(df), None
+    started = time.perf_counter()
+    model = train(df, state=state)
+    seconds = time.perf_counter() - started
+    watermark = df["ds"].max()
+    save_model(registry_dir, device, model, watermark=watermark, rows=len(df), params=model_state(model, watermark),
+               department=department, fit_seconds=round(seconds, 2), warm_start=state is not None)
+    return device, len(df), seconds
+
+
+def train_per_device(db_url, registry_dir, workers=None, limit=None, min_rows=2, force=False, window_days=None,
+                     freq=None):
+    """Fit one model per device in `workers` processes; returns the number of failures."""
+    devices = list_devices(db_url)
+    departments = {name: department for name, department, _ in devices if department}
+    update_manifest(registry_dir, lambda manifest: manifest["departments"].update(departments))
+
+    models = read_manifest(registry_dir)["models"]
+    todo = []
+    for name, department, newest in devices:
+        # Bucketed models are watermarked with their last bucket's start, not the raw max(ds).
+        if freq:
+            newest = bucket_start(newest, freq)
+        watermark = (models.get(name) or {}).get("watermark")
+        if not force and watermark and datetime.fromisoformat(watermark) >= newest:
+            continue
+        todo.append((name, department))
+    print(f"{len(devices)} devices with data, {len(devices) - len(todo)} up to date, training {len(todo)}")
+
+    trained = failed = 0
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(fit_device, db_url, registry_dir, name, department, limit, min_rows, window_days, freq): name
+            for name, department in todo
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            name = futures[future]
+            try:
+                _, rows, seconds = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"[{done}/{len(todo)}] {name}: failed: {e}")
+                continue
+            if seconds is None:
+                print(f"[{done}/{len(todo)}] {name}: skipped, only {rows} rows")
+            else:
+                trained += 1
+                print(f"[{done}/{len(todo)}] {name}: {rows} rows, fit {seconds:.1f}s")
+    print(f"Trained {trained} models in {time.perf_counter() - started:.1f}s "
+          f"({failed} failed) into {registry_dir}")
+    return failed
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--csv", help="Path to CSV with ds,y columns")
     parser.add_argument("--db-url", help="Database URL (overrides env DB_URL)")
     parser.add_argument("--out", default=str(MODEL_DIR / "prophet_model.joblib"))
     parser.add_argument("--limit", type=int, help="Limit rows for training (for dev)")
+    parser.add_argument("--freq", help="Average readings into buckets of this pandas offset in Postgres, e.g. 5min, H")
+    parser.add_argument("--device", help="Train the single model on one device's readings")
+    parser.add_argument("--since", type=datetime.fromisoformat, help="Only rows with ds >= this timestamp")
+    parser.add_argument("--until", type=datetime.fromisoformat, help="Only rows with ds < this timestamp")
+    parser.add_argument("--per-device", action="store_true", help="Train one model per device into the registry")
+    parser.add_argument("--registry-dir", default=MODEL_REGISTRY_DIR)
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Training processes for --per-device")
+    parser.add_argument("--min-rows", type=int, default=100, help="Skip devices with fewer readings")
+    parser.add_argument("--force", action="store_true", help="Retrain devices whose model is up to date")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Warm-start from the saved params and read only rows since the watermark")
+    parser.add_argument("--window-days", type=float, default=14,
+                        help="Trailing history read before the watermark by --incremental")
     args = parser.parse_args()
+    window_days = args.window_days if args.incremental else None
 
+    if args.per_device:
+        db_url = args.db_url or os.environ.get("DB_URL")
+        if not db_url:
+            raise RuntimeError("--per-device needs a database. Export DB_URL or pass --db-url.")
+        failed = train_per_device(db_url, args.registry_dir, workers=args.workers, limit=args.limit,
+                                  min_rows=args.min_rows, force=args.force, window_days=window_days, freq=args.freq)
+        sys.exit(1 if failed else 0)
+
+    state = read_json(params_path(args.out)) if args.incremental else None
+    since = max(filter(None, (incremental_since(state, args.window_days), args.since)), default=None)
     if args.csv:
         df = load_from_csv(args.csv)
+        if since is not None:
+            df = df[df["ds"] >= since]
     else:
         db_url = args.db_url or os.environ.get("DB_URL")
         if not db_url:
             raise RuntimeError("No DB_URL set and no CSV provided. Export DB_URL or pass --csv.")
-        df = load_from_db(db_url, limit=args.limit)
+        df = load_from_db(db_url, limit=args.limit, device=args.device, since=since, until=args.until,
+                          freq=args.freq)
 
-    print(f"Training on {len(df)} rows")
-    model = train(df)
-    joblib.dump(model, args.out)
+    if state is not None and (df.empty or df["ds"].max() <= datetime.fromisoformat(state["watermark"])):
+        print(f"No rows newer than the watermark {state['watermark']}; model is up to date")
+        sys.exit(0)
+    if state is not None:
+        print(f"Training on {len(df)} rows since {since} (warm start)")
+    else:
+        print(f"Training on {len(df)} rows")
+    started = time.perf_counter()
+    model = train(df, state=state)
+    print(f"Fit in {time.perf_counter() - started:.1f}s")
+    # Atomic replace: serve_prophet may have the current artifact memory-mapped.
+    dump_model(model, args.out)
+    write_json(params_path(args.out), model_state(model, df["ds"].max()))
     print(f"Saved model to {args.out}")